@@ -3,22 +3,37 @@
 """
 import logging
 import os
+from datetime import datetime, timezone
 from pathlib import Path
+from zoneinfo import ZoneInfo
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     CommandHandler, CallbackQueryHandler, MessageHandler, 
     ConversationHandler, ContextTypes, filters
 )
-from config import ADMIN_IDS
+from config import ADMIN_IDS, MAILING_TIMEZONE
 from database import get_db, ReminderText, Mailing, BotSettings
 from mailing_system import create_mailing, send_test_mailing, send_mass_mailing
-from statistics import get_statistics, export_statistics_excel
+from recipients import SEGMENTS, segment_audience, count_recipients
+from mailing_scheduler import schedule_mailing
+from statistics import get_statistics, export_statistics_excel, export_statistics_csv
+from settings_cache import get_settings, reload_settings, notify_settings_changed
 
 logger = logging.getLogger(__name__)
 
 # Состояния для ConversationHandler
 (MAILING_TEXT, MAILING_IMAGE, MAILING_CONFIRM, 
- EDIT_REMINDER_SELECT, EDIT_REMINDER_TEXT) = range(5)
+ EDIT_REMINDER_SELECT, EDIT_REMINDER_TEXT, MAILING_AUDIENCE, MAILING_SCHEDULE) = range(7)
+
+# Формат времени отложенной рассылки
+SCHEDULE_FORMAT = "%d.%m.%Y %H:%M"
+
+# Подсказка о подстановках в текстах рассылок и напоминаний (message_templates.py)
+PLACEHOLDERS_HINT = (
+    "Подстановки: <code>{first_name}</code> - имя, <code>{username}</code> - username, "
+    "<code>{days_since_join}</code> - дней с регистрации; значение по умолчанию после «|»: "
+    "<code>{first_name|друг}</code>"
+)
 
 # Папка для хранения изображений
 MEDIA_DIR = Path("media")
@@ -42,7 +57,8 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
         [InlineKeyboardButton("📤 Создать рассылку", callback_data="admin_new_mailing")],
         [InlineKeyboardButton("✏️ Изменить тексты напоминаний", callback_data="admin_edit_reminders")],
-        [InlineKeyboardButton("📥 Выгрузить статистику (Excel)", callback_data="admin_export_stats")]
+        [InlineKeyboardButton("📥 Выгрузить статистику (Excel)", callback_data="admin_export_stats")],
+        [InlineKeyboardButton("📥 Выгрузить статистику (CSV)", callback_data="admin_export_stats_csv")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -54,7 +70,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📊 <b>Статистика</b> - просмотр статистики пользователей
 📤 <b>Создать рассылку</b> - создание и отправка рассылки
 ✏️ <b>Изменить тексты напоминаний</b> - настройка текстов напоминаний
-📥 <b>Выгрузить статистику</b> - экспорт данных в Excel
+📥 <b>Выгрузить статистику</b> - экспорт данных в Excel или сжатый CSV
     """
     
     await update.message.reply_text(admin_text, reply_markup=reply_markup, parse_mode='HTML')
@@ -106,7 +122,8 @@ async def start_new_mailing(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.edit_message_text(
         "📝 <b>Создание рассылки</b>\n\n"
         "Отправьте текст сообщения для рассылки.\n"
-        "Вы можете использовать HTML-форматирование: <b>жирный</b>, <i>курсив</i>, <code>код</code>\n\n"
+        "Вы можете использовать HTML-форматирование: <b>жирный</b>, <i>курсив</i>, <code>код</code>\n"
+        f"{PLACEHOLDERS_HINT}\n\n"
         "Для отмены отправьте /cancel",
         parse_mode='HTML'
     )
@@ -146,6 +163,8 @@ async def receive_mailing_image(update: Update, context: ContextTypes.DEFAULT_TY
         await file.download_to_drive(filepath)
         
         context.user_data['mailing_image'] = str(filepath)
+        # file_id фото уже есть у бота: рассылка сможет отправлять его без повторной загрузки
+        context.user_data['mailing_photo_file_id'] = photo.file_id
         
         await update.message.reply_text("✅ Изображение сохранено!")
     
@@ -159,15 +178,29 @@ async def skip_mailing_image(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     
     context.user_data['mailing_image'] = None
+    context.user_data['mailing_photo_file_id'] = None
     
     # Показываем предпросмотр
     return await show_mailing_preview(update, context)
 
 
+def _mailing_segment(context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Выбранный сегмент получателей (по умолчанию - все пользователи)"""
+    return context.user_data.get('mailing_segment', 'all')
+
+
 async def show_mailing_preview(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать предпросмотр рассылки"""
     message_text = context.user_data.get('mailing_text', '')
     image_path = context.user_data.get('mailing_image')
+    segment = _mailing_segment(context)
+    
+    # Размер аудитории: один COUNT с тем же условием, что и у рассылки
+    try:
+        recipients_count = await count_recipients(audience=segment_audience(segment))
+    except Exception as e:
+        logger.error(f"Ошибка при подсчете получателей: {e}")
+        recipients_count = '?'
     
     preview_text = f"""
 📋 <b>Предпросмотр рассылки</b>
@@ -176,11 +209,14 @@ async def show_mailing_preview(update: Update, context: ContextTypes.DEFAULT_TYP
 {message_text}
 
 <b>Изображение:</b> {'✅ Да' if image_path else '❌ Нет'}
+<b>Аудитория:</b> {SEGMENTS[segment][0]} ({recipients_count} получателей)
     """
     
     keyboard = [
+        [InlineKeyboardButton("🎯 Выбрать аудиторию", callback_data="mailing_audience")],
         [InlineKeyboardButton("✉️ Тестовая отправка", callback_data="mailing_test")],
         [InlineKeyboardButton("📢 Отправить всем", callback_data="mailing_send_all")],
+        [InlineKeyboardButton("🕒 Запланировать", callback_data="mailing_schedule")],
         [InlineKeyboardButton("❌ Отмена", callback_data="mailing_cancel")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -201,6 +237,94 @@ async def show_mailing_preview(update: Update, context: ContextTypes.DEFAULT_TYP
     return MAILING_CONFIRM
 
 
+async def choose_mailing_audience(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать список сегментов получателей"""
+    query = update.callback_query
+    await query.answer()
+    
+    current = _mailing_segment(context)
+    keyboard = [
+        [InlineKeyboardButton(f"{'✅ ' if key == current else ''}{title}", callback_data=f"mailing_segment_{key}")]
+        for key, (title, _) in SEGMENTS.items()
+    ]
+    
+    await query.edit_message_text(
+        "🎯 <b>Аудитория рассылки</b>\n\nВыберите, кому отправить сообщение:",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='HTML'
+    )
+    
+    return MAILING_AUDIENCE
+
+
+async def select_mailing_segment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сохранить выбранный сегмент и вернуться к предпросмотру"""
+    query = update.callback_query
+    await query.answer()
+    
+    segment = query.data[len("mailing_segment_"):]
+    if segment in SEGMENTS:
+        context.user_data['mailing_segment'] = segment
+    
+    return await show_mailing_preview(update, context)
+
+
+async def ask_mailing_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запросить время отложенной рассылки"""
+    query = update.callback_query
+    await query.answer()
+    
+    example = datetime.now(ZoneInfo(MAILING_TIMEZONE)).strftime(SCHEDULE_FORMAT)
+    await query.message.reply_text(
+        "🕒 <b>Отложенная рассылка</b>\n\n"
+        f"Отправьте дату и время запуска в формате <code>ДД.ММ.ГГГГ ЧЧ:ММ</code> "
+        f"(часовой пояс {MAILING_TIMEZONE}), например: <code>{example}</code>\n\n"
+        "Для отмены отправьте /cancel",
+        parse_mode='HTML'
+    )
+    
+    return MAILING_SCHEDULE
+
+
+async def receive_mailing_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Создать рассылку и запланировать ее на указанное время"""
+    try:
+        local_time = datetime.strptime(update.message.text.strip(), SCHEDULE_FORMAT)
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат. Пример: 31.12.2025 03:00")
+        return MAILING_SCHEDULE
+    
+    # В базе время хранится в UTC без часового пояса
+    scheduled_time = local_time.replace(tzinfo=ZoneInfo(MAILING_TIMEZONE)).astimezone(timezone.utc).replace(tzinfo=None)
+    if scheduled_time <= datetime.utcnow():
+        await update.message.reply_text("❌ Это время уже прошло. Укажите время в будущем.")
+        return MAILING_SCHEDULE
+    
+    user_id = update.effective_user.id
+    audience = segment_audience(_mailing_segment(context))
+    mailing_id = await create_mailing(
+        context.user_data.get('mailing_text', ''),
+        context.user_data.get('mailing_image'),
+        user_id,
+        context.user_data.get('mailing_photo_file_id'),
+        audience
+    )
+    
+    if mailing_id and await schedule_mailing(mailing_id, scheduled_time):
+        await update.message.reply_text(
+            f"✅ <b>Рассылка #{mailing_id} запланирована</b>\n\n"
+            f"Запуск: {local_time.strftime(SCHEDULE_FORMAT)} ({MAILING_TIMEZONE})\n"
+            f"Аудитория: {SEGMENTS[_mailing_segment(context)][0]}\n\n"
+            f"Вы получите уведомление о завершении.",
+            parse_mode='HTML'
+        )
+    else:
+        await update.message.reply_text("❌ Ошибка при планировании рассылки")
+    
+    context.user_data.clear()
+    return ConversationHandler.END
+
+
 async def send_test_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отправить тестовое сообщение"""
     query = update.callback_query
@@ -210,8 +334,11 @@ async def send_test_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_text = context.user_data.get('mailing_text', '')
     image_path = context.user_data.get('mailing_image')
     
+    photo_file_id = context.user_data.get('mailing_photo_file_id')
+    audience = segment_audience(_mailing_segment(context))
+    
     # Создаем рассылку
-    mailing_id = await create_mailing(message_text, image_path, user_id)
+    mailing_id = await create_mailing(message_text, image_path, user_id, photo_file_id, audience)
     
     if mailing_id:
         success, message = await send_test_mailing(context, mailing_id, user_id)
@@ -243,6 +370,8 @@ async def send_mass_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     message_text = context.user_data.get('mailing_text', '')
     image_path = context.user_data.get('mailing_image')
+    photo_file_id = context.user_data.get('mailing_photo_file_id')
+    audience = segment_audience(_mailing_segment(context))
     
     # Проверяем, есть ли ID рассылки в callback_data
     callback_data = query.data
@@ -252,9 +381,9 @@ async def send_mass_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             mailing_id = int(parts[-1])
         else:
             # Создаем новую рассылку
-            mailing_id = await create_mailing(message_text, image_path, user_id)
+            mailing_id = await create_mailing(message_text, image_path, user_id, photo_file_id, audience)
     else:
-        mailing_id = await create_mailing(message_text, image_path, user_id)
+        mailing_id = await create_mailing(message_text, image_path, user_id, photo_file_id, audience)
     
     if mailing_id:
         await query.message.reply_text("📨 Начинаю отправку сообщений...")
@@ -342,12 +471,7 @@ async def select_reminder_to_edit(update: Update, context: ContextTypes.DEFAULT_
     context.user_data['editing_reminder'] = reminder_type
     
     # Получаем текущий текст
-    db = get_db()
-    try:
-        reminder_text = db.query(ReminderText).filter_by(reminder_type=reminder_type).first()
-        current_text = reminder_text.text if reminder_text else "Текст не найден"
-    finally:
-        db.close()
+    current_text = get_settings().reminder_text(reminder_type) or "Текст не найден"
     
     reminder_names = {
         'reminder_3min': '3 минуты',
@@ -359,6 +483,7 @@ async def select_reminder_to_edit(update: Update, context: ContextTypes.DEFAULT_
     await query.edit_message_text(
         f"✏️ <b>Редактирование напоминания ({reminder_names.get(reminder_type, reminder_type)})</b>\n\n"
         f"<b>Текущий текст:</b>\n{current_text}\n\n"
+        f"{PLACEHOLDERS_HINT}\n\n"
         f"Отправьте новый текст напоминания или /cancel для отмены",
         parse_mode='HTML'
     )
@@ -377,7 +502,9 @@ async def save_reminder_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         if reminder_text:
             reminder_text.text = new_text
+            notify_settings_changed(db)
             db.commit()
+            await reload_settings()
             
             await update.message.reply_text(
                 f"✅ Текст напоминания <b>{reminder_type}</b> успешно обновлен!",
@@ -398,7 +525,7 @@ async def save_reminder_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 async def export_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Экспорт статистики в Excel"""
+    """Экспорт статистики в Excel или сжатый CSV"""
     query = update.callback_query
     await query.answer("Подготавливаю файл...")
     
@@ -408,14 +535,19 @@ async def export_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        filepath = await export_statistics_excel()
+        if query.data == "admin_export_stats_csv":
+            filepath = await export_statistics_csv()
+            filename = "statistics.csv.gz"
+        else:
+            filepath = await export_statistics_excel()
+            filename = "statistics.xlsx"
         
         if filepath and Path(filepath).exists():
             with open(filepath, 'rb') as file:
                 await context.bot.send_document(
                     chat_id=user_id,
                     document=file,
-                    filename="statistics.xlsx",
+                    filename=filename,
                     caption="📊 Статистика пользователей бота"
                 )
             
@@ -443,7 +575,8 @@ async def admin_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
         [InlineKeyboardButton("📤 Создать рассылку", callback_data="admin_new_mailing")],
         [InlineKeyboardButton("✏️ Изменить тексты напоминаний", callback_data="admin_edit_reminders")],
-        [InlineKeyboardButton("📥 Выгрузить статистику (Excel)", callback_data="admin_export_stats")]
+        [InlineKeyboardButton("📥 Выгрузить статистику (Excel)", callback_data="admin_export_stats")],
+        [InlineKeyboardButton("📥 Выгрузить статистику (CSV)", callback_data="admin_export_stats_csv")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -463,7 +596,7 @@ def setup_admin_handlers(application):
     # Главное меню
     application.add_handler(CommandHandler("admin", admin_command))
     application.add_handler(CallbackQueryHandler(show_statistics, pattern="^admin_stats$"))
-    application.add_handler(CallbackQueryHandler(export_statistics, pattern="^admin_export_stats$"))
+    application.add_handler(CallbackQueryHandler(export_statistics, pattern="^admin_export_stats(_csv)?$"))
     
     # Conversation handler для создания рассылки
     mailing_conv = ConversationHandler(
@@ -476,10 +609,17 @@ def setup_admin_handlers(application):
                 CallbackQueryHandler(cancel_mailing, pattern="^mailing_cancel$")
             ],
             MAILING_CONFIRM: [
+                CallbackQueryHandler(choose_mailing_audience, pattern="^mailing_audience$"),
+                CallbackQueryHandler(ask_mailing_schedule, pattern="^mailing_schedule$"),
                 CallbackQueryHandler(send_test_message, pattern="^mailing_test$"),
                 CallbackQueryHandler(send_mass_message, pattern="^mailing_send_all"),
                 CallbackQueryHandler(cancel_mailing, pattern="^mailing_cancel$")
-            ]
+            ],
+            MAILING_AUDIENCE: [
+                CallbackQueryHandler(select_mailing_segment, pattern="^mailing_segment_"),
+                CallbackQueryHandler(cancel_mailing, pattern="^mailing_cancel$")
+            ],
+            MAILING_SCHEDULE: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_mailing_schedule)]
         },
         fallbacks=[
             CommandHandler("cancel", cancel_mailing),
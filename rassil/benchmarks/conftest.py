@@ -0,0 +1,197 @@
+"""
+Окружение микробенчмарков: отдельная база, наполнение синтетическими
+пользователями и сравнение с сохраненными результатами
+
+База задается в BENCH_DATABASE_URL (по умолчанию - файл SQLite во
+временном каталоге), DATABASE_URL из .env не используется: таблица users
+перед замерами очищается. Размеры таблицы - BENCH_SIZES (через запятую).
+
+Результаты замеров хранятся в baselines/<диалект базы>.json. Замер,
+минимальное время которого хуже сохраненного больше чем на
+--regression-threshold, считается проваленным: помехи на машине только
+увеличивают время, поэтому минимум меняется меньше медианы. Сохраненные
+результаты обновляются с --update-baselines; записывать их нужно на той
+же машине и базе, на которой потом проверять.
+"""
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+import pytest
+
+BENCH_DIR = Path(__file__).resolve().parent
+BASELINES_DIR = BENCH_DIR / 'baselines'
+
+# Настройки бота читаются при импорте его модулей, поэтому задаются до них
+os.environ['DATABASE_URL'] = (
+    os.getenv('BENCH_DATABASE_URL') or f"sqlite:///{Path(tempfile.gettempdir()) / 'hi_bot_bench.db'}"
+)
+os.environ['ASYNC_DATABASE_URL'] = os.getenv('BENCH_ASYNC_DATABASE_URL', '')
+os.environ.setdefault('BOT_TOKEN', '123456:BENCH')
+os.environ['LOG_LEVEL'] = 'WARNING'
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+from sqlalchemy import delete, func, insert, select, text
+from alembic import command
+from database import engine, async_engine, alembic_config, User
+from config import REMINDER_INTERVALS
+
+SIZES = [int(size) for size in os.getenv('BENCH_SIZES', '10000,100000,1000000').split(',') if size.strip()]
+
+# user_id синтетических пользователей
+USER_ID_BASE = 10_000_000_000
+_SEED_CHUNK = 10_000
+
+# Результаты замеров этого запуска: имя замера -> статистика
+_results = {}
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('baselines', 'Сравнение с сохраненными результатами')
+    group.addoption('--update-baselines', action='store_true',
+                    help="Сохранить результаты запуска вместо сравнения")
+    group.addoption('--regression-threshold', type=float, default=0.2,
+                    help="Допустимое ухудшение минимального времени относительно сохраненного (0.2 = 20%%)")
+
+
+def _synthetic_users(size: int):
+    """
+    Пользователи, похожие на настоящих
+
+    Регистрация за последние 60 дней (2% - за последние сутки, им еще
+    отправляются напоминания), 30% подписаны, 3% заблокировали бота.
+    """
+    rng = random.Random(size)
+    now = datetime.utcnow()
+    for index in range(size):
+        recent = rng.random() < 0.02
+        age = timedelta(seconds=rng.randrange(24 * 3600 if recent else 60 * 24 * 3600))
+        subscribed = rng.random() < 0.3
+        row = {
+            'user_id': USER_ID_BASE + index,
+            'chat_id': USER_ID_BASE + index,
+            'username': f"user{index}" if rng.random() < 0.7 else None,
+            'first_name': f"Имя{index}",
+            'last_name': None,
+            'subscribed': subscribed,
+            'subscription_date': now - age / 2 if subscribed else None,
+            'created_at': now - age,
+            'reachability': 'blocked' if rng.random() < 0.03 else 'ok',
+        }
+        for reminder_type, interval in REMINDER_INTERVALS.items():
+            # Недавним пользователям наступившее напоминание отправлено не всегда
+            due = age.total_seconds() >= interval
+            row[f"{reminder_type}_sent"] = due and (not recent or rng.random() < 0.5)
+        yield row
+
+
+def _seed(size: int):
+    """Наполнить таблицу users (пропускается, если в ней уже эти пользователи)"""
+    with engine.begin() as conn:
+        count, last_user_id = conn.execute(select(func.count(), func.max(User.user_id))).one()
+        if count == size and last_user_id == USER_ID_BASE + size - 1:
+            return
+        conn.execute(delete(User))
+        chunk = []
+        for row in _synthetic_users(size):
+            chunk.append(row)
+            if len(chunk) == _SEED_CHUNK:
+                conn.execute(insert(User), chunk)
+                chunk = []
+        if chunk:
+            conn.execute(insert(User), chunk)
+    with engine.begin() as conn:
+        conn.execute(text('ANALYZE users'))
+
+
+@pytest.fixture(scope='session')
+def loop():
+    """Один цикл событий на запуск: соединения асинхронного пула привязаны к циклу"""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.run_until_complete(async_engine.dispose())
+    loop.close()
+
+
+@pytest.fixture(scope='session')
+def run_async(loop):
+    return loop.run_until_complete
+
+
+@pytest.fixture(scope='session', params=SIZES, ids=str)
+def users(request) -> int:
+    """Количество пользователей в наполненной таблице"""
+    # База бенчмарков одноразовая: схема приводится к последней миграции
+    command.upgrade(alembic_config(), 'head')
+    _seed(request.param)
+    return request.param
+
+
+@pytest.fixture
+def bench(benchmark, request, users):
+    """
+    Замер функции с проверкой против сохраненного результата
+
+    Количество повторов зависит от размера таблицы, чтобы замеры на
+    1M строк не шли часами.
+    """
+    def run(func, setup=None):
+        rounds = max(3, 200_000 // users)
+        result = benchmark.pedantic(func, setup=setup, rounds=rounds, iterations=1, warmup_rounds=1)
+        _check(request, benchmark.stats.stats)
+        return result
+    return run
+
+
+def _baseline_path() -> Path:
+    return BASELINES_DIR / f"{engine.dialect.name}.json"
+
+
+def _load_baselines() -> dict:
+    path = _baseline_path()
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding='utf-8')).get('results', {})
+
+
+def _check(request, stats):
+    name = request.node.name
+    _results[name] = {'min': stats.min, 'median': stats.median, 'mean': stats.mean, 'rounds': stats.rounds}
+    if request.config.getoption('--update-baselines'):
+        return
+
+    baseline = _load_baselines().get(name)
+    if baseline is None:
+        return
+    threshold = request.config.getoption('--regression-threshold')
+    limit = baseline['min'] * (1 + threshold)
+    if stats.min > limit:
+        pytest.fail(
+            f"Регрессия {name}: минимум {stats.min * 1000:.2f} мс, сохраненный "
+            f"{baseline['min'] * 1000:.2f} мс (допустимо до {limit * 1000:.2f} мс)",
+            pytrace=False
+        )
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if not session.config.getoption('--update-baselines', default=False) or not _results:
+        return
+    path = _baseline_path()
+    baselines = _load_baselines()
+    baselines.update(_results)
+    BASELINES_DIR.mkdir(exist_ok=True)
+    path.write_text(json.dumps({
+        'machine': {
+            'node': platform.node(),
+            'processor': platform.processor() or platform.machine(),
+            'python': platform.python_version(),
+            'database': engine.dialect.name,
+            'recorded_at': datetime.utcnow().isoformat(timespec='seconds'),
+        },
+        'results': dict(sorted(baselines.items())),
+    }, ensure_ascii=False, indent=2) + '\n', encoding='utf-8')
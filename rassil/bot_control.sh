@@ -158,6 +158,14 @@ update_bot() {
     cd $BOT_DIR
     source venv/bin/activate
     pip install --upgrade -r requirements.txt
+    
+    print_info "Применение миграций базы данных..."
+    if ! alembic upgrade head; then
+        deactivate
+        print_error "Ошибка при применении миграций, бот не запущен"
+        print_warning "Восстановите из резервной копии если нужно"
+        return
+    fi
     deactivate
     
     print_info "Запуск бота..."
@@ -2,11 +2,16 @@
 Основной модуль бота
 """
 import logging
-from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+import re
+from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
 from datetime import datetime
-from database import get_db, User
-from config import WELCOME_MESSAGE, VERIFICATION_MESSAGE, VERIFICATION_SUCCESS
+from sqlalchemy import select
+from database import get_async_db, User
+from user_ingest import upsert_user
+from cache import invalidate_user_statistics
+from message_templates import GREETING_MESSAGES, REMOVE_KEYBOARD, VERIFY_BUTTON_TEXT
+from config import VERIFICATION_SUCCESS
 
 logger = logging.getLogger(__name__)
 
@@ -18,59 +23,22 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     logger.info(f"Команда /start от пользователя {user.id} ({user.username})")
     
-    # Сохранение пользователя в базу данных
-    db = get_db()
+    # Сохранение пользователя в базу данных (пакетно вместе с другими пользователями)
     try:
-        existing_user = db.query(User).filter_by(user_id=user.id).first()
-        
-        if existing_user:
-            # Обновляем информацию о пользователе
-            existing_user.username = user.username
-            existing_user.first_name = user.first_name
-            existing_user.last_name = user.last_name
-            existing_user.chat_id = chat_id
-            logger.info(f"Обновлена информация о пользователе {user.id}")
-        else:
-            # Создаем нового пользователя (НЕ подписанного)
-            new_user = User(
-                user_id=user.id,
-                chat_id=chat_id,
-                username=user.username,
-                first_name=user.first_name,
-                last_name=user.last_name,
-                subscribed=False,  # Пользователь не подписан до нажатия кнопки "Ок"
-                created_at=datetime.utcnow()
-            )
-            db.add(new_user)
-            logger.info(f"Создан новый пользователь {user.id}")
-        
-        db.commit()
-        
+        await upsert_user(
+            user_id=user.id,
+            chat_id=chat_id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name
+        )
+        logger.info(f"Пользователь {user.id} сохранен")
     except Exception as e:
-        db.rollback()
         logger.error(f"Ошибка при сохранении пользователя: {e}")
-    finally:
-        db.close()
-    
-    # Отправляем приветственное сообщение
-    await update.message.reply_text(
-        WELCOME_MESSAGE,
-        parse_mode='HTML'
-    )
     
-    # Создаем кнопку "Я человек" для отправки в чат
-    keyboard = [[KeyboardButton("✅ Я человек!")]]
-    reply_markup = ReplyKeyboardMarkup(
-        keyboard,
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-    
-    # Отправляем сообщение с кнопкой верификации
-    await update.message.reply_text(
-        VERIFICATION_MESSAGE,
-        reply_markup=reply_markup
-    )
+    # Приветствие и сообщение с кнопкой верификации (заранее собранные)
+    for payload in GREETING_MESSAGES:
+        await update.message.reply_text(**payload)
 
 
 async def save_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -80,44 +48,48 @@ async def save_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Пользователь {user.id} отправил '✅ Я человек!'")
     
     # Сохраняем пользователя в БД как подписанного (для рассылки)
-    db = get_db()
-    try:
-        db_user = db.query(User).filter_by(user_id=user.id).first()
-        
-        if db_user:
-            # Отмечаем пользователя как подписанного
-            db_user.subscribed = True
-            db_user.subscription_date = datetime.utcnow()
-            db.commit()
-            
-            logger.info(f"Пользователь {user.id} сохранен в БД для рассылки")
-            
-            # Сообщение об успехе (убираем клавиатуру)
-            await update.message.reply_text(
-                text=VERIFICATION_SUCCESS,
-                reply_markup=ReplyKeyboardRemove()
-            )
+    # Соединение освобождается до ответа пользователю
+    db_user = None
+    async with get_async_db() as db:
+        try:
+            result = await db.execute(select(User).filter_by(user_id=user.id))
+            db_user = result.scalar_one_or_none()
             
-            # Отправляем главное меню
-            await update.message.reply_text(
-                text="<b>Главное меню</b>\n\nИспользуйте /help для просмотра доступных команд",
-                parse_mode='HTML'
-            )
-        else:
-            logger.error(f"Пользователь {user.id} не найден в БД")
+            if db_user:
+                # Отмечаем пользователя как подписанного
+                db_user.subscribed = True
+                db_user.subscription_date = datetime.utcnow()
+                await db.commit()
+                invalidate_user_statistics()
+                
+                logger.info(f"Пользователь {user.id} сохранен в БД для рассылки")
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"Ошибка при сохранении пользователя {user.id}: {e}")
             await update.message.reply_text(
-                text="❌ Ошибка: пользователь не найден. Попробуйте отправить /start еще раз.",
-                reply_markup=ReplyKeyboardRemove()
+                text="❌ Произошла ошибка при регистрации. Попробуйте позже.",
+                reply_markup=REMOVE_KEYBOARD
             )
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Ошибка при сохранении пользователя {user.id}: {e}")
+            return
+    
+    if db_user:
+        # Сообщение об успехе (убираем клавиатуру)
+        await update.message.reply_text(
+            text=VERIFICATION_SUCCESS,
+            reply_markup=REMOVE_KEYBOARD
+        )
+        
+        # Отправляем главное меню
+        await update.message.reply_text(
+            text="<b>Главное меню</b>\n\nИспользуйте /help для просмотра доступных команд",
+            parse_mode='HTML'
+        )
+    else:
+        logger.error(f"Пользователь {user.id} не найден в БД")
         await update.message.reply_text(
-            text="❌ Произошла ошибка при регистрации. Попробуйте позже.",
-            reply_markup=ReplyKeyboardRemove()
+            text="❌ Ошибка: пользователь не найден. Попробуйте отправить /start еще раз.",
+            reply_markup=REMOVE_KEYBOARD
         )
-    finally:
-        db.close()
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -147,7 +119,7 @@ def setup_handlers(application: Application):
     
     # Обработчик текстового сообщения "✅ Я человек!"
     application.add_handler(MessageHandler(
-        filters.TEXT & filters.Regex("^✅ Я человек!$"),
+        filters.TEXT & filters.Regex(f"^{re.escape(VERIFY_BUTTON_TEXT)}$"),
         save_user_message
     ))
     
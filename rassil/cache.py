@@ -0,0 +1,46 @@
+"""
+Кэш в памяти процесса
+"""
+import time
+from config import STATISTICS_CACHE_TTL
+
+# Значение-маркер отсутствия записи в кэше
+MISSING = object()
+
+
+class TTLCache:
+    """Простой кэш с ограниченным временем жизни записей"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}
+
+    def get(self, key):
+        """Значение по ключу или MISSING, если его нет или оно устарело"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return MISSING
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            self._entries.pop(key, None)
+            return MISSING
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+
+    def invalidate(self, key=None):
+        """Удалить запись (или все записи, если ключ не указан)"""
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+
+# Агрегаты по таблице users для админ-панели
+statistics_cache = TTLCache(STATISTICS_CACHE_TTL)
+
+
+def invalidate_user_statistics():
+    """Сбросить кэш статистики после изменения пользователей"""
+    statistics_cache.invalidate()
@@ -4,7 +4,8 @@
 Удаляет все данные из таблиц, но сохраняет структуру
 """
 import sys
-from database import get_db, User, Mailing, ReminderText, BotSettings, init_db
+from sqlalchemy import text
+from database import get_db, engine, Base, User, Mailing, MailingDelivery, ReminderText, BotSettings, init_db
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -18,6 +19,7 @@ def clear_database():
     print("Будут очищены таблицы:")
     print("  - users (пользователи)")
     print("  - mailings (рассылки)")
+    print("  - mailing_deliveries (журнал доставки рассылок)")
     print("  - reminder_texts (тексты напоминаний)")
     print("  - bot_settings (настройки бота, включая ссылку на канал)")
     
@@ -31,6 +33,10 @@ def clear_database():
         db = get_db()
         
         # Удаляем данные из таблиц в правильном порядке (из-за возможных связей)
+        logger.info("Очистка таблицы mailing_deliveries...")
+        deleted_deliveries = db.query(MailingDelivery).delete()
+        logger.info(f"Удалено записей из mailing_deliveries: {deleted_deliveries}")
+        
         logger.info("Очистка таблицы mailings...")
         deleted_mailings = db.query(Mailing).delete()
         logger.info(f"Удалено записей из mailings: {deleted_mailings}")
@@ -54,6 +60,7 @@ def clear_database():
         print("\n✅ База данных успешно очищена!")
         print(f"   - Пользователей удалено: {deleted_users}")
         print(f"   - Рассылок удалено: {deleted_mailings}")
+        print(f"   - Записей о доставке удалено: {deleted_deliveries}")
         print(f"   - Текстов напоминаний удалено: {deleted_reminders}")
         print(f"   - Настроек удалено: {deleted_settings}")
         print("\n⚠️  Не забудьте заново установить ссылку на канал через админ-панель!")
@@ -78,6 +85,10 @@ def recreate_database():
     
     try:
         logger.info("Пересоздание базы данных...")
+        # Удаляем таблицы вместе с версией Alembic: init_db создаст пустую базу миграциями
+        Base.metadata.drop_all(bind=engine)
+        with engine.begin() as conn:
+            conn.execute(text("DROP TABLE IF EXISTS alembic_version"))
         init_db()
         print("\n✅ База данных успешно пересоздана!")
         
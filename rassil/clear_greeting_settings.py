@@ -3,6 +3,7 @@
 """
 import sys
 from database import get_db, BotSettings
+from settings_cache import notify_settings_changed
 
 def clear_greeting_settings():
     """Удалить старые настройки приветствия из БД"""
@@ -27,6 +28,8 @@ def clear_greeting_settings():
             else:
                 print(f"ℹ️  Настройка {key} не найдена в БД")
         
+        # Запущенный бот перечитает настройки
+        notify_settings_changed(db)
         db.commit()
         print(f"\n✅ Успешно удалено {deleted_count} настроек приветствия из БД")
         print("Теперь бот будет использовать новые тексты из config.py")
@@ -1,18 +1,193 @@
 """
 Модуль для работы с базой данных
 """
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, Text, BigInteger, ARRAY
+from sqlalchemy import create_engine, inspect, Column, Integer, String, Boolean, DateTime, Text, BigInteger, Float, ARRAY, UniqueConstraint, LargeBinary, JSON, Index, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy import event, exc
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from contextlib import asynccontextmanager
 from datetime import datetime
-from config import DATABASE_URL
+from config import (
+    DATABASE_URL, ASYNC_DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING
+)
 import logging
+import os
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+# Асинхронные драйверы для синхронных схем URL
+_ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def _async_database_url(url: str) -> str:
+    """URL для асинхронного драйвера по синхронному DATABASE_URL"""
+    scheme, separator, rest = url.partition('://')
+    if scheme in _ASYNC_DRIVERS:
+        return f"{_ASYNC_DRIVERS[scheme]}{separator}{rest}"
+    return url
+
+
+class PoolMetrics:
+    """
+    Статистика пула соединений
+
+    Время ожидания соединения измеряет сам пул (см. _MeteredPoolMixin),
+    количество выданных соединений и переполнение отслеживают обработчики
+    событий checkout/checkin.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.engine = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Сбросить накопленные значения (текущее состояние пула не меняется)"""
+        with self._lock:
+            self.checkouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+            self.timeouts = 0
+            self.peak_checked_out = 0
+            self.peak_overflow = 0
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    @property
+    def pool(self):
+        # Пул берется у движка: после engine.dispose() он пересоздается
+        return self.engine.pool if self.engine is not None else None
+
+    def record_usage(self):
+        pool = self.pool
+        with self._lock:
+            self.peak_checked_out = max(self.peak_checked_out, pool.checkedout())
+            self.peak_overflow = max(self.peak_overflow, pool.overflow())
+
+    def snapshot(self) -> dict:
+        """Текущее состояние пула и накопленная статистика"""
+        pool = self.pool
+        with self._lock:
+            return {
+                'pool': self.name,
+                'size': pool.size() if pool is not None else 0,
+                'checked_out': pool.checkedout() if pool is not None else 0,
+                'overflow': max(pool.overflow(), 0) if pool is not None else 0,
+                'peak_checked_out': self.peak_checked_out,
+                'peak_overflow': max(self.peak_overflow, 0),
+                'checkouts': self.checkouts,
+                'wait_avg_ms': self.wait_total / self.checkouts * 1000 if self.checkouts else 0.0,
+                'wait_max_ms': self.wait_max * 1000,
+                'timeouts': self.timeouts,
+            }
+
+
+sync_pool_metrics = PoolMetrics('sync')
+async_pool_metrics = PoolMetrics('async')
+
+
+class _MeteredPoolMixin:
+    """Пул, который замеряет время ожидания свободного соединения"""
+
+    metrics = None
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.record_wait(time.perf_counter() - started_at, timed_out=True)
+            raise
+        self.metrics.record_wait(time.perf_counter() - started_at)
+        return connection
+
+
+class _MeteredQueuePool(_MeteredPoolMixin, QueuePool):
+    metrics = sync_pool_metrics
+
+
+class _MeteredAsyncQueuePool(_MeteredPoolMixin, AsyncAdaptedQueuePool):
+    metrics = async_pool_metrics
+
+
+def _pool_options(url: str, poolclass) -> dict:
+    """Параметры пула из config.py (SQLite использует свой пул по умолчанию)"""
+    if url.startswith('sqlite'):
+        return {}
+    return {
+        'poolclass': poolclass,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+
+
+def _attach_pool_metrics(engine, metrics: PoolMetrics):
+    """Подключить обработчики событий пула к статистике"""
+    if not isinstance(engine.pool, QueuePool):
+        return
+    metrics.engine = engine
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.record_usage()
+
+
 Base = declarative_base()
-engine = create_engine(DATABASE_URL, echo=False, pool_pre_ping=True)
+engine = create_engine(DATABASE_URL, echo=False, **_pool_options(DATABASE_URL, _MeteredQueuePool))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+_attach_pool_metrics(engine, sync_pool_metrics)
+
+# Асинхронный движок для обработчиков: запросы не блокируют цикл событий
+_async_url = ASYNC_DATABASE_URL or _async_database_url(DATABASE_URL)
+async_engine = create_async_engine(_async_url, echo=False, **_pool_options(_async_url, _MeteredAsyncQueuePool))
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+_attach_pool_metrics(async_engine.sync_engine, async_pool_metrics)
+
+
+def get_pool_stats() -> list:
+    """Статистика обоих пулов соединений (список словарей)"""
+    return [sync_pool_metrics.snapshot(), async_pool_metrics.snapshot()]
+
+
+def log_pool_stats(reset: bool = True):
+    """
+    Записать статистику пулов в лог
+
+    Args:
+        reset: Сбросить накопленные значения, чтобы следующая запись
+            показывала только новый интервал
+    """
+    for stats in get_pool_stats():
+        logger.info(
+            "Пул БД {pool}: размер {size}, выдано {checked_out} (пик {peak_checked_out}), "
+            "переполнение {overflow} (пик {peak_overflow}), выдач {checkouts}, "
+            "ожидание ср. {wait_avg_ms:.1f} мс / макс. {wait_max_ms:.1f} мс, таймаутов {timeouts}".format(**stats)
+        )
+    if reset:
+        sync_pool_metrics.reset()
+        async_pool_metrics.reset()
 
 
 class User(Base):
@@ -27,34 +202,144 @@ class User(Base):
     last_name = Column(String(255), nullable=True)
     subscribed = Column(Boolean, default=False)
     subscription_date = Column(DateTime, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
     reminder_3min_sent = Column(Boolean, default=False)
     reminder_10min_sent = Column(Boolean, default=False)
     reminder_30min_sent = Column(Boolean, default=False)
     reminder_9hours_sent = Column(Boolean, default=False)
+    reachability = Column(String(20), nullable=False, default='ok', server_default='ok')  # ok, blocked, chat_not_found, deactivated
+    unreachable_since = Column(DateTime, nullable=True)
+    last_messaged_at = Column(DateTime, nullable=True)  # Последняя доставленная рассылка
     
     def __repr__(self):
         return f"<User(user_id={self.user_id}, username={self.username}, subscribed={self.subscribed})>"
 
 
+# Пользователь получил не все напоминания (поздний этап отмечается вместе с ранними)
+REMINDERS_PENDING = or_(
+    User.reminder_3min_sent == False,
+    User.reminder_10min_sent == False,
+    User.reminder_30min_sent == False,
+    User.reminder_9hours_sent == False
+)
+
+# Проход напоминаний: неподписанные пользователи с неотправленными напоминаниями
+# в порядке (created_at, id); подписанные и получившие все напоминания в индекс не попадают
+Index(
+    'ix_users_reminders_pending', User.created_at, User.id,
+    postgresql_where=(User.subscribed == False) & REMINDERS_PENDING,
+    sqlite_where=(User.subscribed == False) & REMINDERS_PENDING
+)
+
+# Рассылка читает (id, user_id, chat_id) страницами по id: index-only scan без обращения к таблице
+Index(
+    'ix_users_broadcast', User.id,
+    postgresql_include=['user_id', 'chat_id']
+)
+
+# Рассылка по сегменту подписанных: выборка и подсчет читают только индекс
+Index(
+    'ix_users_subscribed', User.id,
+    postgresql_include=['user_id', 'chat_id', 'reachability'],
+    postgresql_where=User.subscribed == True,
+    sqlite_where=User.subscribed == True
+)
+
+
 class Mailing(Base):
     """Модель рассылки"""
     __tablename__ = 'mailings'
+    __table_args__ = (
+        # Диспетчер отложенных рассылок: status = 'scheduled' ORDER BY scheduled_time
+        Index('ix_mailings_status_scheduled_time', 'status', 'scheduled_time'),
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     message_text = Column(Text, nullable=False)
     image_path = Column(String(500), nullable=True)
+    photo_file_id = Column(String(255), nullable=True)  # file_id фото после первой загрузки в Telegram
     scheduled_time = Column(DateTime, nullable=True)
-    status = Column(String(50), default='draft')  # draft, test_sent, sent, sending
+    status = Column(String(50), default='draft')  # draft, test_sent, scheduled, sending, sent
     created_by = Column(BigInteger, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     sent_count = Column(Integer, default=0)
+    failed_count = Column(Integer, default=0)
+    pruned_count = Column(Integer, default=0)  # Пользователей, впервые признанных недоступными в этой рассылке
     total_count = Column(Integer, default=0)
+    started_at = Column(DateTime, nullable=True)  # Начало отправки (переход в 'sending'), от него отсчитывается сегмент
+    audience = Column(JSON, nullable=True)  # Сегмент получателей (см. recipients.audience_criteria), NULL - все
     
     def __repr__(self):
         return f"<Mailing(id={self.id}, status={self.status}, created_at={self.created_at})>"
 
 
+class MailingDelivery(Base):
+    """Модель результата доставки рассылки одному получателю"""
+    __tablename__ = 'mailing_deliveries'
+    __table_args__ = (
+        UniqueConstraint('mailing_id', 'recipient_id', name='uq_mailing_deliveries_recipient'),
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    mailing_id = Column(Integer, nullable=False)
+    recipient_id = Column(Integer, nullable=False)  # users.id
+    user_id = Column(BigInteger, nullable=False)
+    status = Column(String(20), nullable=False)  # sent, failed, blocked, chat_not_found, deactivated
+    error = Column(String(255), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<MailingDelivery(mailing_id={self.mailing_id}, user_id={self.user_id}, status={self.status})>"
+
+
+class MailingChunk(Base):
+    """Модель диапазона получателей рассылки: единица работы для процессов рассылки"""
+    __tablename__ = 'mailing_chunks'
+    __table_args__ = (
+        Index('ix_mailing_chunks_mailing_id_status', 'mailing_id', 'status'),
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    mailing_id = Column(Integer, nullable=False)
+    first_recipient_id = Column(Integer, nullable=False)  # users.id, включительно
+    last_recipient_id = Column(Integer, nullable=False)  # users.id, включительно
+    status = Column(String(20), nullable=False, default='pending')  # pending, claimed, done
+    claimed_by = Column(String(100), nullable=True)  # хост:pid процесса
+    claimed_at = Column(DateTime, nullable=True)  # Последнее продление захвата
+    
+    def __repr__(self):
+        return f"<MailingChunk(mailing_id={self.mailing_id}, {self.first_recipient_id}-{self.last_recipient_id}, status={self.status})>"
+
+
+class RateBudget(Base):
+    """Модель общего для нескольких процессов лимита отправки (см. SharedRateBudget в rate_limiter.py)"""
+    __tablename__ = 'rate_budgets'
+    
+    name = Column(String(100), primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f"<RateBudget(name={self.name}, tokens={self.tokens})>"
+
+
+class PersistenceEntry(Base):
+    """Модель записи состояния бота (user_data, chat_data, bot_data, состояния диалогов)"""
+    __tablename__ = 'persistence_entries'
+    __table_args__ = (
+        UniqueConstraint('kind', 'key', name='uq_persistence_entries_kind_key'),
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(20), nullable=False)  # user, chat, bot, conversation
+    key = Column(String(255), nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<PersistenceEntry(kind={self.kind}, key={self.key})>"
+
+
 class ReminderText(Base):
     """Модель для хранения текстов напоминаний"""
     __tablename__ = 'reminder_texts'
@@ -81,10 +366,68 @@ class BotSettings(Base):
         return f"<BotSettings(setting_key={self.setting_key})>"
 
 
+# Каталог миграций Alembic (alembic.ini рядом с модулем)
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alembic.ini')
+
+
+def alembic_config():
+    """Конфигурация Alembic для вызова миграций из кода"""
+    from alembic.config import Config
+    config = Config(ALEMBIC_INI)
+    config.set_main_option('script_location', os.path.join(os.path.dirname(ALEMBIC_INI), 'migrations'))
+    # Логирование уже настроено ботом
+    config.attributes['configure_logger'] = False
+    return config
+
+
+def check_schema_version():
+    """
+    Проверка схемы при запуске: база не отстает от последней миграции
+
+    Один запрос к базе вместо сравнения всей схемы с моделями. Пустая база
+    (первый запуск) создается миграциями сразу; существующая обновляется
+    отдельно командой `alembic upgrade head`, до перезапуска бота. Версия
+    новее известных боту (миграции следующей версии применены, а код еще
+    старый) только записывается в лог: работающий бот, перезапущенный
+    посреди обновления, должен запуститься.
+    """
+    from alembic import command
+    from alembic.runtime.migration import MigrationContext
+    from alembic.script import ScriptDirectory
+    from alembic.util import CommandError
+    config = alembic_config()
+    script = ScriptDirectory.from_config(config)
+    head = script.get_current_head()
+    
+    with engine.connect() as conn:
+        current = MigrationContext.configure(conn).get_current_revision()
+        empty = current is None and not inspect(conn).has_table('users')
+    
+    if current == head:
+        return
+    if empty:
+        logger.info("Пустая база данных: создание схемы миграциями")
+        command.upgrade(config, 'head')
+        return
+    if current is not None:
+        try:
+            script.get_revision(current)
+        except CommandError:
+            logger.warning(
+                f"Версия схемы базы данных {current} новее версии бота ({head}): "
+                f"миграции следующей версии уже применены, запуск продолжается"
+            )
+            return
+    raise RuntimeError(
+        f"Схема базы данных не соответствует версии бота (в базе {current or 'нет версии Alembic'}, "
+        f"нужна {head}). Выполните в каталоге бота: alembic upgrade head"
+    )
+
+
 def init_db():
     """Инициализация базы данных"""
     try:
-        Base.metadata.create_all(bind=engine)
+        check_schema_version()
         logger.info("База данных успешно инициализирована")
         
         # Инициализация текстов напоминаний по умолчанию
@@ -110,12 +453,74 @@ def init_db():
             logger.error(f"Ошибка при инициализации текстов: {e}")
         finally:
             db.close()
+        
+        # Тексты и настройки держатся в памяти, обработчики не читают их из базы
+        from settings_cache import load_settings
+        load_settings()
             
     except Exception as e:
         logger.error(f"Ошибка при инициализации базы данных: {e}")
         raise
 
 
+def fetch_user_page(columns, after_id: int = None, page_size: int = 1000, descending: bool = False, criteria=()):
+    """
+    Одна страница пользователей по первичному ключу (keyset-пагинация)
+    
+    Args:
+        columns: Выбираемые колонки User (User.id добавляется первой автоматически)
+        after_id: id последней строки предыдущей страницы (None - с начала)
+        page_size: Размер страницы
+        descending: Обход от новых пользователей к старым
+        criteria: Дополнительные условия фильтрации
+    
+    Returns:
+        list: Строки (Row) с полями id и запрошенными колонками
+    """
+    db = get_db()
+    try:
+        query = db.query(User.id, *columns).filter(*criteria)
+        if descending:
+            if after_id is not None:
+                query = query.filter(User.id < after_id)
+            query = query.order_by(User.id.desc())
+        else:
+            if after_id is not None:
+                query = query.filter(User.id > after_id)
+            query = query.order_by(User.id)
+        return query.limit(page_size).all()
+    finally:
+        db.close()
+
+
+def iter_user_rows(columns, page_size: int = 1000, descending: bool = False, criteria=()):
+    """
+    Обход всех пользователей страницами, без загрузки всей таблицы в память
+    
+    Каждая страница читается в отдельной короткой сессии, поэтому
+    соединение не удерживается на время обработки строк.
+    """
+    after_id = None
+    while True:
+        page = fetch_user_page(columns, after_id, page_size, descending, criteria)
+        yield from page
+        if len(page) < page_size:
+            return
+        after_id = page[-1].id
+
+
+# INSERT ... ON CONFLICT есть только в диалектах PostgreSQL и SQLite
+_INSERT_BY_DIALECT = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+def upsert_insert(table):
+    """INSERT с поддержкой on_conflict_do_update для диалекта базы"""
+    return _INSERT_BY_DIALECT[async_engine.dialect.name](table)
+
+
 def get_db() -> Session:
     """Получить сессию базы данных"""
     db = SessionLocal()
@@ -126,3 +531,22 @@ def get_db() -> Session:
         raise
 
 
+@asynccontextmanager
+async def get_async_db():
+    """
+    Асинхронная сессия базы данных
+    
+    Использование:
+        async with get_async_db() as db:
+            result = await db.execute(select(User).filter_by(user_id=user_id))
+    """
+    db = AsyncSessionLocal()
+    try:
+        yield db
+    except Exception:
+        await db.rollback()
+        raise
+    finally:
+        await db.close()
+
+
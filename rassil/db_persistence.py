@@ -0,0 +1,204 @@
+"""
+Хранение состояния бота в базе данных вместо PicklePersistence
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import pickle
+from datetime import datetime
+from sqlalchemy import select, delete, tuple_
+from telegram.ext import BasePersistence, PersistenceInput
+from database import get_async_db, upsert_insert, PersistenceEntry
+from config import PERSISTENCE_UPDATE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Строк в одном INSERT (ограничение числа параметров запроса)
+_WRITE_CHUNK = 1000
+
+USER = 'user'
+CHAT = 'chat'
+BOT = 'bot'
+CONVERSATION = 'conversation'
+
+
+def _conversation_key(name: str, key: tuple) -> str:
+    return f"{name}:{json.dumps(list(key))}"
+
+
+class DatabasePersistence(BasePersistence):
+    """
+    Состояние бота в таблице persistence_entries, по строке на ключ
+
+    - user_data и chat_data не загружаются при запуске: данные пользователя
+      читаются из базы при его первом обновлении (refresh_user_data), поэтому
+      запуск не зависит от того, сколько пользователей когда-либо писали боту.
+    - Записываются только ключи, данные которых действительно изменились
+      (сравнивается хеш сериализованных данных), одной транзакцией.
+    - Запись выполняет фоновая задача, обработчики обновлений ее не ждут.
+      Application вызывает update_* раз в update_interval секунд.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._loaded = {USER: set(), CHAT: set()}
+        self._digests = {}
+        self._dirty = {}
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+
+    # --- Загрузка ---
+
+    async def _load(self, kind: str, key: str):
+        async with get_async_db() as db:
+            result = await db.execute(
+                select(PersistenceEntry.data).where(PersistenceEntry.kind == kind, PersistenceEntry.key == key)
+            )
+            data = result.scalar_one_or_none()
+        if data is None:
+            return None
+        self._digests[(kind, key)] = hashlib.sha1(data).digest()
+        return pickle.loads(data)
+
+    async def _refresh(self, kind: str, entity_id: int, data: dict):
+        loaded = self._loaded[kind]
+        if entity_id in loaded:
+            return
+        loaded.add(entity_id)
+        try:
+            stored = await self._load(kind, str(entity_id))
+        except Exception as e:
+            loaded.discard(entity_id)
+            logger.error(f"Не удалось загрузить состояние {kind} {entity_id}: {e}")
+            return
+        if stored:
+            for key, value in stored.items():
+                data.setdefault(key, value)
+
+    async def get_user_data(self):
+        # Данные пользователей загружаются по одному в refresh_user_data
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return await self._load(BOT, '') or {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        prefix = f"{name}:"
+        async with get_async_db() as db:
+            result = await db.execute(
+                select(PersistenceEntry.key, PersistenceEntry.data).where(
+                    PersistenceEntry.kind == CONVERSATION,
+                    PersistenceEntry.key.startswith(prefix, autoescape=True)
+                )
+            )
+            rows = result.all()
+        conversations = {}
+        for row in rows:
+            self._digests[(CONVERSATION, row.key)] = hashlib.sha1(row.data).digest()
+            conversations[tuple(json.loads(row.key[len(prefix):]))] = pickle.loads(row.data)
+        return conversations
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        await self._refresh(USER, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        await self._refresh(CHAT, chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data: dict):
+        # bot_data загружается целиком при запуске
+        pass
+
+    # --- Запись ---
+
+    def _mark(self, kind: str, key: str, value):
+        """Поставить ключ в очередь на запись (value=None - удалить)"""
+        if value is None:
+            self._digests.pop((kind, key), None)
+            self._dirty[(kind, key)] = None
+        else:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            digest = hashlib.sha1(data).digest()
+            if self._digests.get((kind, key)) == digest:
+                return
+            self._digests[(kind, key)] = digest
+            self._dirty[(kind, key)] = data
+
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_dirty())
+
+    async def _write_dirty(self):
+        """Записать накопленные изменения (пока они есть)"""
+        async with self._write_lock:
+            while self._dirty:
+                batch, self._dirty = self._dirty, {}
+                try:
+                    await _write_entries(batch)
+                except Exception as e:
+                    logger.error(f"Не удалось сохранить состояние бота ({len(batch)} ключей): {e}")
+                    # Возвращаем в очередь то, что не успело измениться снова
+                    for entry, data in batch.items():
+                        self._dirty.setdefault(entry, data)
+                    return
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._loaded[USER].add(user_id)
+        self._mark(USER, str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        self._loaded[CHAT].add(chat_id)
+        self._mark(CHAT, str(chat_id), data)
+
+    async def update_bot_data(self, data: dict):
+        self._mark(BOT, '', data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name: str, key: tuple, new_state):
+        self._mark(CONVERSATION, _conversation_key(name, key), new_state)
+
+    async def drop_user_data(self, user_id: int):
+        self._mark(USER, str(user_id), None)
+
+    async def drop_chat_data(self, chat_id: int):
+        self._mark(CHAT, str(chat_id), None)
+
+    async def flush(self):
+        """Дописать все изменения (вызывается при остановке бота)"""
+        if self._writer is not None:
+            await asyncio.gather(self._writer, return_exceptions=True)
+        await self._write_dirty()
+
+
+async def _write_entries(batch: dict):
+    """Одна транзакция: upsert измененных ключей и удаление удаленных"""
+    now = datetime.utcnow()
+    rows = [
+        {'kind': kind, 'key': key, 'data': data, 'updated_at': now}
+        for (kind, key), data in batch.items() if data is not None
+    ]
+    deleted = [entry for entry, data in batch.items() if data is None]
+
+    async with get_async_db() as db:
+        for start in range(0, len(rows), _WRITE_CHUNK):
+            statement = upsert_insert(PersistenceEntry).values(rows[start:start + _WRITE_CHUNK])
+            statement = statement.on_conflict_do_update(
+                index_elements=[PersistenceEntry.kind, PersistenceEntry.key],
+                set_={'data': statement.excluded.data, 'updated_at': statement.excluded.updated_at}
+            )
+            await db.execute(statement)
+        if deleted:
+            await db.execute(
+                delete(PersistenceEntry).where(tuple_(PersistenceEntry.kind, PersistenceEntry.key).in_(deleted))
+            )
+        await db.commit()
@@ -1,61 +1,225 @@
 """
 Обработчик заявок на вступление в канал
 """
+import asyncio
 import logging
-from datetime import datetime
-from telegram import Update, ChatJoinRequest, KeyboardButton, ReplyKeyboardMarkup
+import time
+from telegram import Update, ChatJoinRequest
 from telegram.ext import ContextTypes
 from telegram.error import TelegramError
-from database import get_db, User
-from config import CHANNEL_ID, WELCOME_MESSAGE, VERIFICATION_MESSAGE
+from user_ingest import upsert_user
+from rate_limiter import get_rate_limiter
+from message_templates import GREETING_MESSAGES
+from config import (
+    CHANNEL_ID,
+    JOIN_APPROVAL_WORKERS, JOIN_GREETING_WORKERS, JOIN_QUEUE_SIZE, JOIN_SHUTDOWN_TIMEOUT
+)
 
 logger = logging.getLogger(__name__)
 
 
-async def send_greeting_message(context: ContextTypes.DEFAULT_TYPE, user_chat_id: int):
+async def send_greeting_message(bot, user_chat_id: int):
     """
     Отправить приветственное сообщение пользователю
     
     Args:
-        context: Контекст бота
+        bot: Бот для отправки сообщений
         user_chat_id: Chat ID пользователя для отправки
     """
+    limiter = get_rate_limiter()
     try:
-        # Отправляем приветственное сообщение
-        await context.bot.send_message(
-            chat_id=user_chat_id,
-            text=WELCOME_MESSAGE,
-            parse_mode='HTML'
-        )
-        
-        # Создаем кнопку "Я человек" для отправки в чат
-        keyboard = [[KeyboardButton("✅ Я человек!")]]
-        reply_markup = ReplyKeyboardMarkup(
-            keyboard,
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
-        
-        # Отправляем сообщение с кнопкой верификации
-        await context.bot.send_message(
-            chat_id=user_chat_id,
-            text=VERIFICATION_MESSAGE,
-            reply_markup=reply_markup
-        )
+        # Приветствие и сообщение с кнопкой верификации (заранее собранные)
+        for payload in GREETING_MESSAGES:
+            await limiter.call(bot.send_message, chat_id=user_chat_id, **payload)
         
         logger.info(f"Приветственное сообщение отправлено пользователю {user_chat_id}")
-        
+    
     except TelegramError as e:
         logger.error(f"Telegram ошибка при отправке приветствия пользователю {user_chat_id}: {e}")
     except Exception as e:
         logger.error(f"Ошибка при отправке приветствия пользователю {user_chat_id}: {e}")
 
 
+async def approve_join_request(bot, join_request: ChatJoinRequest):
+    """
+    Принять заявку и сохранить пользователя в БД
+    
+    Returns:
+        bool: True если заявка принята
+    """
+    user = join_request.from_user
+    user_id = user.id
+    
+    try:
+        # Автоматически принимаем заявку (ограничение на чат не нужно - это не сообщение в канал)
+        await get_rate_limiter().call(
+            bot.approve_chat_join_request,
+            per_chat=False,
+            chat_id=join_request.chat.id,
+            user_id=user_id
+        )
+        logger.info(f"✅ Заявка пользователя {user_id} автоматически принята")
+    except TelegramError as e:
+        logger.error(f"Telegram ошибка при обработке заявки пользователя {user_id}: {e}")
+        return False
+    
+    # Сохраняем пользователя в БД (пакетно вместе с другими заявками)
+    try:
+        await upsert_user(
+            user_id=user_id,
+            chat_id=user_id,  # chat_id для личных сообщений
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name
+        )
+        logger.info(f"Пользователь {user_id} сохранен")
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении пользователя {user_id}: {e}")
+    
+    return True
+
+
+class JoinPipeline:
+    """
+    Конвейер обработки заявок на вступление
+    
+    Обработчик обновления только ставит заявку в очередь и сразу
+    освобождается. Заявки принимают JOIN_APPROVAL_WORKERS параллельных
+    обработчиков через общий ограничитель скорости, а приветствия
+    отправляются отдельной очередью и могут отставать, не задерживая
+    принятие новых заявок.
+    
+    Очередь на принятие ограничена queue_size: когда она заполнена,
+    обработчик обновления ждет места, и новые обновления не забираются
+    быстрее, чем принимаются заявки. Так при падении бота теряется не
+    больше queue_size полученных, но еще не принятых заявок.
+    """
+    
+    def __init__(self, bot, approval_workers: int, greeting_workers: int, queue_size: int = 0):
+        self.bot = bot
+        self.approval_workers = approval_workers
+        self.greeting_workers = greeting_workers
+        self.approvals = asyncio.Queue(maxsize=queue_size)
+        self.greetings = asyncio.Queue()
+        self._workers = []
+        self.reset_stats()
+    
+    def reset_stats(self):
+        """Сбросить накопленную статистику (очереди не меняются)"""
+        self.approved = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+    
+    def start(self):
+        """Запустить обработчиков (в работающем цикле событий)"""
+        if self._workers:
+            return
+        self._workers = (
+            [asyncio.create_task(self._approval_worker()) for _ in range(self.approval_workers)] +
+            [asyncio.create_task(self._greeting_worker()) for _ in range(self.greeting_workers)]
+        )
+    
+    async def submit(self, join_request: ChatJoinRequest):
+        """Поставить заявку в очередь на принятие (ждет, если очередь заполнена)"""
+        self.start()
+        await self.approvals.put((time.monotonic(), join_request))
+    
+    async def _approval_worker(self):
+        while True:
+            received_at, join_request = await self.approvals.get()
+            try:
+                if await approve_join_request(self.bot, join_request):
+                    self._record_latency(time.monotonic() - received_at)
+                    self.greetings.put_nowait(join_request.from_user.id)
+                else:
+                    self.failed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка при обработке заявки пользователя {join_request.from_user.id}: {e}")
+            finally:
+                self.approvals.task_done()
+    
+    async def _greeting_worker(self):
+        while True:
+            user_chat_id = await self.greetings.get()
+            try:
+                await send_greeting_message(self.bot, user_chat_id)
+            finally:
+                self.greetings.task_done()
+    
+    def _record_latency(self, seconds: float):
+        self.approved += 1
+        self.latency_total += seconds
+        self.latency_max = max(self.latency_max, seconds)
+    
+    def stats(self) -> dict:
+        """Глубина очередей и задержка принятия заявок"""
+        return {
+            'approval_queue': self.approvals.qsize(),
+            'greeting_queue': self.greetings.qsize(),
+            'approved': self.approved,
+            'failed': self.failed,
+            'latency_avg_ms': self.latency_total / self.approved * 1000 if self.approved else 0.0,
+            'latency_max_ms': self.latency_max * 1000,
+        }
+    
+    async def stop(self, timeout: float):
+        """
+        Остановить конвейер
+        
+        Уже полученные заявки Telegram повторно не пришлет, поэтому очередь
+        на принятие дорабатывается (не дольше timeout секунд). Неотправленные
+        приветствия отбрасываются.
+        """
+        if not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self.approvals.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не принято заявок при остановке: {self.approvals.qsize()}")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+_pipeline = None
+
+
+def get_join_pipeline(bot) -> JoinPipeline:
+    """Получить общий конвейер заявок"""
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = JoinPipeline(bot, JOIN_APPROVAL_WORKERS, JOIN_GREETING_WORKERS, JOIN_QUEUE_SIZE)
+    return _pipeline
+
+
+def log_join_stats(reset: bool = True):
+    """Записать статистику конвейера заявок в лог"""
+    if _pipeline is None:
+        return
+    logger.info(
+        "Заявки: в очереди на принятие {approval_queue}, на приветствие {greeting_queue}, "
+        "принято {approved}, ошибок {failed}, задержка ср. {latency_avg_ms:.0f} мс / "
+        "макс. {latency_max_ms:.0f} мс".format(**_pipeline.stats())
+    )
+    if reset:
+        _pipeline.reset_stats()
+
+
+async def stop_join_pipeline():
+    """Дообработать принятые заявки при остановке бота"""
+    if _pipeline is not None:
+        await _pipeline.stop(JOIN_SHUTDOWN_TIMEOUT)
+
+
 async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Автоматическое принятие заявок на вступление в канал
     
-    Автоматически принимает все заявки и отправляет приветственное сообщение
+    Заявка ставится в очередь конвейера: принятие и приветствие
+    выполняются в фоне, обработчик обновлений не ждет сети
     """
     join_request: ChatJoinRequest = update.chat_join_request
     user_id = join_request.from_user.id
@@ -68,56 +232,4 @@ async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     logger.info(f"Получена заявка на вступление в канал от пользователя {user_id} (@{user.username})")
-    
-    try:
-        # Автоматически принимаем заявку
-        await context.bot.approve_chat_join_request(
-            chat_id=chat_id,
-            user_id=user_id
-        )
-        logger.info(f"✅ Заявка пользователя {user_id} автоматически принята")
-        
-        # Сохраняем пользователя в БД (если еще не сохранен)
-        db = get_db()
-        try:
-            db_user = db.query(User).filter_by(user_id=user_id).first()
-            
-            if db_user:
-                # Обновляем информацию о пользователе
-                db_user.username = user.username
-                db_user.first_name = user.first_name
-                db_user.last_name = user.last_name
-                db_user.chat_id = user_id  # chat_id для личных сообщений
-                logger.info(f"Обновлена информация о пользователе {user_id}")
-            else:
-                # Создаем нового пользователя (НЕ подписанного)
-                db_user = User(
-                    user_id=user_id,
-                    chat_id=user_id,  # chat_id для личных сообщений
-                    username=user.username,
-                    first_name=user.first_name,
-                    last_name=user.last_name,
-                    subscribed=False,  # Пользователь не подписан до нажатия кнопки "Я человек"
-                    created_at=datetime.utcnow()
-                )
-                db.add(db_user)
-                logger.info(f"Создан новый пользователь {user_id}")
-            
-            db.commit()
-            user_chat_id = db_user.chat_id
-        except Exception as e:
-            db.rollback()
-            logger.error(f"Ошибка при сохранении пользователя {user_id}: {e}")
-            user_chat_id = user_id  # Пробуем отправить по user_id
-        finally:
-            db.close()
-        
-        # Отправляем приветственное сообщение
-        await send_greeting_message(context, user_chat_id)
-        
-    except TelegramError as e:
-        logger.error(f"Telegram ошибка при обработке заявки пользователя {user_id}: {e}")
-    except Exception as e:
-        logger.error(f"Ошибка при обработке заявки пользователя {user_id}: {e}")
-
-
+    await get_join_pipeline(context.bot).submit(join_request)
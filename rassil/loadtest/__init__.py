@@ -0,0 +1,6 @@
+"""
+Нагрузочное тестирование бота без обращения к Telegram
+
+fake_bot_api.py - тестовый сервер Bot API, load_driver.py - генератор
+нагрузки, который запускает бота (main.main) против этого сервера.
+"""
@@ -0,0 +1,370 @@
+"""
+Тестовый сервер Telegram Bot API
+
+Отвечает на запросы бота так же, как Telegram, но ничего никуда не
+отправляет: sendMessage, sendPhoto, approveChatJoinRequest, getUpdates
+(long polling), createChatInviteLink, getChatMember и служебные методы,
+которые бот вызывает при запуске. Настраиваются задержка ответа, доля
+ответов 429 (retry_after), лимит сообщений в секунду (сверх - 429, как у
+Telegram) и пользователи, заблокировавшие бота (403 Forbidden).
+
+Отдельный запуск (из каталога бота):
+
+    python -m loadtest.fake_bot_api --port 8081 --latency-ms 40 --forbidden-every 50
+
+    # бот против тестового сервера
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot BOT_TOKEN=123456:TEST python main.py
+
+    # обновления для бота и статистика вызовов
+    curl -X POST http://127.0.0.1:8081/control/updates -d '[{"message": {...}}]'
+    curl http://127.0.0.1:8081/control/stats
+
+load_driver.py запускает сервер сам, в одном процессе с генератором нагрузки.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+from collections import Counter, deque
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Методы, на которые действуют лимит сообщений и случайные 429
+_LIMITED_METHODS = {'sendMessage', 'sendPhoto', 'approveChatJoinRequest'}
+# Методы, которые отправляют сообщение в чат (403 для заблокировавших бота)
+_MESSAGE_METHODS = {'sendMessage', 'sendPhoto'}
+# Служебные методы, которым достаточно ответа true
+_TRUE_METHODS = {
+    'deleteWebhook', 'setWebhook', 'setMyCommands', 'deleteMyCommands', 'answerCallbackQuery',
+    'declineChatJoinRequest', 'logOut', 'close'
+}
+
+
+class FakeBotApi:
+    """
+    Состояние тестового сервера: очередь обновлений, участники канала, счетчики
+
+    Наблюдатели (observers) вызываются на каждый запрос бота:
+    observer(method, params, error_code), error_code - None для успешного ответа.
+    """
+
+    def __init__(self, bot_id: int = 123456, latency: float = 0.0, jitter: float = 0.0,
+                 retry_after_rate: float = 0.0, retry_after: int = 1, forbidden_every: int = 0,
+                 rate_limit: float = 0.0, seed: int = None):
+        self.bot_user = {'id': bot_id, 'is_bot': True, 'first_name': 'Fake Bot', 'username': 'fake_test_bot'}
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.forbidden_every = forbidden_every
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+
+        self.updates = deque()
+        self.members = set()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.observers = []
+        # Бот начал получать обновления (первый getUpdates)
+        self.polling = asyncio.Event()
+
+        self._next_update_id = 1
+        self._delivered_up_to = 0
+        self._next_message_id = 1
+        self._updates_ready = asyncio.Event()
+        self._sent_window = deque()
+
+    # --- Обновления для бота ---
+
+    def push_update(self, update: dict) -> int:
+        """Поставить обновление в очередь getUpdates; вернуть его update_id"""
+        update = dict(update, update_id=self._next_update_id)
+        self._next_update_id += 1
+        self.updates.append(update)
+        self._updates_ready.set()
+        return update['update_id']
+
+    @staticmethod
+    def user(user_id: int, first_name: str = None, username: str = None) -> dict:
+        """Пользователь Telegram"""
+        return {
+            'id': user_id, 'is_bot': False,
+            'first_name': first_name or f"User{user_id}",
+            'username': username or f"user{user_id}"
+        }
+
+    def message_update(self, user: dict, text: str) -> dict:
+        """Обновление с личным сообщением пользователя (команды размечаются как в Telegram)"""
+        message = {
+            'message_id': self._message_id(),
+            'date': int(time.time()),
+            'chat': {'id': user['id'], 'type': 'private', 'first_name': user['first_name']},
+            'from': user,
+            'text': text
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'message': message}
+
+    @staticmethod
+    def join_request_update(channel_id: int, user: dict) -> dict:
+        """Обновление с заявкой на вступление в канал"""
+        return {
+            'chat_join_request': {
+                'chat': {'id': channel_id, 'type': 'channel', 'title': 'Fake channel'},
+                'from': user,
+                'user_chat_id': user['id'],
+                'date': int(time.time())
+            }
+        }
+
+    # --- Статистика ---
+
+    def stats(self) -> dict:
+        return {
+            'calls': dict(self.calls),
+            'errors': {str(code): count for code, count in self.errors.items()},
+            'pending_updates': len(self.updates),
+            'members': len(self.members)
+        }
+
+    # --- HTTP ---
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        app.router.add_post('/control/updates', self.control_updates)
+        app.router.add_get('/control/stats', self.control_stats)
+        return app
+
+    async def control_updates(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        updates = data if isinstance(data, list) else [data]
+        for update in updates:
+            self.push_update(update)
+        return web.json_response({'queued': len(updates)})
+
+    async def control_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Запрос бота к методу Bot API"""
+        method = request.match_info['method']
+        params = await _request_params(request)
+        self.calls[method] += 1
+
+        if method == 'getUpdates':
+            return _ok(await self._get_updates(params))
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+        error = self._injected_error(method, params)
+        if error is not None:
+            self.errors[error.status] += 1
+            self._notify(method, params, error.status)
+            return error
+
+        try:
+            result = self._result(method, params)
+        except KeyError as e:
+            self.errors[400] += 1
+            self._notify(method, params, 400)
+            return _error(400, f"Bad Request: parameter {e} is required")
+        if result is None:
+            self.errors[404] += 1
+            return _error(404, "Not Found")
+        self._notify(method, params, None)
+        return _ok(result)
+
+    def _notify(self, method: str, params: dict, error_code):
+        for observer in self.observers:
+            observer(method, params, error_code)
+
+    def _injected_error(self, method: str, params: dict):
+        """Ошибка, которую вернул бы Telegram, или None"""
+        if method not in _LIMITED_METHODS:
+            return None
+
+        if method in _MESSAGE_METHODS and self.forbidden_every:
+            if _int(params.get('chat_id')) % self.forbidden_every == 0:
+                return _error(403, "Forbidden: bot was blocked by the user")
+
+        if self.rate_limit:
+            now = time.monotonic()
+            while self._sent_window and self._sent_window[0] <= now - 1.0:
+                self._sent_window.popleft()
+            if len(self._sent_window) >= self.rate_limit:
+                return _retry_after(1)
+            self._sent_window.append(now)
+
+        if self.retry_after_rate and self.random.random() < self.retry_after_rate:
+            return _retry_after(self.retry_after)
+        return None
+
+    async def _get_updates(self, params: dict) -> list:
+        """Long polling: подтвержденные (offset) удаляются, ждем новых не дольше timeout"""
+        self.polling.set()
+        offset = _int(params.get('offset', 0))
+        limit = _int(params.get('limit', 100)) or 100
+        timeout = float(params.get('timeout', 0) or 0)
+
+        while self.updates and self.updates[0]['update_id'] < offset:
+            self.updates.popleft()
+        if not self.updates and timeout > 0:
+            self._updates_ready.clear()
+            try:
+                await asyncio.wait_for(self._updates_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        batch = [update for _, update in zip(range(limit), self.updates)]
+        for update in batch:
+            if update['update_id'] > self._delivered_up_to:
+                self._delivered_up_to = update['update_id']
+                self._notify('getUpdates', update, None)
+        return batch
+
+    def _result(self, method: str, params: dict):
+        """Результат успешного вызова метода (None - метод не поддерживается)"""
+        if method == 'getMe':
+            return dict(self.bot_user, can_join_groups=True, can_read_all_group_messages=False,
+                        supports_inline_queries=False)
+        if method == 'sendMessage':
+            return self._message(params, text=params['text'])
+        if method == 'sendPhoto':
+            photo = params['photo']
+            file_id = photo if isinstance(photo, str) else f"fake-photo-{self._next_message_id}"
+            return self._message(params, caption=params.get('caption'), photo=[
+                {'file_id': file_id, 'file_unique_id': file_id[-16:], 'width': 1280, 'height': 720}
+            ])
+        if method == 'approveChatJoinRequest':
+            self.members.add(_int(params['user_id']))
+            return True
+        if method == 'getChatMember':
+            user_id = _int(params['user_id'])
+            status = 'member' if user_id in self.members else 'left'
+            return {'status': status, 'user': self.user(user_id)}
+        if method == 'createChatInviteLink':
+            return {
+                'invite_link': f"https://t.me/+fake{self._message_id()}",
+                'creator': self.bot_user,
+                'creates_join_request': params.get('creates_join_request') in ('true', True),
+                'is_primary': False,
+                'is_revoked': False
+            }
+        if method == 'getChat':
+            return {'id': _int(params['chat_id']), 'type': 'channel', 'title': 'Fake channel'}
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': len(self.updates)}
+        if method in _TRUE_METHODS:
+            return True
+        return None
+
+    def _message(self, params: dict, **fields) -> dict:
+        chat_id = _int(params['chat_id'])
+        message = {
+            'message_id': self._message_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'channel'},
+            'from': self.bot_user
+        }
+        message.update({key: value for key, value in fields.items() if value is not None})
+        return message
+
+    def _message_id(self) -> int:
+        self._next_message_id += 1
+        return self._next_message_id
+
+
+async def _request_params(request: web.Request) -> dict:
+    """Параметры запроса: JSON или форма (библиотека бота отправляет форму)"""
+    if request.content_type == 'application/json':
+        return await request.json()
+    if request.method == 'GET':
+        return dict(request.query)
+    data = await request.post()
+    return {key: value for key, value in data.items()}
+
+
+def _int(value) -> int:
+    return int(value) if value not in (None, '') else 0
+
+
+def _ok(result) -> web.Response:
+    return web.json_response({'ok': True, 'result': result})
+
+
+def _error(code: int, description: str, parameters: dict = None) -> web.Response:
+    body = {'ok': False, 'error_code': code, 'description': description}
+    if parameters:
+        body['parameters'] = parameters
+    return web.json_response(body, status=code)
+
+
+def _retry_after(seconds: int) -> web.Response:
+    return _error(429, f"Too Many Requests: retry after {seconds}", {'retry_after': seconds})
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    """Параметры тестового сервера в командной строке (общие с load_driver.py)"""
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=30.0, help="Задержка ответа на запрос (мс)")
+    parser.add_argument('--jitter-ms', type=float, default=10.0, help="Случайный разброс задержки (± мс)")
+    parser.add_argument('--retry-after-rate', type=float, default=0.0,
+                        help="Доля отправок, на которые отвечать 429 (0..1)")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429 (сек)")
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help="Сообщений в секунду, сверх которых ответ 429, как у Telegram (0 - без лимита)")
+    parser.add_argument('--forbidden-every', type=int, default=0,
+                        help="Каждый N-й чат (chat_id %% N == 0) заблокировал бота (0 - никто)")
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def server_from_args(args, bot_id: int = 123456) -> FakeBotApi:
+    return FakeBotApi(
+        bot_id=bot_id,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        retry_after_rate=args.retry_after_rate,
+        retry_after=args.retry_after,
+        forbidden_every=args.forbidden_every,
+        rate_limit=args.rate_limit,
+        seed=args.seed
+    )
+
+
+async def start_server(api: FakeBotApi, host: str, port: int) -> web.AppRunner:
+    """Запустить HTTP-сервер в текущем цикле событий"""
+    runner = web.AppRunner(api.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Тестовый Bot API: http://{host}:{port}/bot")
+    return runner
+
+
+async def _serve(args):
+    api = server_from_args(args)
+    runner = await start_server(api, args.host, args.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Тестовый сервер Telegram Bot API")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
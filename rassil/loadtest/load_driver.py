@@ -0,0 +1,284 @@
+"""
+Нагрузочный тест бота против тестового сервера Bot API
+
+Запускает тестовый сервер (fake_bot_api.py) и бота (main.main) отдельным
+процессом с TELEGRAM_API_BASE_URL, указывающим на сервер. Синтетические
+пользователи появляются с заданной частотой, и каждый проходит путь
+настоящего пользователя: заявка на вступление в канал, /start и
+"✅ Я человек!"; следующее обновление пользователя отправляется после
+ответов бота на предыдущее. Затем (--broadcast) бот отправляет рассылку
+всем сохраненным пользователям.
+
+Отчет: обновлений в секунду, задержка обработки (от выдачи обновления
+боту в getUpdates до первого ответа бота, p50/p99) и скорость рассылки.
+
+Бот работает с базой из DATABASE_URL (.env) и сохраняет в нее тестовых
+пользователей - используйте отдельную базу. Запуск из каталога бота:
+
+    python -m loadtest.load_driver --users 2000 --arrival-rate 100 --broadcast
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import time
+from pathlib import Path
+from loadtest.fake_bot_api import FakeBotApi, add_server_arguments, server_from_args, start_server
+
+BOT_DIR = Path(__file__).resolve().parent.parent
+
+VERIFY_TEXT = "✅ Я человек!"
+
+# Шаги пути пользователя: (название, сколько ответов бота ждать)
+# Заявка: принятие и два приветственных сообщения; /start и верификация: по два сообщения
+STEPS = (('join', 3), ('start', 2), ('verify', 2))
+
+
+class Conversation:
+    """Обновление, отправленное боту, и ответы бота на него"""
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.delivered_at = None
+        self.first_response_at = None
+        self.responses = 0
+        self.done = asyncio.Event()
+
+    def respond(self, error_code=None):
+        if self.first_response_at is None:
+            self.first_response_at = time.monotonic()
+        if error_code == 429:
+            # Бот повторит запрос
+            return
+        self.responses += 1
+        # После 403 (бот заблокирован) бот этому пользователю больше не пишет
+        if self.responses >= self.expected or error_code == 403:
+            self.done.set()
+
+    @property
+    def latency(self):
+        if self.delivered_at is None or self.first_response_at is None:
+            return None
+        return self.first_response_at - self.delivered_at
+
+
+class LoadDriver:
+    """Генератор нагрузки: синтетические пользователи и замеры по вызовам тестового сервера"""
+
+    def __init__(self, api: FakeBotApi, channel_id: int, user_id_base: int, step_timeout: float):
+        self.api = api
+        self.channel_id = channel_id
+        self.user_id_base = user_id_base
+        self.step_timeout = step_timeout
+        # update_id -> беседа (до выдачи боту), user_id -> текущая беседа
+        self._by_update = {}
+        self._by_user = {}
+        self.latencies = {name: [] for name, _ in STEPS}
+        self.timeouts = 0
+        self.broadcast_marker = None
+        self.broadcast_times = []
+        api.observers.append(self._observe)
+
+    def _observe(self, method: str, params: dict, error_code):
+        if method == 'getUpdates':
+            conversation = self._by_update.pop(params['update_id'], None)
+            if conversation is not None:
+                conversation.delivered_at = time.monotonic()
+            return
+
+        if method in ('sendMessage', 'sendPhoto'):
+            text = params.get('text') or params.get('caption') or ''
+            if self.broadcast_marker and self.broadcast_marker in text:
+                if error_code is None:
+                    self.broadcast_times.append(time.monotonic())
+                return
+            user_id = int(params.get('chat_id', 0))
+        elif method == 'approveChatJoinRequest':
+            user_id = int(params.get('user_id', 0))
+        else:
+            return
+
+        conversation = self._by_user.get(user_id)
+        if conversation is not None:
+            conversation.respond(error_code)
+
+    async def _step(self, user: dict, name: str, expected: int, update: dict):
+        conversation = Conversation(expected)
+        self._by_user[user['id']] = conversation
+        self._by_update[self.api.push_update(update)] = conversation
+        try:
+            await asyncio.wait_for(conversation.done.wait(), self.step_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+        if conversation.latency is not None:
+            self.latencies[name].append(conversation.latency)
+
+    async def user_flow(self, index: int):
+        """Путь одного пользователя: заявка, /start, верификация"""
+        user = self.api.user(self.user_id_base + index)
+        updates = {
+            'join': self.api.join_request_update(self.channel_id, user),
+            'start': self.api.message_update(user, '/start'),
+            'verify': self.api.message_update(user, VERIFY_TEXT),
+        }
+        for name, expected in STEPS:
+            await self._step(user, name, expected, updates[name])
+        self._by_user.pop(user['id'], None)
+
+    async def run_users(self, users: int, arrival_rate: float) -> float:
+        """Запустить пользователей с частотой arrival_rate в секунду; вернуть длительность"""
+        started_at = time.monotonic()
+        tasks = []
+        for index in range(users):
+            delay = started_at + index / arrival_rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self.user_flow(index)))
+        await asyncio.gather(*tasks)
+        return time.monotonic() - started_at
+
+
+def _percentile(values: list, percent: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def _latency_report(values: list) -> dict:
+    return {
+        'count': len(values),
+        'p50_ms': round(_percentile(values, 50) * 1000, 1) if values else None,
+        'p99_ms': round(_percentile(values, 99) * 1000, 1) if values else None,
+    }
+
+
+async def run_broadcast(driver: LoadDriver, timeout: float) -> dict:
+    """
+    Рассылка всем пользователям через работающего бота
+
+    Рассылка создается в базе сразу в статусе 'sending': бот подхватывает
+    ее периодической проверкой (MAILING_RESUME_INTERVAL), как рассылку,
+    прерванную остановкой.
+    """
+    from datetime import datetime
+    from sqlalchemy import update
+    from database import get_async_db, async_engine, Mailing
+    from mailing_system import create_mailing, get_mailing
+    from recipients import count_recipients
+
+    driver.broadcast_marker = f"[loadtest {int(time.time())}]"
+    expected = await count_recipients()
+    # created_by=0: без уведомления администратору о завершении
+    mailing_id = await create_mailing(f"{driver.broadcast_marker} Привет, {{first_name|друг}}!", created_by=0)
+    async with get_async_db() as db:
+        await db.execute(update(Mailing).where(Mailing.id == mailing_id).values(
+            status='sending', started_at=datetime.utcnow()
+        ))
+        await db.commit()
+
+    deadline = time.monotonic() + timeout
+    status = None
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+        mailing = await get_mailing(mailing_id)
+        status = mailing.status
+        if status == 'sent':
+            break
+    await async_engine.dispose()
+
+    times = driver.broadcast_times
+    elapsed = times[-1] - times[0] if len(times) > 1 else 0.0
+    return {
+        'mailing_id': mailing_id,
+        'status': status,
+        'recipients': expected,
+        'delivered': len(times),
+        'msgs_per_sec': round(len(times) / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def _bot_env(args, base_url: str) -> dict:
+    """Переменные окружения бота под нагрузочным тестом"""
+    return {
+        'BOT_TOKEN': args.bot_token,
+        'TELEGRAM_API_BASE_URL': base_url,
+        'BOT_MODE': 'polling',
+        'CHANNEL_ID': str(args.channel_id),
+        'LOG_LEVEL': args.bot_log_level,
+        'REMINDERS_ENABLED': 'false',
+        'MAILING_RESUME_INTERVAL': '1',
+    }
+
+
+async def run(args) -> dict:
+    bot_id = int(args.bot_token.split(':')[0])
+    base_url = f"http://{args.host}:{args.port}/bot"
+    # Рассылку этот процесс создает с теми же настройками, что у запущенного бота
+    os.environ.update(_bot_env(args, base_url))
+    api = server_from_args(args, bot_id=bot_id)
+    runner = await start_server(api, args.host, args.port)
+
+    bot = await asyncio.create_subprocess_exec(
+        sys.executable, '-c', 'import main; main.main()',
+        cwd=str(BOT_DIR), env=dict(os.environ),
+        # Журнал бота остается в bot.log, в консоли - только отчет
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        await asyncio.wait_for(api.polling.wait(), args.startup_timeout)
+        driver = LoadDriver(api, args.channel_id, args.user_id_base, args.step_timeout)
+
+        duration = await driver.run_users(args.users, args.arrival_rate)
+        updates = sum(len(values) for values in driver.latencies.values())
+        all_latencies = [value for values in driver.latencies.values() for value in values]
+        report = {
+            'users': args.users,
+            'duration_sec': round(duration, 2),
+            'updates': updates,
+            'updates_per_sec': round(updates / duration, 1) if duration else None,
+            'timeouts': driver.timeouts,
+            'handler_latency': _latency_report(all_latencies),
+            'handler_latency_by_step': {name: _latency_report(values) for name, values in driver.latencies.items()},
+        }
+        if args.broadcast:
+            report['broadcast'] = await run_broadcast(driver, args.broadcast_timeout)
+        report['api'] = api.stats()
+        return report
+    finally:
+        if bot.returncode is None:
+            bot.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(bot.wait(), 30)
+            except asyncio.TimeoutError:
+                bot.kill()
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота против тестового сервера Bot API")
+    add_server_arguments(parser)
+    parser.add_argument('--users', type=int, default=500, help="Синтетических пользователей")
+    parser.add_argument('--arrival-rate', type=float, default=50.0, help="Новых пользователей в секунду")
+    parser.add_argument('--user-id-base', type=int, default=7_000_000_000, help="Первый id тестового пользователя")
+    parser.add_argument('--channel-id', type=int, default=-1001234567890)
+    parser.add_argument('--bot-token', default='123456:LOADTEST')
+    parser.add_argument('--bot-log-level', default='WARNING')
+    parser.add_argument('--broadcast', action='store_true', help="После пользователей отправить рассылку")
+    parser.add_argument('--step-timeout', type=float, default=30.0, help="Ожидание ответов бота на обновление (сек)")
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--broadcast-timeout', type=float, default=600.0)
+    parser.add_argument('--json', help="Сохранить отчет в файл")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.json:
+        Path(args.json).write_text(text, encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Диспетчер отложенных рассылок
+"""
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import select, update
+from database import get_async_db, Mailing
+from mailing_system import start_scheduled_mailing
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд повторить запуск, если база была недоступна
+_RETRY_DELAY = 60
+
+
+class MailingDispatcher:
+    """
+    Запуск отложенных рассылок в назначенное время
+
+    Рассылки в статусе 'scheduled' лежат в куче по scheduled_time. Задача
+    спит до ближайшего времени запуска и просыпается раньше, только если
+    запланирована новая рассылка; база не опрашивается. Куча строится
+    одним запросом при запуске бота, поэтому запланированные рассылки
+    переживают перезапуск.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._heap = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def load(self) -> int:
+        """Загрузить запланированные рассылки из базы (индекс по status, scheduled_time)"""
+        async with get_async_db() as db:
+            result = await db.execute(
+                select(Mailing.scheduled_time, Mailing.id)
+                .where(Mailing.status == 'scheduled', Mailing.scheduled_time.is_not(None))
+                .order_by(Mailing.scheduled_time)
+            )
+            # Отсортированный список уже является кучей
+            self._heap = [(row.scheduled_time, row.id) for row in result]
+        self._wakeup.set()
+        return len(self._heap)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def add(self, mailing_id: int, when: datetime):
+        """Добавить рассылку в расписание"""
+        heapq.heappush(self._heap, (when, mailing_id))
+        self._wakeup.set()
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    async def _run(self):
+        while True:
+            # Сбрасываем до проверки кучи: add() после этого места разбудит ожидание
+            self._wakeup.clear()
+            timeout = None
+            if self._heap:
+                timeout = (self._heap[0][0] - datetime.utcnow()).total_seconds()
+                if timeout <= 0:
+                    _, mailing_id = heapq.heappop(self._heap)
+                    await self._dispatch(mailing_id)
+                    continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self, mailing_id: int):
+        try:
+            if await start_scheduled_mailing(self.bot, mailing_id):
+                logger.info(f"Запущена отложенная рассылка {mailing_id}")
+        except Exception as e:
+            logger.error(f"Не удалось запустить отложенную рассылку {mailing_id}: {e}")
+            heapq.heappush(self._heap, (datetime.utcnow() + timedelta(seconds=_RETRY_DELAY), mailing_id))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+_dispatcher = None
+
+
+async def start_mailing_dispatcher(bot) -> int:
+    """
+    Запустить диспетчер при старте бота
+
+    Returns:
+        int: Количество запланированных рассылок
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = MailingDispatcher(bot)
+        count = await _dispatcher.load()
+        _dispatcher.start()
+        return count
+    return _dispatcher.pending()
+
+
+async def stop_mailing_dispatcher():
+    """Остановить диспетчер (рассылки остаются запланированными в базе)"""
+    global _dispatcher
+    if _dispatcher is not None:
+        await _dispatcher.stop()
+        _dispatcher = None
+
+
+async def schedule_mailing(mailing_id: int, when: datetime) -> bool:
+    """
+    Запланировать рассылку
+
+    Args:
+        mailing_id: ID рассылки
+        when: Время запуска (UTC, без часового пояса, как и остальные даты в базе)
+
+    Returns:
+        bool: True если рассылка запланирована
+    """
+    async with get_async_db() as db:
+        result = await db.execute(
+            update(Mailing).where(
+                Mailing.id == mailing_id,
+                Mailing.status.not_in(['sending', 'sent'])
+            ).values(status='scheduled', scheduled_time=when)
+        )
+        await db.commit()
+    if result.rowcount == 0:
+        return False
+
+    if _dispatcher is not None:
+        _dispatcher.add(mailing_id, when)
+    logger.info(f"Рассылка {mailing_id} запланирована на {when:%d.%m.%Y %H:%M} UTC")
+    return True
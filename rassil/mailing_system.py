@@ -3,11 +3,21 @@
 """
 import logging
 import asyncio
+import os
+import socket
+import time
+from collections import defaultdict
+from sqlalchemy import select, insert, update, delete, func, and_, or_
 from telegram import InputMediaPhoto
 from telegram.ext import ContextTypes
-from telegram.error import TelegramError
-from database import get_db, User, Mailing
-from datetime import datetime
+from telegram.error import TelegramError, BadRequest
+from database import get_async_db, upsert_insert, User, Mailing, MailingDelivery, MailingChunk
+from config import MAILING_CONCURRENCY, MAILING_PROGRESS_EVERY, MAILING_CHUNK_SIZE, MAILING_CHUNK_LEASE
+from rate_limiter import get_rate_limiter
+from recipients import stream_recipients, count_recipients
+from reachability import REACHABLE, PERMANENT_FAILURES, classify_send_error
+from message_templates import compile_template, MessageTemplate
+from datetime import datetime, timedelta
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
@@ -15,6 +25,95 @@ logger = logging.getLogger(__name__)
 # Глобальный флаг активной рассылки (для предотвращения блокировки)
 _active_mailings = set()
 
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_background_tasks = set()
+
+
+class ChunkLeaseLost(Exception):
+    """Захват куска рассылки истек, и кусок передан другому процессу"""
+
+
+async def _save_photo_file_id(mailing_id: int, file_id: str):
+    """Сохранить file_id загруженного фото рассылки"""
+    try:
+        async with get_async_db() as db:
+            await db.execute(update(Mailing).where(Mailing.id == mailing_id).values(photo_file_id=file_id))
+            await db.commit()
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить file_id фото рассылки {mailing_id}: {e}")
+
+
+def _is_stale_file_id_error(error: BadRequest) -> bool:
+    """Ошибка означает, что Telegram больше не принимает этот file_id"""
+    message = str(error).lower()
+    return 'file' in message and ('identifier' in message or 'reference' in message)
+
+
+class _MailingPhoto:
+    """
+    Фото рассылки
+
+    Файл загружается в Telegram один раз, все остальные копии отправляются
+    по file_id. Если file_id устарел, файл загружается повторно (один раз).
+    """
+
+    def __init__(self, mailing_id: int, image_path: str = None, file_id: str = None):
+        self.mailing_id = mailing_id
+        self.image_path = image_path
+        self.file_id = file_id
+        self._reuploaded = False
+        self._lock = asyncio.Lock()
+
+    async def _send(self, bot, chat_id: int, photo, caption: str):
+        return await get_rate_limiter().call(
+            bot.send_photo,
+            chat_id=chat_id,
+            photo=photo,
+            caption=caption,
+            parse_mode='HTML'
+        )
+
+    async def send(self, bot, chat_id: int, caption: str):
+        """Отправить фото с подписью в чат"""
+        file_id = self.file_id
+        stale_error = None
+        if file_id:
+            try:
+                return await self._send(bot, chat_id, file_id, caption)
+            except BadRequest as e:
+                if not _is_stale_file_id_error(e):
+                    raise
+                logger.warning(f"file_id фото рассылки {self.mailing_id} больше не действителен: {e}")
+                stale_error = e
+
+        async with self._lock:
+            # Пока ждали блокировку, фото мог загрузить другой отправитель
+            if self.file_id and self.file_id != file_id:
+                return await self._send(bot, chat_id, self.file_id, caption)
+
+            if stale_error and self._reuploaded:
+                raise stale_error
+
+            if not self.image_path or not Path(self.image_path).exists():
+                raise stale_error or FileNotFoundError(f"Изображение рассылки не найдено: {self.image_path}")
+
+            photo_bytes = await asyncio.to_thread(Path(self.image_path).read_bytes)
+            message = await self._send(bot, chat_id, photo_bytes, caption)
+
+            if stale_error:
+                self._reuploaded = True
+            self.file_id = message.photo[-1].file_id
+            await _save_photo_file_id(self.mailing_id, self.file_id)
+            logger.info(f"Фото рассылки {self.mailing_id} загружено в Telegram, далее отправка по file_id")
+            return message
+
+
+def _mailing_photo(mailing: Mailing):
+    """Фото рассылки или None, если рассылка без изображения"""
+    if mailing.photo_file_id or (mailing.image_path and Path(mailing.image_path).exists()):
+        return _MailingPhoto(mailing.id, mailing.image_path, mailing.photo_file_id)
+    return None
+
 
 async def send_test_mailing(context: ContextTypes.DEFAULT_TYPE, mailing_id: int, admin_id: int):
     """
@@ -28,36 +127,44 @@ async def send_test_mailing(context: ContextTypes.DEFAULT_TYPE, mailing_id: int,
     Returns:
         tuple: (success: bool, message: str)
     """
-    db = get_db()
     try:
         # Получаем рассылку
-        mailing = db.query(Mailing).filter_by(id=mailing_id).first()
+        async with get_async_db() as db:
+            mailing = await db.get(Mailing, mailing_id)
         
         if not mailing:
             return False, "❌ Рассылка не найдена"
         
+        # Подстановки заполняются данными администратора, если он есть среди пользователей
+        template = compile_template(mailing.message_text)
+        recipient = None
+        if template.personalized:
+            async with get_async_db() as db:
+                result = await db.execute(
+                    select(*(getattr(User, name) for name in template.columns)).where(User.user_id == admin_id)
+                )
+                row = result.first()
+            recipient = dict(row._mapping) if row else None
+        message_text = template.render(recipient)
+        
         # Отправляем сообщение администратору
         try:
-            if mailing.image_path and Path(mailing.image_path).exists():
-                # Отправка с изображением
-                with open(mailing.image_path, 'rb') as photo:
-                    await context.bot.send_photo(
-                        chat_id=admin_id,
-                        photo=photo,
-                        caption=mailing.message_text,
-                        parse_mode='HTML'
-                    )
+            photo = _mailing_photo(mailing)
+            if photo:
+                # Отправка с изображением (заодно получаем file_id для основной рассылки)
+                await photo.send(context.bot, admin_id, message_text)
             else:
                 # Отправка только текста
                 await context.bot.send_message(
                     chat_id=admin_id,
-                    text=mailing.message_text,
+                    text=message_text,
                     parse_mode='HTML'
                 )
             
             # Обновляем статус
-            mailing.status = 'test_sent'
-            db.commit()
+            async with get_async_db() as db:
+                await db.execute(update(Mailing).where(Mailing.id == mailing_id).values(status='test_sent'))
+                await db.commit()
             
             logger.info(f"Тестовая рассылка {mailing_id} отправлена администратору {admin_id}")
             return True, "✅ Тестовое сообщение отправлено вам в личные сообщения!"
@@ -67,141 +174,534 @@ async def send_test_mailing(context: ContextTypes.DEFAULT_TYPE, mailing_id: int,
             return False, f"❌ Ошибка отправки: {str(e)}"
             
     except Exception as e:
-        db.rollback()
         logger.error(f"Ошибка при обработке тестовой рассылки: {e}")
         return False, "❌ Произошла ошибка"
+
+
+async def _save_mailing_progress(mailing_id: int, chunk_id: int, worker: str,
+                                 deliveries: list, unreachable: dict) -> int:
+    """
+    Сохранить результаты доставки одной транзакцией
+    
+    Счетчики рассылки увеличиваются, а не перезаписываются: в рассылке
+    могут одновременно участвовать несколько процессов. Считаются только
+    впервые записанные доставки: получателя, которому рассылку уже
+    доставил другой процесс, вставка пропускает. Заодно продлевается
+    захват куска этим процессом.
+    
+    Args:
+        unreachable: {состояние доступности: [users.id]} для недоступных чатов
+    
+    Returns:
+        int: Количество пользователей, впервые помеченных недоступными
+    
+    Raises:
+        ChunkLeaseLost: кусок захвачен другим процессом (результаты при этом сохранены)
+    """
+    now = datetime.utcnow()
+    sent_ids = [delivery['recipient_id'] for delivery in deliveries if delivery['status'] == 'sent']
+    
+    async with get_async_db() as db:
+        sent_count = failed_count = 0
+        if deliveries:
+            result = await db.execute(
+                upsert_insert(MailingDelivery).values(deliveries).on_conflict_do_nothing(
+                    index_elements=[MailingDelivery.mailing_id, MailingDelivery.recipient_id]
+                ).returning(MailingDelivery.status)
+            )
+            for status in result.scalars():
+                if status == 'sent':
+                    sent_count += 1
+                else:
+                    failed_count += 1
+        
+        # Для сегмента "без рассылок последние N дней"
+        if sent_ids:
+            await db.execute(
+                update(User).where(User.id.in_(sent_ids)).values(last_messaged_at=now),
+                execution_options={'synchronize_session': False}
+            )
+        
+        newly_pruned = 0
+        for state, recipient_ids in unreachable.items():
+            result = await db.execute(
+                update(User).where(
+                    User.id.in_(recipient_ids),
+                    User.reachability == REACHABLE
+                ).values(
+                    reachability=state,
+                    unreachable_since=now
+                ),
+                execution_options={'synchronize_session': False}
+            )
+            newly_pruned += result.rowcount
+        
+        await db.execute(
+            update(Mailing).where(Mailing.id == mailing_id).values(
+                sent_count=func.coalesce(Mailing.sent_count, 0) + sent_count,
+                failed_count=func.coalesce(Mailing.failed_count, 0) + failed_count,
+                pruned_count=func.coalesce(Mailing.pruned_count, 0) + newly_pruned
+            ),
+            execution_options={'synchronize_session': False}
+        )
+        lease = await db.execute(
+            update(MailingChunk).where(MailingChunk.id == chunk_id, MailingChunk.claimed_by == worker).values(claimed_at=now),
+            execution_options={'synchronize_session': False}
+        )
+        # Результаты сохраняются и без захвата: эти сообщения уже отправлены
+        await db.commit()
+    
+    if lease.rowcount == 0:
+        raise ChunkLeaseLost(chunk_id)
+    return newly_pruned
+
+
+async def _load_delivered(mailing_id: int, first_id: int, last_id: int) -> set:
+    """
+    id получателей куска, которым рассылка уже доставлена
+
+    Кусок мог частично обработать процесс, который остановился
+    или потерял захват куска.
+    """
+    async with get_async_db() as db:
+        result = await db.execute(
+            select(MailingDelivery.recipient_id).where(
+                MailingDelivery.mailing_id == mailing_id,
+                MailingDelivery.recipient_id.between(first_id, last_id)
+            )
+        )
+        return set(result.scalars())
+
+
+def _segment(mailing: Mailing) -> dict:
+    """
+    Аудитория рассылки для stream_recipients / count_recipients
+
+    Относительные сроки сегмента отсчитываются от начала отправки
+    (started_at задается один раз, при переходе в 'sending'), поэтому
+    отложенная рассылка уходит аудитории на момент отправки, а при
+    продолжении аудитория не меняется.
+    """
+    return {'audience': mailing.audience, 'now': mailing.started_at or mailing.created_at}
+
+
+def _worker_name() -> str:
+    """Имя процесса рассылки (в mailing_chunks.claimed_by)"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def _plan_mailing(mailing_id: int, segment: dict) -> bool:
+    """
+    Разбить получателей рассылки на куски по MAILING_CHUNK_SIZE
+    
+    Выполняется один раз на рассылку: строка рассылки блокируется, и если
+    куски уже есть (рассылка продолжается), ничего не делается. В куске
+    хранятся только границы диапазона users.id, сами получатели читаются
+    при обработке куска.
+    
+    Returns:
+        bool: True если куски созданы этим вызовом
+    """
+    async with get_async_db() as db:
+        await db.execute(select(Mailing.id).where(Mailing.id == mailing_id).with_for_update())
+        planned = await db.execute(select(MailingChunk.id).where(MailingChunk.mailing_id == mailing_id).limit(1))
+        if planned.first() is not None:
+            return False
+        
+        chunks = []
+        total_count = 0
+        first_id = None
+        async for recipient in stream_recipients(page_size=MAILING_CHUNK_SIZE, **segment):
+            total_count += 1
+            if first_id is None:
+                first_id = recipient['id']
+            if total_count % MAILING_CHUNK_SIZE == 0:
+                chunks.append({'mailing_id': mailing_id, 'first_recipient_id': first_id,
+                               'last_recipient_id': recipient['id'], 'status': 'pending'})
+                first_id = None
+        if first_id is not None:
+            chunks.append({'mailing_id': mailing_id, 'first_recipient_id': first_id,
+                           'last_recipient_id': recipient['id'], 'status': 'pending'})
+        
+        if chunks:
+            await db.execute(insert(MailingChunk), chunks)
+        await db.execute(
+            update(Mailing).where(Mailing.id == mailing_id).values(
+                total_count=total_count,
+                # Рассылка могла перейти в 'sending' без отметки времени (до появления started_at)
+                started_at=func.coalesce(Mailing.started_at, datetime.utcnow())
+            )
+        )
+        await db.commit()
+    
+    logger.info(f"Рассылка {mailing_id}: {total_count} получателей, кусков {len(chunks)}")
+    return True
+
+
+async def _claim_chunk(mailing_id: int, worker: str):
+    """
+    Захватить свободный кусок рассылки
+    
+    SELECT ... FOR UPDATE SKIP LOCKED: процессы не ждут друг друга и не
+    получают один и тот же кусок. Кусок, захват которого не продлевался
+    дольше MAILING_CHUNK_LEASE (процесс упал), считается свободным.
+    
+    Returns:
+        tuple: (id, first_recipient_id, last_recipient_id) или None
+    """
+    now = datetime.utcnow()
+    claimable = or_(
+        MailingChunk.status == 'pending',
+        and_(
+            MailingChunk.status == 'claimed',
+            MailingChunk.claimed_at < now - timedelta(seconds=MAILING_CHUNK_LEASE)
+        )
+    )
+    async with get_async_db() as db:
+        while True:
+            result = await db.execute(
+                select(MailingChunk.id, MailingChunk.first_recipient_id, MailingChunk.last_recipient_id).where(
+                    MailingChunk.mailing_id == mailing_id,
+                    claimable
+                ).order_by(MailingChunk.id).limit(1).with_for_update(skip_locked=True)
+            )
+            chunk = result.first()
+            if chunk is None:
+                return None
+            # Условие повторяется в UPDATE: без блокировки строк (SQLite) кусок мог захватить другой процесс
+            result = await db.execute(
+                update(MailingChunk).where(MailingChunk.id == chunk.id, claimable).values(
+                    status='claimed', claimed_by=worker, claimed_at=now
+                )
+            )
+            await db.commit()
+            if result.rowcount == 1:
+                return tuple(chunk)
+
+
+async def _finish_chunk(chunk_id: int, worker: str, status: str = 'done'):
+    """Отметить кусок обработанным ('done') или вернуть его в очередь ('pending')"""
+    async with get_async_db() as db:
+        result = await db.execute(
+            update(MailingChunk).where(MailingChunk.id == chunk_id, MailingChunk.claimed_by == worker).values(
+                status=status,
+                claimed_by=worker if status == 'done' else None
+            )
+        )
+        await db.commit()
+    if result.rowcount == 0:
+        logger.warning(f"Кусок рассылки {chunk_id} был передан другому процессу (захват истек)")
+
+
+async def _complete_mailing(mailing_id: int) -> bool:
+    """
+    Завершить рассылку, если все куски обработаны
+    
+    Условный UPDATE: рассылку завершает (и уведомляет администратора)
+    ровно один процесс - тот, кто обработал последний кусок.
+    """
+    unfinished = select(MailingChunk.id).where(MailingChunk.mailing_id == mailing_id, MailingChunk.status != 'done')
+    async with get_async_db() as db:
+        result = await db.execute(
+            update(Mailing).where(
+                Mailing.id == mailing_id,
+                Mailing.status == 'sending',
+                ~unfinished.exists()
+            ).values(status='sent')
+        )
+        await db.commit()
+    return result.rowcount == 1
+
+
+class _MailingProgress:
+    """
+    Результаты отправки куска получателей
+
+    Результаты копятся в буфере и сохраняются пачкой; сохранение заодно
+    продлевает захват куска, поэтому сохраняется и по времени, если
+    отправка идет медленно.
+    """
+
+    def __init__(self, mailing_id: int, chunk_id: int, worker: str):
+        self.mailing_id = mailing_id
+        self.chunk_id = chunk_id
+        self.worker = worker
+        self.sent_count = 0
+        self.failed_count = 0
+        self.pruned_count = 0
+        # Получатели без результата отправки: кусок нужно обработать еще раз
+        self.retry_count = 0
+        # Кусок передан другому процессу: отправку нужно прекратить
+        self.lease_lost = False
+        self._buffer = []
+        self._unreachable = defaultdict(list)
+        self._flushed_at = time.monotonic()
+        self._flush_lock = asyncio.Lock()
+
+    def record(self, recipient: dict, error: Exception = None):
+        """Записать результат отправки одному получателю"""
+        if error is None:
+            status = 'sent'
+            self.sent_count += 1
+        else:
+            status = classify_send_error(error)
+            self.failed_count += 1
+            if status in PERMANENT_FAILURES:
+                self._unreachable[status].append(recipient['id'])
+            else:
+                status = 'failed'
+
+        self._buffer.append({
+            'mailing_id': self.mailing_id,
+            'recipient_id': recipient['id'],
+            'user_id': recipient['user_id'],
+            'status': status,
+            'error': str(error)[:255] if error is not None else None,
+            'created_at': datetime.utcnow()
+        })
+
+    @property
+    def unsaved(self) -> bool:
+        """Есть результаты, которые не удалось сохранить"""
+        return bool(self._buffer) or any(self._unreachable.values())
+
+    @property
+    def should_flush(self) -> bool:
+        return (
+            len(self._buffer) >= MAILING_PROGRESS_EVERY
+            or (self._buffer and time.monotonic() - self._flushed_at > MAILING_CHUNK_LEASE / 4)
+        )
+
+    async def flush(self):
+        """Сохранить накопленные результаты"""
+        async with self._flush_lock:
+            deliveries, self._buffer = self._buffer, []
+            unreachable, self._unreachable = self._unreachable, defaultdict(list)
+            self._flushed_at = time.monotonic()
+            try:
+                self.pruned_count += await _save_mailing_progress(
+                    self.mailing_id, self.chunk_id, self.worker, deliveries, unreachable
+                )
+            except ChunkLeaseLost:
+                # Результаты сохранены; отправку куска прекращает _dispatch_mailing
+                self.lease_lost = True
+            except Exception as e:
+                self._buffer[:0] = deliveries
+                for state, recipient_ids in unreachable.items():
+                    self._unreachable[state].extend(recipient_ids)
+                logger.warning(f"Не удалось сохранить прогресс рассылки {self.mailing_id}: {e}")
+
+
+async def _dispatch_mailing(bot, recipients, template: MessageTemplate, progress: _MailingProgress,
+                            photo: _MailingPhoto = None, skip_ids: set = frozenset()):
+    """
+    Параллельная отправка рассылки пулом отправителей
+
+    Все отправители берут получателей из общей очереди и проходят через
+    общий ограничитель скорости, поэтому медленный ответ Telegram для
+    одного чата не останавливает остальных. Получатели читаются из
+    асинхронного генератора по мере отправки, текст для каждого
+    получателя заполняется по шаблону.
+    """
+    limiter = get_rate_limiter()
+    queue = asyncio.Queue(maxsize=MAILING_CONCURRENCY * 2)
+    now = datetime.utcnow()
+
+    async def send_one(user_data: dict):
+        message_text = template.render(user_data, now)
+        if photo is not None:
+            await photo.send(bot, user_data['chat_id'], message_text)
+        else:
+            await limiter.call(
+                bot.send_message,
+                chat_id=user_data['chat_id'],
+                text=message_text,
+                parse_mode='HTML'
+            )
+
+    async def worker():
+        while True:
+            user_data = await queue.get()
+            try:
+                if user_data is None:
+                    return
+                await send_one(user_data)
+                progress.record(user_data)
+
+            except TelegramError as e:
+                progress.record(user_data, e)
+                logger.warning(f"Не удалось отправить сообщение пользователю {user_data['user_id']}: {e}")
+            except Exception as e:
+                # Не ответ Telegram (например, бот уже останавливается): получатель остается
+                # без записи о доставке и получит рассылку при продолжении
+                progress.retry_count += 1
+                logger.error(f"Ошибка при отправке сообщения пользователю {user_data['user_id']}: {e}")
+            finally:
+                queue.task_done()
+
+            # Периодически сохраняем прогресс
+            if progress.should_flush:
+                await progress.flush()
+            if progress.lease_lost:
+                raise ChunkLeaseLost(progress.chunk_id)
+
+    async def produce():
+        async for user_data in recipients:
+            if user_data['id'] in skip_ids:
+                continue
+            await queue.put(user_data)
+        for _ in range(MAILING_CONCURRENCY):
+            await queue.put(None)
+
+    # Ошибка любого отправителя (потеря захвата куска) сразу останавливает и чтение получателей
+    tasks = [asyncio.create_task(produce())] + [asyncio.create_task(worker()) for _ in range(MAILING_CONCURRENCY)]
+    try:
+        await asyncio.gather(*tasks)
     finally:
-        db.close()
+        for task in tasks:
+            task.cancel()
+        # Сохраняем результаты и при остановке бота посреди рассылки
+        await progress.flush()
 
 
-async def _background_mass_mailing(context: ContextTypes.DEFAULT_TYPE, mailing_id: int, admin_id: int = None):
+async def _work_mailing(bot, mailing: Mailing) -> int:
+    """
+    Обработать куски рассылки, пока есть свободные
+    
+    Returns:
+        int: Количество обработанных этим процессом кусков
+    """
+    worker = _worker_name()
+    segment = _segment(mailing)
+    photo = _mailing_photo(mailing)
+    # Шаблон разбирается один раз на рассылку; из базы читаются только нужные ему колонки
+    template = compile_template(mailing.message_text)
+    chunks_done = 0
+    
+    while True:
+        chunk = await _claim_chunk(mailing.id, worker)
+        if chunk is None:
+            return chunks_done
+        chunk_id, first_id, last_id = chunk
+        
+        progress = _MailingProgress(mailing.id, chunk_id, worker)
+        try:
+            skip_ids = await _load_delivered(mailing.id, first_id, last_id)
+            recipients = stream_recipients(after_id=first_id - 1, until_id=last_id, columns=template.columns, **segment)
+            await _dispatch_mailing(bot, recipients, template, progress, photo, skip_ids)
+            if progress.lease_lost:
+                raise ChunkLeaseLost(chunk_id)
+            if progress.unsaved:
+                raise RuntimeError("результаты отправки не сохранены")
+            if progress.retry_count:
+                raise RuntimeError(f"не отправлено из-за ошибок: {progress.retry_count}, кусок будет обработан повторно")
+        except ChunkLeaseLost:
+            # Оставшихся получателей куска обрабатывает процесс, захвативший его
+            logger.warning(
+                f"Рассылка {mailing.id}: захват куска {chunk_id} истек, кусок передан другому процессу"
+            )
+            continue
+        except BaseException:
+            # Кусок сразу возвращается в очередь (а не по истечении захвата)
+            try:
+                await asyncio.shield(_finish_chunk(chunk_id, worker, 'pending'))
+            except Exception as e:
+                logger.error(f"Не удалось вернуть кусок {chunk_id} рассылки {mailing.id}: {e}")
+            raise
+        
+        await _finish_chunk(chunk_id, worker)
+        chunks_done += 1
+        logger.info(
+            f"Рассылка {mailing.id}: кусок {chunk_id} обработан, отправлено {progress.sent_count}, "
+            f"ошибок {progress.failed_count}, уже было доставлено {len(skip_ids)}"
+        )
+
+
+async def _notify_mailing_finished(bot, mailing_id: int, admin_id: int = None):
+    """Записать итоги завершенной рассылки в лог и уведомить администратора"""
+    async with get_async_db() as db:
+        mailing = await db.get(Mailing, mailing_id)
+    
+    sent_count = mailing.sent_count or 0
+    failed_count = mailing.failed_count or 0
+    pruned_count = mailing.pruned_count or 0
+    total_count = mailing.total_count or 0
+    elapsed = (datetime.utcnow() - mailing.started_at).total_seconds() if mailing.started_at else 0.0
+    throughput = sent_count / elapsed if elapsed > 0 else 0.0
+    
+    logger.info(
+        f"Массовая рассылка {mailing_id} завершена: отправлено {sent_count} из {total_count}, "
+        f"ошибок {failed_count}, исключено недоступных чатов {pruned_count}; "
+        f"за {elapsed:.1f} сек, {throughput:.1f} сообщ./сек"
+    )
+    
+    # Отправляем уведомление администратору о завершении
+    if admin_id:
+        try:
+            await bot.send_message(
+                chat_id=admin_id,
+                text=f"✅ <b>Рассылка завершена!</b>\n\n"
+                     f"Отправлено: <b>{sent_count}</b> из <b>{total_count}</b> пользователей\n"
+                     f"Ошибок: <b>{failed_count}</b>\n"
+                     f"Недоступных чатов исключено: <b>{pruned_count}</b>\n"
+                     f"Время: <b>{elapsed:.0f}</b> сек\n"
+                     f"Скорость: <b>{throughput:.1f}</b> сообщ./сек",
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+
+
+async def _background_mass_mailing(bot, mailing_id: int, admin_id: int = None):
     """
     Фоновая массовая рассылка (не блокирует бота)
     
+    Получатели разбиваются на куски (один раз на рассылку), и процесс
+    обрабатывает свободные куски, пока они есть. Так же работают
+    дополнительные процессы рассылки (mailing_worker.py): каждый кусок
+    обрабатывает один процесс, а уже доставленные получатели пропускаются,
+    поэтому после перезапуска рассылка продолжается без повторов.
+    
     Args:
-        context: Контекст бота
+        bot: Бот для отправки сообщений
         mailing_id: ID рассылки
         admin_id: ID администратора для уведомления о завершении
     """
     global _active_mailings
     _active_mailings.add(mailing_id)
     
-    db = get_db()
     try:
         # Получаем рассылку
-        mailing = db.query(Mailing).filter_by(id=mailing_id).first()
+        async with get_async_db() as db:
+            mailing = await db.get(Mailing, mailing_id)
         
         if not mailing:
             logger.error(f"Рассылка {mailing_id} не найдена")
             return
         
-        # Получаем всех пользователей и извлекаем нужные данные
-        users = db.query(User).all()
-        total_count = len(users)
-        
-        # ВАЖНО: Извлекаем данные пользователей перед закрытием сессии
-        users_data = [
-            {
-                'user_id': user.user_id,
-                'chat_id': user.chat_id
-            }
-            for user in users
-        ]
-        
-        # Сохраняем путь к изображению и текст сообщения
-        image_path = mailing.image_path
-        message_text = mailing.message_text
-        
-        # Обновляем статус
-        mailing.status = 'sending'
-        mailing.total_count = total_count
-        db.commit()
-        db.close()  # Теперь безопасно закрываем соединение
-        
-        logger.info(f"Начата массовая рассылка {mailing_id} для {total_count} пользователей (в фоне)")
-        
-        sent_count = 0
-        
-        # Отправляем сообщения
-        for user_data in users_data:
-            try:
-                if image_path and Path(image_path).exists():
-                    # Отправка с изображением
-                    with open(image_path, 'rb') as photo:
-                        await context.bot.send_photo(
-                            chat_id=user_data['chat_id'],
-                            photo=photo,
-                            caption=message_text,
-                            parse_mode='HTML'
-                        )
-                else:
-                    # Отправка только текста
-                    await context.bot.send_message(
-                        chat_id=user_data['chat_id'],
-                        text=message_text,
-                        parse_mode='HTML'
-                    )
-                
-                sent_count += 1
-                
-                # Обновляем счетчик каждые 10 сообщений
-                if sent_count % 10 == 0:
-                    db = get_db()
-                    mailing_update = db.query(Mailing).filter_by(id=mailing_id).first()
-                    if mailing_update:
-                        mailing_update.sent_count = sent_count
-                        db.commit()
-                    db.close()
-                
-                # Небольшая задержка для избежания лимитов
-                await asyncio.sleep(0.05)
-                
-            except TelegramError as e:
-                logger.warning(f"Не удалось отправить сообщение пользователю {user_data['user_id']}: {e}")
-                continue
-            except Exception as e:
-                logger.error(f"Ошибка при отправке сообщения пользователю {user_data['user_id']}: {e}")
-                continue
-        
-        # Обновляем финальный статус
-        db = get_db()
-        mailing_final = db.query(Mailing).filter_by(id=mailing_id).first()
-        if mailing_final:
-            mailing_final.status = 'sent'
-            mailing_final.sent_count = sent_count
-            db.commit()
-        db.close()
+        if await _plan_mailing(mailing_id, _segment(mailing)):
+            logger.info(f"Начата массовая рассылка {mailing_id} (в фоне)")
+        else:
+            logger.info(f"Продолжение рассылки {mailing_id}")
         
-        logger.info(f"Массовая рассылка {mailing_id} завершена: отправлено {sent_count} из {total_count}")
+        chunks_done = await _work_mailing(bot, mailing)
         
-        # Отправляем уведомление администратору о завершении
-        if admin_id:
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=f"✅ <b>Рассылка завершена!</b>\n\n"
-                         f"Отправлено: <b>{sent_count}</b> из <b>{total_count}</b> пользователей",
-                    parse_mode='HTML'
-                )
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+        if await _complete_mailing(mailing_id):
+            await _notify_mailing_finished(bot, mailing_id, admin_id)
+        elif chunks_done:
+            logger.info(f"Рассылка {mailing_id}: оставшиеся куски обрабатывают другие процессы")
         
     except Exception as e:
-        logger.error(f"Ошибка при массовой рассылке: {e}")
-        db = get_db()
-        mailing_error = db.query(Mailing).filter_by(id=mailing_id).first()
-        if mailing_error:
-            mailing_error.status = 'draft'
-            db.commit()
-        db.close()
+        # Статус остается 'sending': незавершенные куски продолжит этот или другой процесс
+        logger.error(f"Ошибка при массовой рассылке {mailing_id}: {e}")
         
         # Уведомляем админа об ошибке
         if admin_id:
             try:
-                await context.bot.send_message(
+                await bot.send_message(
                     chat_id=admin_id,
                     text=f"❌ <b>Ошибка при рассылке!</b>\n\n"
-                         f"Рассылка #{mailing_id} не завершена из-за ошибки.",
+                         f"Рассылка #{mailing_id} прервана из-за ошибки и будет продолжена автоматически.",
                     parse_mode='HTML'
                 )
             except Exception as notify_error:
@@ -210,6 +710,13 @@ async def _background_mass_mailing(context: ContextTypes.DEFAULT_TYPE, mailing_i
         _active_mailings.discard(mailing_id)
 
 
+def _start_background_mailing(bot, mailing_id: int, admin_id: int = None):
+    """Запустить рассылку фоновой задачей"""
+    task = asyncio.create_task(_background_mass_mailing(bot, mailing_id, admin_id))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
 async def send_mass_mailing(context: ContextTypes.DEFAULT_TYPE, mailing_id: int, admin_id: int = None):
     """
     Запуск массовой рассылки в фоновом режиме (не блокирует бота)
@@ -229,20 +736,40 @@ async def send_mass_mailing(context: ContextTypes.DEFAULT_TYPE, mailing_id: int,
         logger.warning(f"Рассылка {mailing_id} уже выполняется")
         return False, 0, 0
     
-    db = get_db()
     try:
         # Получаем рассылку
-        mailing = db.query(Mailing).filter_by(id=mailing_id).first()
+        async with get_async_db() as db:
+            mailing = await db.get(Mailing, mailing_id)
         
         if not mailing:
             logger.error(f"Рассылка {mailing_id} не найдена")
             return False, 0, 0
         
-        # Получаем количество пользователей
-        total_count = db.query(User).count()
+        # Повторный запуск завершенной рассылки отправил бы ее всем еще раз
+        if mailing.status == 'sent':
+            logger.warning(f"Рассылка {mailing_id} уже отправлена")
+            return False, mailing.sent_count or 0, mailing.total_count or 0
+        
+        # Рассылку запускает только один вызов, в том числе в другом экземпляре бота
+        started_at = datetime.utcnow()
+        async with get_async_db() as db:
+            result = await db.execute(
+                update(Mailing).where(
+                    Mailing.id == mailing_id,
+                    Mailing.status.not_in(['sending', 'sent'])
+                ).values(status='sending', started_at=started_at)
+            )
+            await db.commit()
+        if result.rowcount == 0:
+            logger.warning(f"Рассылка {mailing_id} уже выполняется")
+            return False, 0, 0
+        
+        # Получаем количество пользователей (аудитория на момент начала отправки)
+        mailing.started_at = started_at
+        total_count = await count_recipients(**_segment(mailing))
         
         # Запускаем рассылку в фоновой задаче с уведомлением админа
-        asyncio.create_task(_background_mass_mailing(context, mailing_id, admin_id))
+        _start_background_mailing(context.bot, mailing_id, admin_id)
         
         logger.info(f"Рассылка {mailing_id} запущена в фоне для {total_count} пользователей")
         return True, 0, total_count
@@ -250,11 +777,100 @@ async def send_mass_mailing(context: ContextTypes.DEFAULT_TYPE, mailing_id: int,
     except Exception as e:
         logger.error(f"Ошибка при запуске массовой рассылки: {e}")
         return False, 0, 0
-    finally:
-        db.close()
 
 
-async def create_mailing(message_text: str, image_path: str = None, created_by: int = None):
+async def start_scheduled_mailing(bot, mailing_id: int) -> bool:
+    """
+    Запустить отложенную рассылку, время которой наступило
+    
+    Статус меняется с 'scheduled' на 'sending' условным UPDATE, поэтому
+    рассылку запускает только один вызов. Перенесенная на другое время
+    рассылка не запускается по старому времени.
+    
+    Returns:
+        bool: True если рассылка запущена
+    """
+    async with get_async_db() as db:
+        result = await db.execute(
+            update(Mailing).where(
+                Mailing.id == mailing_id,
+                Mailing.status == 'scheduled',
+                Mailing.scheduled_time <= datetime.utcnow()
+            ).values(status='sending', started_at=datetime.utcnow()).returning(Mailing.created_by)
+        )
+        created_by = result.scalar_one_or_none()
+        await db.commit()
+    
+    if created_by is None:
+        return False
+    _start_background_mailing(bot, mailing_id, created_by)
+    return True
+
+
+async def resume_interrupted_mailings(bot):
+    """
+    Подключиться к рассылкам, у которых остались необработанные куски
+    
+    Вызывается при запуске бота и периодически (MAILING_RESUME_INTERVAL):
+    так продолжаются рассылки, прерванные остановкой бота, и куски,
+    брошенные упавшим процессом. Уведомление получит создатель рассылки.
+    
+    Returns:
+        int: Количество продолженных рассылок
+    """
+    chunks = select(MailingChunk.id).where(MailingChunk.mailing_id == Mailing.id)
+    lease_expired = datetime.utcnow() - timedelta(seconds=MAILING_CHUNK_LEASE)
+    try:
+        async with get_async_db() as db:
+            result = await db.execute(
+                select(Mailing.id, Mailing.created_by).where(
+                    Mailing.status == 'sending',
+                    or_(
+                        # Куски еще не созданы
+                        ~chunks.exists(),
+                        # Есть свободные куски
+                        chunks.where(or_(
+                            MailingChunk.status == 'pending',
+                            and_(MailingChunk.status == 'claimed', MailingChunk.claimed_at < lease_expired)
+                        )).exists(),
+                        # Все обработано, но рассылка не завершена
+                        ~chunks.where(MailingChunk.status != 'done').exists()
+                    )
+                )
+            )
+            mailings = result.all()
+    except Exception as e:
+        logger.error(f"Не удалось получить прерванные рассылки: {e}")
+        return 0
+    
+    resumed = 0
+    for mailing in mailings:
+        if mailing.id in _active_mailings:
+            continue
+        logger.info(f"Возобновление прерванной рассылки {mailing.id}")
+        _start_background_mailing(bot, mailing.id, mailing.created_by)
+        resumed += 1
+    
+    return resumed
+
+
+async def stop_mailings():
+    """
+    Остановить активные рассылки при остановке бота
+    
+    Прогресс сохраняется, захваченные куски возвращаются в очередь,
+    статус остается 'sending', и рассылки продолжит этот или другой процесс.
+    """
+    tasks = list(_background_tasks)
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info(f"Остановлено рассылок: {len(tasks)}")
+
+
+async def create_mailing(message_text: str, image_path: str = None, created_by: int = None,
+                         photo_file_id: str = None, audience: dict = None):
     """
     Создание новой рассылки
     
@@ -262,33 +878,33 @@ async def create_mailing(message_text: str, image_path: str = None, created_by:
         message_text: Текст сообщения
         image_path: Путь к изображению (опционально)
         created_by: ID создателя рассылки
+        photo_file_id: file_id изображения в Telegram, если оно уже известно
+        audience: Сегмент получателей (см. recipients.audience_criteria), None - все
     
     Returns:
         int: ID созданной рассылки или None в случае ошибки
     """
-    db = get_db()
     try:
-        mailing = Mailing(
-            message_text=message_text,
-            image_path=image_path,
-            created_by=created_by,
-            status='draft',
-            created_at=datetime.utcnow()
-        )
-        
-        db.add(mailing)
-        db.commit()
-        db.refresh(mailing)
+        async with get_async_db() as db:
+            mailing = Mailing(
+                message_text=message_text,
+                image_path=image_path,
+                photo_file_id=photo_file_id,
+                created_by=created_by,
+                audience=audience or None,
+                status='draft',
+                created_at=datetime.utcnow()
+            )
+            
+            db.add(mailing)
+            await db.commit()
         
         logger.info(f"Создана новая рассылка ID: {mailing.id}")
         return mailing.id
         
     except Exception as e:
-        db.rollback()
         logger.error(f"Ошибка при создании рассылки: {e}")
         return None
-    finally:
-        db.close()
 
 
 async def get_mailing(mailing_id: int):
@@ -301,12 +917,8 @@ async def get_mailing(mailing_id: int):
     Returns:
         Mailing: Объект рассылки или None
     """
-    db = get_db()
-    try:
-        mailing = db.query(Mailing).filter_by(id=mailing_id).first()
-        return mailing
-    finally:
-        db.close()
+    async with get_async_db() as db:
+        return await db.get(Mailing, mailing_id)
 
 
 async def delete_mailing(mailing_id: int):
@@ -319,31 +931,31 @@ async def delete_mailing(mailing_id: int):
     Returns:
         bool: True если успешно, False иначе
     """
-    db = get_db()
     try:
-        mailing = db.query(Mailing).filter_by(id=mailing_id).first()
-        
-        if mailing:
-            # Удаляем изображение, если оно есть
-            if mailing.image_path and Path(mailing.image_path).exists():
-                try:
-                    Path(mailing.image_path).unlink()
-                except Exception as e:
-                    logger.warning(f"Не удалось удалить изображение: {e}")
+        async with get_async_db() as db:
+            mailing = await db.get(Mailing, mailing_id)
             
-            db.delete(mailing)
-            db.commit()
-            logger.info(f"Рассылка {mailing_id} удалена")
-            return True
-        else:
-            logger.warning(f"Рассылка {mailing_id} не найдена")
-            return False
+            if not mailing:
+                logger.warning(f"Рассылка {mailing_id} не найдена")
+                return False
+            
+            await db.execute(delete(MailingDelivery).where(MailingDelivery.mailing_id == mailing_id))
+            await db.execute(delete(MailingChunk).where(MailingChunk.mailing_id == mailing_id))
+            await db.delete(mailing)
+            await db.commit()
+        
+        # Удаляем изображение, если оно есть
+        if mailing.image_path and Path(mailing.image_path).exists():
+            try:
+                Path(mailing.image_path).unlink()
+            except Exception as e:
+                logger.warning(f"Не удалось удалить изображение: {e}")
+        
+        logger.info(f"Рассылка {mailing_id} удалена")
+        return True
             
     except Exception as e:
-        db.rollback()
         logger.error(f"Ошибка при удалении рассылки: {e}")
         return False
-    finally:
-        db.close()
 
 
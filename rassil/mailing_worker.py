@@ -0,0 +1,66 @@
+"""
+Дополнительный процесс рассылки
+
+Не принимает обновления от Telegram, а только помогает боту отправлять
+рассылки: периодически ищет рассылки со свободными кусками получателей
+и обрабатывает их. Таких процессов можно запустить несколько, на одном
+или разных серверах с общей базой; каждый кусок обрабатывает один
+процесс. При нескольких процессах включите TELEGRAM_SHARED_RATE_LIMIT,
+чтобы лимит Telegram соблюдался для всех вместе.
+
+Запуск: python mailing_worker.py
+"""
+import asyncio
+import logging
+import signal
+import sys
+from telegram import Bot
+from config import BOT_TOKEN, LOG_LEVEL, TELEGRAM_API_BASE_URL, MAILING_RESUME_INTERVAL
+from database import check_schema_version, async_engine
+from mailing_system import resume_interrupted_mailings, stop_mailings
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=getattr(logging, LOG_LEVEL, logging.INFO),
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def run_worker():
+    """Искать рассылки со свободными кусками до сигнала остановки"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    async with Bot(BOT_TOKEN, base_url=TELEGRAM_API_BASE_URL) as bot:
+        logger.info(f"Процесс рассылки запущен (бот @{bot.username})")
+        try:
+            while not stop.is_set():
+                resumed = await resume_interrupted_mailings(bot)
+                if resumed:
+                    logger.info(f"Подключение к рассылкам: {resumed}")
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=MAILING_RESUME_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # Захваченные куски возвращаются в очередь
+            await stop_mailings()
+            await async_engine.dispose()
+    logger.info("Процесс рассылки остановлен")
+
+
+def main():
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN не указан в файле .env")
+        sys.exit(1)
+    # Схему обновляет alembic upgrade head, процесс рассылки только проверяет версию
+    check_schema_version()
+    asyncio.run(run_worker())
+
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,22 @@
 """
 import logging
 import sys
-from telegram.ext import Application, ChatJoinRequestHandler
-from config import BOT_TOKEN, LOG_LEVEL
-from database import init_db
+from telegram.ext import Application, ChatJoinRequestHandler, ContextTypes
+from config import (
+    BOT_TOKEN, LOG_LEVEL, DB_POOL_STATS_INTERVAL, JOIN_STATS_INTERVAL,
+    UPDATE_CONCURRENCY, UPDATE_MAX_PENDING, BOT_MODE, ALLOWED_UPDATES,
+    TELEGRAM_API_BASE_URL, MAILING_RESUME_INTERVAL, WEBHOOK_SECRET_TOKEN
+)
+from database import init_db, log_pool_stats, async_engine
 from bot_core import setup_handlers
 from admin_panel import setup_admin_handlers
-from join_request_handler import handle_join_request
+from join_request_handler import handle_join_request, stop_join_pipeline, log_join_stats
+from scheduler import setup_reminder_sweeper
+from mailing_system import resume_interrupted_mailings, stop_mailings
+from mailing_scheduler import start_mailing_dispatcher, stop_mailing_dispatcher
+from update_processor import PerUserUpdateProcessor
+from db_persistence import DatabasePersistence
+from settings_cache import start_settings_listener, stop_settings_listener
 
 # Настройка логирования
 logging.basicConfig(
@@ -23,6 +33,68 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+async def on_startup(application: Application):
+    """Действия после инициализации бота, перед началом приема обновлений"""
+    try:
+        webhook_info = await application.bot.get_webhook_info()
+        logger.info(f"Обновлений в очереди Telegram при запуске: {webhook_info.pending_update_count}")
+    except Exception as e:
+        logger.warning(f"Не удалось получить размер очереди обновлений: {e}")
+    
+    # Изменения настроек из других экземпляров бота (PostgreSQL LISTEN/NOTIFY)
+    try:
+        await start_settings_listener()
+    except Exception as e:
+        logger.warning(f"Не удалось подписаться на изменения настроек: {e}")
+    
+    resumed = await resume_interrupted_mailings(application.bot)
+    if resumed:
+        logger.info(f"Возобновлено прерванных рассылок: {resumed}")
+    
+    # Отложенные рассылки: расписание восстанавливается из базы
+    scheduled = await start_mailing_dispatcher(application.bot)
+    if scheduled:
+        logger.info(f"Запланированных рассылок: {scheduled}")
+
+
+async def on_stop(application: Application):
+    """Действия после остановки приема обновлений, пока бот еще может отправлять запросы"""
+    # Новые отложенные рассылки не запускаются
+    await stop_mailing_dispatcher()
+    # Активные рассылки сохраняют прогресс и продолжатся при следующем запуске
+    await stop_mailings()
+    # Уже полученные заявки дообрабатываются (Telegram их повторно не пришлет)
+    await stop_join_pipeline()
+
+
+async def on_shutdown(application: Application):
+    """Действия при остановке бота"""
+    await stop_settings_listener()
+    await async_engine.dispose()
+
+
+async def report_pool_stats(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая запись статистики пулов соединений в лог"""
+    log_pool_stats()
+
+
+async def report_join_stats(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая запись статистики конвейера заявок в лог"""
+    log_join_stats()
+
+
+async def resume_mailings(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическое подключение к рассылкам со свободными кусками (в том числе брошенными другим процессом)"""
+    await resume_interrupted_mailings(context.bot)
+
+
+def setup_stats_job(application: Application, callback, interval: int, name: str):
+    """Запуск периодической записи статистики в лог (interval <= 0 - выключено)"""
+    if interval <= 0 or application.job_queue is None:
+        return
+    application.job_queue.run_repeating(callback, interval=interval, first=interval, name=name)
+
+
 def main():
     """Главная функция запуска бота"""
     
@@ -30,6 +102,9 @@ def main():
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN не указан в файле .env")
         sys.exit(1)
+    if BOT_MODE == 'webhook' and not WEBHOOK_SECRET_TOKEN:
+        logger.error("WEBHOOK_SECRET_TOKEN не указан в файле .env (обязателен в режиме webhook)")
+        sys.exit(1)
     
     logger.info("=" * 50)
     logger.info("Запуск Telegram бота 'Eldorado Trade'")
@@ -43,11 +118,20 @@ def main():
         
         # Создание приложения с persistence для сохранения состояния
         logger.info("Создание приложения бота...")
-        from telegram.ext import PicklePersistence
-        
-        # Используем persistence для сохранения состояния между перезапусками
-        persistence = PicklePersistence(filepath='bot_persistence.pickle')
-        application = Application.builder().token(BOT_TOKEN).persistence(persistence).build()
+        # Состояние между перезапусками хранится в базе (только измененные ключи)
+        persistence = DatabasePersistence()
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .base_url(TELEGRAM_API_BASE_URL)
+            .persistence(persistence)
+            # Разные пользователи обрабатываются параллельно, один пользователь - по порядку
+            .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING))
+            .post_init(on_startup)
+            .post_stop(on_stop)
+            .post_shutdown(on_shutdown)
+            .build()
+        )
         
         # Настройка обработчиков
         logger.info("Настройка обработчиков команд...")
@@ -58,18 +142,36 @@ def main():
         application.add_handler(ChatJoinRequestHandler(handle_join_request))
         logger.info("Обработчик заявок на вступление настроен")
         
+        # Периодическая отправка напоминаний
+        setup_reminder_sweeper(application)
+        
+        # Продолжение рассылок, брошенных остановленным или упавшим процессом
+        if application.job_queue is not None and MAILING_RESUME_INTERVAL > 0:
+            application.job_queue.run_repeating(
+                resume_mailings, interval=MAILING_RESUME_INTERVAL, first=MAILING_RESUME_INTERVAL, name="mailing_resume"
+            )
+        
+        # Статистика пулов соединений с базой и конвейера заявок
+        setup_stats_job(application, report_pool_stats, DB_POOL_STATS_INTERVAL, "db_pool_stats")
+        setup_stats_job(application, report_join_stats, JOIN_STATS_INTERVAL, "join_stats")
+        
         logger.info("Обработчики успешно настроены")
         
         # Запуск бота
-        logger.info("Запуск бота...")
+        logger.info(f"Запуск бота (режим {BOT_MODE})...")
         logger.info("Бот успешно запущен и готов к работе!")
         logger.info("Нажмите Ctrl+C для остановки бота")
         
-        # Запуск polling с обработкой пропущенных сообщений
-        application.run_polling(
-            allowed_updates=['message', 'callback_query', 'chat_join_request'],
-            drop_pending_updates=False  # Обрабатываем сообщения, отправленные во время простоя
-        )
+        if BOT_MODE == 'webhook':
+            # Встроенный HTTP-сервер (aiohttp) принимает обновления от Telegram
+            from webhook_server import run_webhook
+            run_webhook(application)
+        else:
+            # Запуск polling с обработкой пропущенных сообщений
+            application.run_polling(
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=False  # Обрабатываем сообщения, отправленные во время простоя
+            )
         
     except KeyboardInterrupt:
         logger.info("Получен сигнал остановки (Ctrl+C)")
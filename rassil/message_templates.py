@@ -0,0 +1,136 @@
+"""
+Заранее собранные клавиатуры и сообщения
+
+Клавиатуры одинаковы для всех пользователей, поэтому собираются и
+сериализуются в JSON один раз при импорте. Библиотека передает строковый
+reply_markup в запрос как есть, без повторной сериализации.
+
+Здесь же шаблоны персонализации текстов рассылок и напоминаний.
+"""
+import json
+import re
+from datetime import datetime
+from functools import lru_cache
+from html import escape
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from config import WELCOME_MESSAGE, VERIFICATION_MESSAGE
+
+VERIFY_BUTTON_TEXT = "✅ Я человек!"
+
+
+def prebuilt_markup(markup) -> str:
+    """Сериализованная клавиатура для параметра reply_markup"""
+    return json.dumps(markup.to_dict(), ensure_ascii=False, separators=(',', ':'))
+
+
+# Кнопка "Я человек" после приветствия
+VERIFY_KEYBOARD = prebuilt_markup(ReplyKeyboardMarkup(
+    [[KeyboardButton(VERIFY_BUTTON_TEXT)]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+))
+
+# Убрать клавиатуру после верификации
+REMOVE_KEYBOARD = prebuilt_markup(ReplyKeyboardRemove())
+
+# Кнопка подписки в напоминаниях
+SUBSCRIBE_KEYBOARD = prebuilt_markup(InlineKeyboardMarkup(
+    [[InlineKeyboardButton("ОК 🔥", callback_data="subscribe")]]
+))
+
+# Приветствие: аргументы send_message для каждого из двух сообщений (без chat_id)
+GREETING_MESSAGES = (
+    {'text': WELCOME_MESSAGE, 'parse_mode': 'HTML'},
+    {'text': VERIFICATION_MESSAGE, 'reply_markup': VERIFY_KEYBOARD},
+)
+
+
+# Подстановки в текстах рассылок и напоминаний: {first_name}, {username},
+# {days_since_join}; после "|" - значение для пользователей без этих данных,
+# например {first_name|друг}. Остальные фигурные скобки остаются как есть.
+_PLACEHOLDER = re.compile(r'\{(first_name|username|days_since_join)(?:\|([^{}]*))?\}')
+
+
+def _first_name(recipient: dict, now: datetime):
+    return recipient.get('first_name')
+
+
+def _username(recipient: dict, now: datetime):
+    return recipient.get('username')
+
+
+def _days_since_join(recipient: dict, now: datetime):
+    created_at = recipient.get('created_at')
+    if created_at is None:
+        return None
+    return str(((now or datetime.utcnow()) - created_at).days)
+
+
+# Подстановка -> (функция значения, колонка User, из которой оно берется)
+PLACEHOLDERS = {
+    'first_name': (_first_name, 'first_name'),
+    'username': (_username, 'username'),
+    'days_since_join': (_days_since_join, 'created_at'),
+}
+
+
+class MessageTemplate:
+    """
+    Текст с подстановками, разобранный один раз
+
+    Текст делится на неизменные куски и места подстановок; render только
+    заполняет места значениями получателя (экранированными для
+    parse_mode='HTML') и склеивает куски. Текст без подстановок
+    возвращается как есть.
+    """
+
+    __slots__ = ('text', 'columns', '_parts', '_fields')
+
+    def __init__(self, text: str):
+        self.text = text
+        parts = []
+        fields = []
+        columns = []
+        position = 0
+        for match in _PLACEHOLDER.finditer(text):
+            parts.append(text[position:match.start()])
+            value, column = PLACEHOLDERS[match.group(1)]
+            fields.append((len(parts), value, match.group(2) or ''))
+            parts.append('')
+            if column not in columns:
+                columns.append(column)
+            position = match.end()
+        parts.append(text[position:])
+
+        self._parts = parts
+        self._fields = tuple(fields)
+        # Колонки User, которые нужно выбрать для получателей
+        self.columns = tuple(columns)
+
+    @property
+    def personalized(self) -> bool:
+        """В тексте есть подстановки"""
+        return bool(self._fields)
+
+    def render(self, recipient: dict = None, now: datetime = None) -> str:
+        """
+        Текст для одного получателя
+
+        Args:
+            recipient: Значения колонок пользователя (first_name, username, created_at)
+            now: Момент, от которого считаются дни с регистрации (по умолчанию - текущий)
+        """
+        if not self._fields:
+            return self.text
+        recipient = recipient or {}
+        parts = self._parts.copy()
+        for index, value, default in self._fields:
+            result = value(recipient, now)
+            parts[index] = escape(result, quote=False) if result else default
+        return ''.join(parts)
+
+
+@lru_cache(maxsize=64)
+def compile_template(text: str) -> MessageTemplate:
+    """Шаблон для текста (разобранные тексты переиспользуются)"""
+    return MessageTemplate(text or '')
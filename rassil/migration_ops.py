@@ -0,0 +1,56 @@
+"""
+Операции миграций Alembic без блокировки таблиц
+
+Обычный CREATE INDEX блокирует запись в таблицу на все время построения
+индекса. В PostgreSQL индексы строятся и удаляются с CONCURRENTLY: запись
+продолжается, но команда не может выполняться внутри транзакции, поэтому
+выполняется в autocommit-блоке миграции.
+
+Использование в файле миграции:
+
+    from migration_ops import create_index_online, drop_index_online
+
+    def upgrade():
+        create_index_online('ix_users_created_at', 'users', ['created_at'])
+"""
+from alembic import op
+from sqlalchemy import text
+
+
+def _index_is_invalid(index_name: str) -> bool:
+    """Индекс остался невалидным после прерванного CREATE INDEX CONCURRENTLY"""
+    if op.get_context().as_sql:
+        return False
+    result = op.get_bind().execute(
+        text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+        {'name': index_name}
+    )
+    return bool(result.scalar())
+
+
+def create_index_online(index_name: str, table_name: str, columns: list, **kw):
+    """
+    Создать индекс, не блокируя запись в таблицу (CREATE INDEX CONCURRENTLY)
+
+    Повторный запуск безопасен: уже созданный индекс пропускается, а
+    невалидный индекс от прерванной попытки удаляется и строится заново.
+    В других СУБД (SQLite для разработки) создается обычный индекс.
+    """
+    if op.get_bind().dialect.name != 'postgresql':
+        op.create_index(index_name, table_name, columns, if_not_exists=True, **kw)
+        return
+
+    with op.get_context().autocommit_block():
+        if _index_is_invalid(index_name):
+            op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True)
+        op.create_index(index_name, table_name, columns, postgresql_concurrently=True, if_not_exists=True, **kw)
+
+
+def drop_index_online(index_name: str, table_name: str):
+    """Удалить индекс, не блокируя запись в таблицу (DROP INDEX CONCURRENTLY)"""
+    if op.get_bind().dialect.name != 'postgresql':
+        op.drop_index(index_name, table_name=table_name, if_exists=True)
+        return
+
+    with op.get_context().autocommit_block():
+        op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,162 @@
+"""Исходная схема (таблицы, которые раньше создавал create_all)
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+from migration_ops import create_index_online
+
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def _create_users():
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('user_id', sa.BigInteger(), nullable=False),
+        sa.Column('chat_id', sa.BigInteger(), nullable=False),
+        sa.Column('username', sa.String(length=255), nullable=True),
+        sa.Column('first_name', sa.String(length=255), nullable=True),
+        sa.Column('last_name', sa.String(length=255), nullable=True),
+        sa.Column('subscribed', sa.Boolean(), nullable=True),
+        sa.Column('subscription_date', sa.DateTime(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('reminder_3min_sent', sa.Boolean(), nullable=True),
+        sa.Column('reminder_10min_sent', sa.Boolean(), nullable=True),
+        sa.Column('reminder_30min_sent', sa.Boolean(), nullable=True),
+        sa.Column('reminder_9hours_sent', sa.Boolean(), nullable=True),
+        sa.Column('reachability', sa.String(length=20), server_default='ok', nullable=False),
+        sa.Column('unreachable_since', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_users_user_id', 'users', ['user_id'], unique=True)
+    op.create_index('ix_users_created_at', 'users', ['created_at'])
+
+
+def _create_mailings():
+    op.create_table(
+        'mailings',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('message_text', sa.Text(), nullable=False),
+        sa.Column('image_path', sa.String(length=500), nullable=True),
+        sa.Column('photo_file_id', sa.String(length=255), nullable=True),
+        sa.Column('scheduled_time', sa.DateTime(), nullable=True),
+        sa.Column('status', sa.String(length=50), nullable=True),
+        sa.Column('created_by', sa.BigInteger(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('sent_count', sa.Integer(), nullable=True),
+        sa.Column('failed_count', sa.Integer(), nullable=True),
+        sa.Column('pruned_count', sa.Integer(), nullable=True),
+        sa.Column('total_count', sa.Integer(), nullable=True),
+        sa.Column('last_recipient_id', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def _create_mailing_deliveries():
+    op.create_table(
+        'mailing_deliveries',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('mailing_id', sa.Integer(), nullable=False),
+        sa.Column('recipient_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.BigInteger(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('error', sa.String(length=255), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('mailing_id', 'recipient_id', name='uq_mailing_deliveries_recipient')
+    )
+
+
+def _create_persistence_entries():
+    op.create_table(
+        'persistence_entries',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('kind', sa.String(length=20), nullable=False),
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('data', sa.LargeBinary(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('kind', 'key', name='uq_persistence_entries_kind_key')
+    )
+
+
+def _create_reminder_texts():
+    op.create_table(
+        'reminder_texts',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('reminder_type', sa.String(length=50), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('reminder_type')
+    )
+
+
+def _create_bot_settings():
+    op.create_table(
+        'bot_settings',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('setting_key', sa.String(length=100), nullable=False),
+        sa.Column('setting_value', sa.Text(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('setting_key')
+    )
+
+
+_TABLES = [
+    ('users', _create_users),
+    ('mailings', _create_mailings),
+    ('mailing_deliveries', _create_mailing_deliveries),
+    ('persistence_entries', _create_persistence_entries),
+    ('reminder_texts', _create_reminder_texts),
+    ('bot_settings', _create_bot_settings),
+]
+
+
+# Колонки, добавленные после первого релиза (раньше их добавлял init_db)
+_LEGACY_COLUMNS = [
+    ('mailings', sa.Column('photo_file_id', sa.String(length=255), nullable=True)),
+    ('mailings', sa.Column('failed_count', sa.Integer(), server_default='0', nullable=True)),
+    ('mailings', sa.Column('last_recipient_id', sa.Integer(), server_default='0', nullable=True)),
+    ('mailings', sa.Column('pruned_count', sa.Integer(), server_default='0', nullable=True)),
+    ('users', sa.Column('reachability', sa.String(length=20), server_default='ok', nullable=False)),
+    ('users', sa.Column('unreachable_since', sa.DateTime(), nullable=True)),
+]
+
+
+def _add_legacy_columns(inspector):
+    for table_name, column in _LEGACY_COLUMNS:
+        if column.name not in {existing['name'] for existing in inspector.get_columns(table_name)}:
+            op.add_column(table_name, column)
+    
+    create_index_online('ix_users_created_at', 'users', ['created_at'])
+
+
+def upgrade():
+    # Базы, созданные create_all до перехода на Alembic, дополняются до этой схемы
+    existing = set() if op.get_context().as_sql else set(sa.inspect(op.get_bind()).get_table_names())
+    for table_name, create in _TABLES:
+        if table_name not in existing:
+            create()
+    
+    if 'users' in existing:
+        _add_legacy_columns(sa.inspect(op.get_bind()))
+
+
+def downgrade():
+    op.drop_table('bot_settings')
+    op.drop_table('reminder_texts')
+    op.drop_table('persistence_entries')
+    op.drop_table('mailing_deliveries')
+    op.drop_table('mailings')
+    op.drop_index('ix_users_created_at', table_name='users')
+    op.drop_index('ix_users_user_id', table_name='users')
+    op.drop_table('users')
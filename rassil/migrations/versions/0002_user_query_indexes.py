@@ -0,0 +1,37 @@
+"""Индексы users под запросы напоминаний и рассылок
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from migration_ops import create_index_online, drop_index_online
+
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+# Должно совпадать с database.REMINDERS_PENDING: запрос напоминаний содержит то же
+# условие, иначе планировщик не сможет использовать частичный индекс
+REMINDERS_PENDING_WHERE = sa.text(
+    "subscribed = false AND ("
+    "reminder_3min_sent = false OR reminder_10min_sent = false OR "
+    "reminder_30min_sent = false OR reminder_9hours_sent = false)"
+)
+
+
+def upgrade():
+    # Таблица users большая и постоянно пишется: индексы строятся без блокировки
+    create_index_online(
+        'ix_users_reminders_pending', 'users', ['created_at', 'id'],
+        postgresql_where=REMINDERS_PENDING_WHERE,
+        sqlite_where=REMINDERS_PENDING_WHERE
+    )
+    create_index_online('ix_users_broadcast', 'users', ['id'], postgresql_include=['user_id', 'chat_id'])
+
+
+def downgrade():
+    drop_index_online('ix_users_broadcast', 'users')
+    drop_index_online('ix_users_reminders_pending', 'users')
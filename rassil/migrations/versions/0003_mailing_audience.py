@@ -0,0 +1,34 @@
+"""Сегменты получателей рассылок
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+from migration_ops import create_index_online, drop_index_online
+
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Колонки без значения по умолчанию: PostgreSQL не переписывает таблицу
+    op.add_column('users', sa.Column('last_messaged_at', sa.DateTime(), nullable=True))
+    op.add_column('mailings', sa.Column('audience', sa.JSON(), nullable=True))
+
+    create_index_online(
+        'ix_users_subscribed', 'users', ['id'],
+        postgresql_include=['user_id', 'chat_id', 'reachability'],
+        postgresql_where=sa.text('subscribed = true'),
+        sqlite_where=sa.text('subscribed = true')
+    )
+
+
+def downgrade():
+    drop_index_online('ix_users_subscribed', 'users')
+    op.drop_column('mailings', 'audience')
+    op.drop_column('users', 'last_messaged_at')
@@ -0,0 +1,21 @@
+"""Индекс для диспетчера отложенных рассылок
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from migration_ops import create_index_online, drop_index_online
+
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    create_index_online('ix_mailings_status_scheduled_time', 'mailings', ['status', 'scheduled_time'])
+
+
+def downgrade():
+    drop_index_online('ix_mailings_status_scheduled_time', 'mailings')
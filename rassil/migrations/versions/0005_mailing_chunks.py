@@ -0,0 +1,47 @@
+"""Рассылка несколькими процессами: куски получателей и общий лимит отправки
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Новые таблицы пустые: индекс создается обычным образом
+    op.create_table(
+        'mailing_chunks',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('mailing_id', sa.Integer(), nullable=False),
+        sa.Column('first_recipient_id', sa.Integer(), nullable=False),
+        sa.Column('last_recipient_id', sa.Integer(), nullable=False),
+        sa.Column('status', sa.String(20), nullable=False),
+        sa.Column('claimed_by', sa.String(100), nullable=True),
+        sa.Column('claimed_at', sa.DateTime(), nullable=True),
+    )
+    op.create_index('ix_mailing_chunks_mailing_id_status', 'mailing_chunks', ['mailing_id', 'status'])
+    op.create_table(
+        'rate_budgets',
+        sa.Column('name', sa.String(100), primary_key=True),
+        sa.Column('tokens', sa.Float(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+    )
+
+    op.add_column('mailings', sa.Column('started_at', sa.DateTime(), nullable=True))
+    # Прогресс прерванной рассылки восстанавливается по журналу доставки (mailing_deliveries)
+    op.drop_column('mailings', 'last_recipient_id')
+
+
+def downgrade():
+    op.add_column('mailings', sa.Column('last_recipient_id', sa.Integer(), nullable=True))
+    op.drop_column('mailings', 'started_at')
+    op.drop_table('rate_budgets')
+    op.drop_index('ix_mailing_chunks_mailing_id_status', 'mailing_chunks')
+    op.drop_table('mailing_chunks')
@@ -0,0 +1,224 @@
+"""
+Ограничение скорости запросов к Telegram Bot API
+"""
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from telegram.error import RetryAfter
+from config import (
+    BOT_TOKEN, TELEGRAM_RATE_LIMIT, TELEGRAM_PER_CHAT_INTERVAL, TELEGRAM_MAX_RETRIES,
+    TELEGRAM_SHARED_RATE_LIMIT, TELEGRAM_SHARED_RATE_BATCH
+)
+
+logger = logging.getLogger(__name__)
+
+# Сколько записей о чатах держать, прежде чем чистить устаревшие
+_CHAT_CLEANUP_THRESHOLD = 10000
+
+
+class TokenBucket:
+    """Корзина токенов: в среднем не более rate операций в секунду"""
+
+    def __init__(self, rate: float, capacity: int = None):
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        """Дождаться свободного токена (ожидающие обслуживаются по очереди)"""
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class SharedRateBudget:
+    """
+    Корзина токенов в PostgreSQL, общая для всех процессов одного бота
+
+    Процесс берет из общей корзины сразу batch токенов одним запросом
+    (INSERT ... ON CONFLICT DO UPDATE ... RETURNING) и расходует их сам.
+    Корзина может уйти в минус: тогда процесс ждет, пока взятые токены
+    накопятся, и следующие процессы в очереди ждут дольше.
+    """
+
+    _TAKE = """
+        INSERT INTO rate_budgets (name, tokens, updated_at)
+        VALUES (:name, CAST(:capacity AS double precision) - :n, clock_timestamp() AT TIME ZONE 'UTC')
+        ON CONFLICT (name) DO UPDATE SET
+            tokens = LEAST(
+                CAST(:capacity AS double precision),
+                rate_budgets.tokens + CAST(:rate AS double precision)
+                    * EXTRACT(EPOCH FROM (clock_timestamp() AT TIME ZONE 'UTC') - rate_budgets.updated_at)
+            ) - :n,
+            updated_at = clock_timestamp() AT TIME ZONE 'UTC'
+        RETURNING tokens
+    """
+
+    def __init__(self, name: str, rate: float, batch: int = 5):
+        self.name = name
+        self.rate = rate
+        self.capacity = max(1, int(rate))
+        self.batch = max(1, min(batch, self.capacity))
+        self._tokens = 0
+        self._lock = asyncio.Lock()
+
+    async def _take(self) -> float:
+        """Взять batch токенов из общей корзины; вернуть остаток корзины"""
+        from sqlalchemy import text
+        from database import get_async_db
+
+        async with get_async_db() as db:
+            result = await db.execute(
+                text(self._TAKE),
+                {'name': self.name, 'capacity': self.capacity, 'rate': self.rate, 'n': self.batch}
+            )
+            balance = result.scalar_one()
+            await db.commit()
+        return balance
+
+    async def acquire(self):
+        """Дождаться токена общей корзины"""
+        async with self._lock:
+            if self._tokens == 0:
+                try:
+                    balance = await self._take()
+                except Exception as e:
+                    # База недоступна: отправка ограничивается только лимитом процесса
+                    logger.warning(f"Не удалось получить токены общего лимита {self.name}: {e}")
+                    return
+                self._tokens = self.batch
+                if balance < 0:
+                    await asyncio.sleep(-balance / self.rate)
+            self._tokens -= 1
+
+
+class ChatRateLimiter:
+    """Минимальный интервал между сообщениями в один и тот же чат"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_slot = {}
+
+    async def acquire(self, chat_id: int):
+        """Зарезервировать ближайший свободный слот для чата и дождаться его"""
+        now = time.monotonic()
+        slot = max(now, self._next_slot.get(chat_id, 0.0))
+        self._next_slot[chat_id] = slot + self.interval
+
+        if len(self._next_slot) > _CHAT_CLEANUP_THRESHOLD:
+            self._next_slot = {cid: t for cid, t in self._next_slot.items() if t > now}
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    """Значение retry_after в секундах (в разных версиях библиотеки это int или timedelta)"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class RateLimiter:
+    """
+    Общий ограничитель для всех исходящих запросов бота
+
+    Объединяет глобальную корзину токенов, ограничение на чат и общую
+    паузу после RetryAfter: если Telegram попросил подождать, ждут все
+    отправители, а не только тот, кто получил ошибку.
+    """
+
+    def __init__(self, rate: float, per_chat_interval: float, max_retries: int = 3,
+                 shared: SharedRateBudget = None):
+        self.bucket = TokenBucket(rate)
+        self.shared = shared
+        self.chats = ChatRateLimiter(per_chat_interval)
+        self.max_retries = max_retries
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        """Приостановить все отправки на указанное время"""
+        paused_until = time.monotonic() + seconds
+        if paused_until > self._paused_until:
+            self._paused_until = paused_until
+            logger.warning(f"Telegram запросил паузу {seconds:.0f} сек, отправка приостановлена")
+
+    async def _wait_pause(self):
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def acquire(self, chat_id: int = None):
+        """Дождаться разрешения на один запрос (в указанный чат)"""
+        if chat_id is not None:
+            await self.chats.acquire(chat_id)
+        await self._wait_pause()
+        await self.bucket.acquire()
+        if self.shared is not None:
+            await self.shared.acquire()
+        await self._wait_pause()
+
+    async def call(self, func, per_chat: bool = True, **kwargs):
+        """
+        Выполнить запрос к API с учетом лимитов
+
+        Args:
+            func: Корутинная функция бота, например bot.send_message
+            per_chat: Учитывать ограничение на чат (нужно для сообщений, но не,
+                например, для принятия заявок в канал)
+            **kwargs: Аргументы запроса; chat_id используется для ограничения на чат
+
+        Returns:
+            Результат func
+        """
+        chat_id = kwargs.get('chat_id') if per_chat else None
+        attempt = 0
+        while True:
+            await self.acquire(chat_id)
+            try:
+                return await func(**kwargs)
+            except RetryAfter as e:
+                self.pause(_retry_after_seconds(e))
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+
+
+def _shared_rate_budget():
+    """Общий лимит процессов бота (TELEGRAM_SHARED_RATE_LIMIT) или None"""
+    if not TELEGRAM_SHARED_RATE_LIMIT:
+        return None
+    from database import async_engine
+    if async_engine.dialect.name != 'postgresql':
+        logger.warning("Общий лимит отправки поддерживается только с PostgreSQL, используется лимит процесса")
+        return None
+    # Лимит Telegram действует на бота: имя корзины - id бота из токена
+    return SharedRateBudget(f"telegram:{BOT_TOKEN.split(':')[0]}", TELEGRAM_RATE_LIMIT, TELEGRAM_SHARED_RATE_BATCH)
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Получить общий для всего бота ограничитель"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(
+            TELEGRAM_RATE_LIMIT, TELEGRAM_PER_CHAT_INTERVAL, TELEGRAM_MAX_RETRIES, _shared_rate_budget()
+        )
+    return _rate_limiter
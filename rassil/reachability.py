@@ -0,0 +1,40 @@
+"""
+Доступность чатов пользователей: классификация ошибок отправки
+"""
+from telegram.error import Forbidden, BadRequest
+
+# Состояния доступности пользователя (колонка users.reachability)
+REACHABLE = 'ok'
+BLOCKED = 'blocked'  # Пользователь заблокировал бота
+CHAT_NOT_FOUND = 'chat_not_found'  # Чат не существует
+DEACTIVATED = 'deactivated'  # Аккаунт удален
+
+# Временные ошибки (сеть, лимиты и т.п.): пользователь остается в рассылках
+TRANSIENT = 'transient'
+
+# Ошибки, после которых писать пользователю бесполезно
+PERMANENT_FAILURES = (BLOCKED, CHAT_NOT_FOUND, DEACTIVATED)
+
+
+def classify_send_error(error: Exception) -> str:
+    """
+    Определить тип ошибки отправки сообщения
+    
+    Args:
+        error: Исключение, полученное при отправке
+    
+    Returns:
+        str: BLOCKED, CHAT_NOT_FOUND, DEACTIVATED или TRANSIENT
+    """
+    message = str(error).lower()
+    
+    if isinstance(error, Forbidden):
+        if 'deactivated' in message:
+            return DEACTIVATED
+        # "bot was blocked by the user", "bot can't initiate conversation with a user" и т.п.
+        return BLOCKED
+    
+    if isinstance(error, BadRequest) and 'chat not found' in message:
+        return CHAT_NOT_FOUND
+    
+    return TRANSIENT
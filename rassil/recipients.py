@@ -0,0 +1,142 @@
+"""
+Получатели рассылок: потоковая выборка пользователей из базы данных
+"""
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, or_
+from database import get_async_db, User
+from config import RECIPIENT_PAGE_SIZE, REMINDER_INTERVALS
+from reachability import REACHABLE
+
+logger = logging.getLogger(__name__)
+
+# Рассылке нужны только эти колонки, ORM-объекты не создаются
+RECIPIENT_COLUMNS = (User.user_id, User.chat_id)
+
+
+# Готовые сегменты для админ-панели: ключ -> (название, описание аудитории)
+SEGMENTS = {
+    'all': ("Все пользователи", {}),
+    'subscribed': ("Подписанные", {'subscribed': True}),
+    'joined_7d': ("Новые за 7 дней", {'joined_within_days': 7}),
+    'joined_30d': ("Новые за 30 дней", {'joined_within_days': 30}),
+    'reminded_unsubscribed': ("Получили все напоминания, но не подписались",
+                              {'subscribed': False, 'reminder_stage': 'reminder_9hours'}),
+    'not_messaged_3d': ("Без рассылок последние 3 дня", {'not_messaged_days': 3}),
+}
+
+
+def segment_audience(segment: str) -> dict:
+    """Описание аудитории готового сегмента"""
+    return dict(SEGMENTS[segment][1])
+
+
+def _parse_date(value: str) -> datetime:
+    return datetime.fromisoformat(value)
+
+
+def audience_criteria(audience: dict = None, now: datetime = None) -> tuple:
+    """
+    Условия SQL для описания аудитории рассылки
+
+    Все условия объединяются через AND и выполняются в базе вместе с
+    постраничной выборкой получателей.
+
+    Args:
+        audience: Описание аудитории (None или {} - все пользователи):
+            subscribed: только подписанные (True) или только неподписанные (False)
+            joined_from, joined_to: дата регистрации в ISO-формате (включительно / не включая)
+            joined_within_days: зарегистрированы за последние N дней
+            reminder_stage: получено напоминание этого этапа (reminder_3min, ...)
+            not_messaged_days: не получали рассылок последние N дней
+        now: Момент, от которого отсчитываются относительные сроки
+            (для рассылки - начало отправки, started_at, чтобы аудитория не менялась при продолжении)
+
+    Raises:
+        ValueError: неизвестное условие или этап напоминаний
+    """
+    if not audience:
+        return ()
+    now = now or datetime.utcnow()
+    criteria = []
+
+    for key, value in audience.items():
+        if key == 'subscribed':
+            criteria.append(User.subscribed == bool(value))
+        elif key == 'joined_from':
+            criteria.append(User.created_at >= _parse_date(value))
+        elif key == 'joined_to':
+            criteria.append(User.created_at < _parse_date(value))
+        elif key == 'joined_within_days':
+            criteria.append(User.created_at >= now - timedelta(days=value))
+        elif key == 'reminder_stage':
+            if value not in REMINDER_INTERVALS:
+                raise ValueError(f"Неизвестный этап напоминаний: {value}")
+            criteria.append(getattr(User, f"{value}_sent") == True)
+        elif key == 'not_messaged_days':
+            criteria.append(or_(
+                User.last_messaged_at.is_(None),
+                User.last_messaged_at < now - timedelta(days=value)
+            ))
+        else:
+            raise ValueError(f"Неизвестное условие аудитории: {key}")
+
+    return tuple(criteria)
+
+
+def _recipient_criteria(include_unreachable: bool = False, audience: dict = None, now: datetime = None) -> tuple:
+    """Условия отбора получателей"""
+    criteria = audience_criteria(audience, now)
+    if include_unreachable:
+        return criteria
+    # Пользователи, заблокировавшие бота или удалившие аккаунт, пропускаются
+    return (User.reachability == REACHABLE,) + criteria
+
+
+async def stream_recipients(after_id: int = None, page_size: int = RECIPIENT_PAGE_SIZE,
+                            include_unreachable: bool = False, audience: dict = None, now: datetime = None,
+                            until_id: int = None, columns: tuple = ()):
+    """
+    Асинхронный генератор получателей рассылки
+    
+    Пользователи читаются страницами по page_size строк в порядке id,
+    поэтому память не зависит от размера базы, а первые сообщения уходят
+    сразу после чтения первой страницы. Каждая страница читается в
+    отдельной короткой асинхронной сессии.
+    
+    Args:
+        after_id: Начать с пользователей, у которых id больше указанного
+        page_size: Размер страницы
+        include_unreachable: Включать пользователей, до которых сообщения не доходят
+        audience, now: Сегмент получателей (см. audience_criteria)
+        until_id: Закончить на пользователе с этим id (включительно)
+        columns: Имена дополнительных колонок User (например, для подстановок в текст)
+    
+    Yields:
+        dict: {'id', 'user_id', 'chat_id', и колонки из columns}
+    """
+    extra_columns = tuple(getattr(User, name) for name in columns)
+    criteria = _recipient_criteria(include_unreachable, audience, now)
+    if until_id is not None:
+        criteria += (User.id <= until_id,)
+    while True:
+        query = select(User.id, *RECIPIENT_COLUMNS, *extra_columns).where(*criteria)
+        if after_id is not None:
+            query = query.where(User.id > after_id)
+        async with get_async_db() as db:
+            result = await db.execute(query.order_by(User.id).limit(page_size))
+            page = result.all()
+        
+        for row in page:
+            yield dict(row._mapping)
+        if len(page) < page_size:
+            return
+        after_id = page[-1].id
+
+
+async def count_recipients(include_unreachable: bool = False, audience: dict = None, now: datetime = None) -> int:
+    """Количество получателей рассылки (тот же отбор, что и в stream_recipients)"""
+    criteria = _recipient_criteria(include_unreachable, audience, now)
+    async with get_async_db() as db:
+        result = await db.execute(select(func.count(User.id)).where(*criteria))
+        return result.scalar()
@@ -1,113 +1,214 @@
 """
 Планировщик напоминаний
 """
+import asyncio
 import logging
+from collections import defaultdict
 from datetime import datetime, timedelta
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes
-from database import get_db, User, ReminderText
-from config import REMINDER_INTERVALS
+from sqlalchemy import select, and_, or_, case, update, tuple_
+from telegram.ext import Application, ContextTypes
+from telegram.error import TelegramError
+from database import get_async_db, User, REMINDERS_PENDING
+from config import (
+    REMINDER_INTERVALS, REMINDERS_ENABLED, REMINDER_SWEEP_INTERVAL,
+    REMINDER_BATCH_SIZE, REMINDER_LOOKBACK
+)
+from rate_limiter import get_rate_limiter
+from reachability import REACHABLE, PERMANENT_FAILURES, classify_send_error
+from cache import invalidate_user_statistics
+from settings_cache import get_settings
+from message_templates import SUBSCRIBE_KEYBOARD, compile_template
 
 logger = logging.getLogger(__name__)
 
+# Этапы напоминаний по возрастанию интервала
+REMINDER_STAGES = sorted(REMINDER_INTERVALS, key=REMINDER_INTERVALS.get)
 
-async def send_reminder(context: ContextTypes.DEFAULT_TYPE, user_id: int, chat_id: int, reminder_type: str):
-    """Отправка напоминания пользователю"""
-    db = get_db()
-    try:
-        # Проверяем, не подписался ли пользователь
-        user = db.query(User).filter_by(user_id=user_id).first()
-        
-        if not user:
-            logger.warning(f"Пользователь {user_id} не найден в базе данных")
-            return
-        
-        if user.subscribed:
-            logger.info(f"Пользователь {user_id} уже подписан, напоминание не отправляется")
-            return
-        
-        # Проверяем, не было ли уже отправлено это напоминание
-        reminder_field = f"{reminder_type}_sent"
-        if getattr(user, reminder_field, False):
-            logger.info(f"Напоминание {reminder_type} уже было отправлено пользователю {user_id}")
-            return
-        
-        # Получаем текст напоминания
-        reminder_text_obj = db.query(ReminderText).filter_by(reminder_type=reminder_type).first()
-        
-        if not reminder_text_obj:
+# Не даем двум проходам выполняться одновременно
+_sweep_lock = asyncio.Lock()
+
+
+def _reminder_flag(reminder_type: str):
+    """Колонка User с флагом отправки напоминания"""
+    return getattr(User, f"{reminder_type}_sent")
+
+
+async def _fetch_due_users(now: datetime, limit: int, after: tuple = None) -> list:
+    """
+    Пользователи, которым пора отправить хотя бы одно напоминание
+
+    Один запрос на все этапы: пользователь не подписан, доступен,
+    зарегистрирован не раньше окна REMINDER_LOOKBACK и для какого-то
+    этапа прошел интервал, а флаг этого этапа еще не выставлен.
+
+    Args:
+        after: (created_at, id) последнего пользователя предыдущей пачки
+    """
+    due_conditions = [
+        and_(
+            User.created_at <= now - timedelta(seconds=REMINDER_INTERVALS[reminder_type]),
+            _reminder_flag(reminder_type) == False
+        )
+        for reminder_type in REMINDER_STAGES
+    ]
+
+    query = select(
+        User.id, User.user_id, User.chat_id, User.created_at, User.first_name, User.username
+    ).where(
+        User.subscribed == False,
+        # Совпадает с условием частичного индекса ix_users_reminders_pending
+        REMINDERS_PENDING,
+        User.reachability == REACHABLE,
+        User.created_at >= now - timedelta(seconds=REMINDER_LOOKBACK),
+        or_(*due_conditions)
+    )
+    if after is not None:
+        query = query.where(tuple_(User.created_at, User.id) > after)
+
+    async with get_async_db() as db:
+        result = await db.execute(query.order_by(User.created_at, User.id).limit(limit))
+        return result.all()
+
+
+def _due_stage(created_at: datetime, now: datetime) -> int:
+    """Индекс самого позднего наступившего этапа напоминаний"""
+    stage = -1
+    for index, reminder_type in enumerate(REMINDER_STAGES):
+        if created_at <= now - timedelta(seconds=REMINDER_INTERVALS[reminder_type]):
+            stage = index
+    return stage
+
+
+async def _save_reminder_results(stages: dict, unreachable: dict):
+    """
+    Отметить отправленные напоминания одним UPDATE
+
+    Args:
+        stages: {users.id: индекс отправленного этапа}; более ранние этапы
+            тоже отмечаются, чтобы пользователь не получил их после позднего
+        unreachable: {состояние доступности: [users.id]}
+    """
+    async with get_async_db() as db:
+        if stages:
+            values = {}
+            for index, reminder_type in enumerate(REMINDER_STAGES):
+                ids = [user_pk for user_pk, stage in stages.items() if stage >= index]
+                if ids:
+                    flag = _reminder_flag(reminder_type)
+                    values[flag.key] = case((User.id.in_(ids), True), else_=flag)
+            await db.execute(
+                update(User).where(User.id.in_(list(stages))).values(**values),
+                execution_options={'synchronize_session': False}
+            )
+
+        for state, ids in unreachable.items():
+            await db.execute(
+                update(User).where(User.id.in_(ids), User.reachability == REACHABLE).values(
+                    reachability=state,
+                    unreachable_since=datetime.utcnow()
+                ),
+                execution_options={'synchronize_session': False}
+            )
+
+        await db.commit()
+
+
+async def _send_reminder(bot, user, text: str, now: datetime = None):
+    """Отправка одного напоминания через общий ограничитель (с подстановками данных пользователя)"""
+    await get_rate_limiter().call(
+        bot.send_message,
+        chat_id=user.chat_id,
+        text=compile_template(text).render(user._mapping, now),
+        reply_markup=SUBSCRIBE_KEYBOARD,
+        parse_mode='HTML'
+    )
+
+
+async def _process_batch(bot, users: list, texts: dict, now: datetime) -> int:
+    """
+    Отправить напоминания пачке пользователей и сохранить результат
+
+    Returns:
+        int: Количество отправленных напоминаний
+    """
+    sent_stages = {}
+    unreachable = defaultdict(list)
+
+    async def send(user):
+        stage = _due_stage(user.created_at, now)
+        reminder_type = REMINDER_STAGES[stage]
+        text = texts.get(reminder_type)
+        if not text:
             logger.error(f"Текст напоминания {reminder_type} не найден в базе данных")
             return
-        
-        # Создаем кнопку
-        keyboard = [[InlineKeyboardButton("ОК 🔥", callback_data="subscribe")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Отправляем напоминание
         try:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=reminder_text_obj.text,
-                reply_markup=reply_markup,
-                parse_mode='HTML'
-            )
-            
-            # Отмечаем, что напоминание отправлено
-            setattr(user, reminder_field, True)
-            db.commit()
-            
-            logger.info(f"Напоминание {reminder_type} отправлено пользователю {user_id}")
-            
+            await _send_reminder(bot, user, text, now)
+            sent_stages[user.id] = stage
+        except TelegramError as e:
+            state = classify_send_error(e)
+            if state in PERMANENT_FAILURES:
+                unreachable[state].append(user.id)
+            logger.warning(f"Ошибка при отправке напоминания {reminder_type} пользователю {user.user_id}: {e}")
         except Exception as e:
-            logger.error(f"Ошибка при отправке напоминания пользователю {user_id}: {e}")
-            
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Ошибка при обработке напоминания: {e}")
-    finally:
-        db.close()
-
-
-async def schedule_reminders(context: ContextTypes.DEFAULT_TYPE, user_id: int, chat_id: int):
-    """Планирование напоминаний для пользователя"""
-    try:
-        # Планируем напоминания на разные интервалы
-        for reminder_type, interval in REMINDER_INTERVALS.items():
-            job_name = f"reminder_{user_id}_{reminder_type}"
-            
-            # Удаляем существующую задачу, если она есть
-            current_jobs = context.job_queue.get_jobs_by_name(job_name)
-            for job in current_jobs:
-                job.schedule_removal()
-            
-            # Планируем новую задачу
-            context.job_queue.run_once(
-                callback=lambda ctx, uid=user_id, cid=chat_id, rt=reminder_type: 
-                    send_reminder(ctx, uid, cid, rt),
-                when=interval,
-                name=job_name,
-                user_id=user_id
-            )
-            
-            logger.info(f"Запланировано напоминание {reminder_type} для пользователя {user_id} через {interval} секунд")
-            
-    except Exception as e:
-        logger.error(f"Ошибка при планировании напоминаний: {e}")
-
-
-async def cancel_reminders(context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    """Отмена всех напоминаний для пользователя"""
-    try:
-        # Отменяем все запланированные напоминания
-        for reminder_type in REMINDER_INTERVALS.keys():
-            job_name = f"reminder_{user_id}_{reminder_type}"
-            current_jobs = context.job_queue.get_jobs_by_name(job_name)
-            
-            for job in current_jobs:
-                job.schedule_removal()
-                logger.info(f"Отменено напоминание {job_name}")
-                
-    except Exception as e:
-        logger.error(f"Ошибка при отмене напоминаний: {e}")
+            logger.error(f"Ошибка при отправке напоминания пользователю {user.user_id}: {e}")
+
+    await asyncio.gather(*(send(user) for user in users))
+    await _save_reminder_results(sent_stages, unreachable)
+    if sent_stages:
+        invalidate_user_statistics()
+    return len(sent_stages)
+
+
+async def sweep_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Периодическая задача: отправка всех наступивших напоминаний
+
+    Пользователи выбираются пачками одним запросом к базе, напоминания
+    отправляются параллельно через общий ограничитель скорости, а флаги
+    выставляются одним UPDATE на пачку. Состояние хранится только в базе,
+    поэтому перезапуск бота напоминания не теряет.
+    """
+    if _sweep_lock.locked():
+        return
+
+    async with _sweep_lock:
+        try:
+            now = datetime.utcnow()
+            texts = get_settings().reminder_texts
+            total_sent = 0
+            after = None
+
+            while True:
+                users = await _fetch_due_users(now, REMINDER_BATCH_SIZE, after)
+                if not users:
+                    break
+                total_sent += await _process_batch(context.bot, users, texts, now)
+                if len(users) < REMINDER_BATCH_SIZE:
+                    break
+                # Пользователи с временной ошибкой будут повторены на следующем проходе
+                after = (users[-1].created_at, users[-1].id)
+
+            if total_sent:
+                logger.info(f"Отправлено напоминаний: {total_sent}")
+
+        except Exception as e:
+            logger.error(f"Ошибка при обработке напоминаний: {e}")
+
+
+def setup_reminder_sweeper(application: Application):
+    """Запуск периодической отправки напоминаний (если включена в config.py)"""
+    if not REMINDERS_ENABLED:
+        logger.info("Напоминания отключены (REMINDERS_ENABLED)")
+        return
 
+    if application.job_queue is None:
+        logger.error("JobQueue недоступна: установите python-telegram-bot[job-queue]")
+        return
 
+    application.job_queue.run_repeating(
+        sweep_reminders,
+        interval=REMINDER_SWEEP_INTERVAL,
+        first=REMINDER_SWEEP_INTERVAL,
+        name="reminder_sweeper"
+    )
+    logger.info(f"Напоминания включены, проверка каждые {REMINDER_SWEEP_INTERVAL} сек")
@@ -0,0 +1,128 @@
+"""
+Кэш текстов напоминаний (ReminderText) и настроек бота (BotSettings)
+
+Строки меняются только из админ-панели, поэтому читаются один раз при
+запуске и держатся в памяти. После сохранения в админ-панели кэш
+перечитывается; если запущено несколько экземпляров бота, остальные
+узнают об изменении через PostgreSQL LISTEN/NOTIFY.
+"""
+import asyncio
+import logging
+from types import MappingProxyType
+from typing import Optional
+from sqlalchemy import select, text
+from database import get_db, get_async_db, async_engine, ReminderText, BotSettings
+from config import SETTINGS_NOTIFY_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+
+class Settings:
+    """Неизменяемый снимок текстов напоминаний и настроек бота"""
+
+    __slots__ = ('reminder_texts', 'values')
+
+    def __init__(self, reminder_texts: dict, values: dict):
+        self.reminder_texts = MappingProxyType(dict(reminder_texts))
+        self.values = MappingProxyType(dict(values))
+
+    def reminder_text(self, reminder_type: str) -> Optional[str]:
+        """Текст напоминания или None, если его нет"""
+        return self.reminder_texts.get(reminder_type)
+
+    def setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """Значение настройки BotSettings"""
+        value = self.values.get(key)
+        return value if value is not None else default
+
+    @property
+    def channel_invite_link(self) -> Optional[str]:
+        return self.setting('channel_invite_link') or None
+
+
+_settings = Settings({}, {})
+_listener = None
+_reload_tasks = set()
+
+
+def get_settings() -> Settings:
+    """Текущий снимок настроек (без обращения к базе)"""
+    return _settings
+
+
+def load_settings():
+    """Загрузить настройки из базы (синхронно, при инициализации базы)"""
+    global _settings
+    db = get_db()
+    try:
+        reminder_texts = {row.reminder_type: row.text for row in db.query(ReminderText.reminder_type, ReminderText.text)}
+        values = {row.setting_key: row.setting_value for row in db.query(BotSettings.setting_key, BotSettings.setting_value)}
+    finally:
+        db.close()
+    _settings = Settings(reminder_texts, values)
+    logger.info(f"Загружены тексты напоминаний ({len(reminder_texts)}) и настройки ({len(values)})")
+
+
+async def reload_settings():
+    """Перечитать настройки из базы"""
+    global _settings
+    async with get_async_db() as db:
+        reminder_result = await db.execute(select(ReminderText.reminder_type, ReminderText.text))
+        settings_result = await db.execute(select(BotSettings.setting_key, BotSettings.setting_value))
+        reminder_texts = {row.reminder_type: row.text for row in reminder_result}
+        values = {row.setting_key: row.setting_value for row in settings_result}
+    _settings = Settings(reminder_texts, values)
+    logger.info("Кэш текстов и настроек обновлен")
+
+
+def notify_settings_changed(db):
+    """
+    Оповестить другие экземпляры бота об изменении настроек
+
+    Вызывается до commit в той же сессии: PostgreSQL доставит уведомление
+    только если транзакция будет зафиксирована.
+    """
+    if db.get_bind().dialect.name == 'postgresql':
+        db.execute(text("SELECT pg_notify(:channel, '')"), {'channel': SETTINGS_NOTIFY_CHANNEL})
+
+
+async def start_settings_listener():
+    """Подписаться на уведомления об изменении настроек (только PostgreSQL)"""
+    global _listener
+    if async_engine.dialect.name != 'postgresql' or _listener is not None:
+        return
+
+    loop = asyncio.get_running_loop()
+
+    def on_notify(connection, pid, channel, payload):
+        task = loop.create_task(_reload_logged())
+        _reload_tasks.add(task)
+        task.add_done_callback(_reload_tasks.discard)
+
+    connection = await async_engine.connect()
+    try:
+        raw_connection = await connection.get_raw_connection()
+        # Соединение asyncpg держится открытым все время работы бота
+        await raw_connection.driver_connection.add_listener(SETTINGS_NOTIFY_CHANNEL, on_notify)
+    except Exception:
+        await connection.close()
+        raise
+    _listener = connection
+    logger.info(f"Подписка на изменения настроек: LISTEN {SETTINGS_NOTIFY_CHANNEL}")
+
+
+async def stop_settings_listener():
+    """Отписаться от уведомлений при остановке бота"""
+    global _listener
+    if _listener is not None:
+        # Соединение с подпиской не возвращается в пул, а закрывается
+        await _listener.invalidate()
+        await _listener.close()
+        _listener = None
+
+
+async def _reload_logged():
+    try:
+        await reload_settings()
+    except Exception as e:
+        logger.error(f"Не удалось обновить кэш настроек: {e}")
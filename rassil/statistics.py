@@ -1,14 +1,73 @@
 """
 Модуль статистики
 """
+import asyncio
+import csv
+import gzip
 import logging
 from datetime import datetime, timedelta
-from database import get_db, User
-import pandas as pd
+from itertools import islice
+from sqlalchemy import func
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
+from database import get_db, iter_user_rows, User
+from config import RECIPIENT_PAGE_SIZE, REMINDER_INTERVALS, EXPORT_WIDTH_SAMPLE
+from cache import statistics_cache, MISSING
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+# Колонки для детальной статистики и выгрузки
+DETAILED_STATISTICS_COLUMNS = (
+    User.user_id, User.username, User.first_name, User.last_name,
+    User.subscribed, User.subscription_date, User.created_at,
+    User.reminder_3min_sent, User.reminder_10min_sent,
+    User.reminder_30min_sent, User.reminder_9hours_sent
+)
+
+
+def _fetch_user_aggregates() -> dict:
+    """
+    Все агрегаты по пользователям за один проход по таблице
+    
+    Вместо отдельного COUNT на каждый показатель используется
+    COUNT(*) FILTER (WHERE ...) в одном запросе.
+    """
+    today = datetime.utcnow().date()
+    today_start = datetime.combine(today, datetime.min.time())
+    week_start = datetime.combine(today - timedelta(days=7), datetime.min.time())
+    month_start = datetime.combine(today - timedelta(days=30), datetime.min.time())
+    subscribed = User.subscribed == True
+    
+    columns = [
+        func.count().label('total_users'),
+        func.count().filter(subscribed).label('subscribed_users'),
+        func.count().filter(User.created_at >= today_start).label('today_users'),
+        func.count().filter(User.created_at >= week_start).label('week_users'),
+        func.count().filter(User.created_at >= month_start).label('month_users'),
+        func.max(User.created_at).label('last_created_at'),
+    ]
+    for reminder_type in REMINDER_INTERVALS:
+        flag = getattr(User, f"{reminder_type}_sent")
+        suffix = reminder_type.replace('reminder_', '')
+        columns.append(func.count().filter(flag == True).label(f"{reminder_type}_sent"))
+        columns.append(func.count().filter(flag == True, subscribed).label(f"subscribed_after_{suffix}"))
+    
+    db = get_db()
+    try:
+        return dict(db.query(*columns).one()._mapping)
+    finally:
+        db.close()
+
+
+async def _get_user_aggregates() -> dict:
+    """Агрегаты по пользователям из кэша или из базы данных"""
+    aggregates = statistics_cache.get('users')
+    if aggregates is MISSING:
+        aggregates = await asyncio.to_thread(_fetch_user_aggregates)
+        statistics_cache.set('users', aggregates)
+    return aggregates
+
 
 async def get_statistics():
     """
@@ -17,47 +76,31 @@ async def get_statistics():
     Returns:
         dict: Словарь со статистическими данными
     """
-    db = get_db()
     try:
+        aggregates = await _get_user_aggregates()
+        
         # Общее количество пользователей
-        total_users = db.query(User).count()
+        total_users = aggregates['total_users']
         
         # Подписанные/неподписанные
-        subscribed_users = db.query(User).filter_by(subscribed=True).count()
+        subscribed_users = aggregates['subscribed_users']
         unsubscribed_users = total_users - subscribed_users
         
         # Процент подписки
         subscription_rate = (subscribed_users / total_users * 100) if total_users > 0 else 0
         
-        # Статистика по датам
-        today = datetime.utcnow().date()
-        week_ago = today - timedelta(days=7)
-        month_ago = today - timedelta(days=30)
-        
-        today_users = db.query(User).filter(
-            User.created_at >= datetime.combine(today, datetime.min.time())
-        ).count()
-        
-        week_users = db.query(User).filter(
-            User.created_at >= datetime.combine(week_ago, datetime.min.time())
-        ).count()
-        
-        month_users = db.query(User).filter(
-            User.created_at >= datetime.combine(month_ago, datetime.min.time())
-        ).count()
-        
         # Последняя активность
-        last_user = db.query(User).order_by(User.created_at.desc()).first()
-        last_activity = last_user.created_at.strftime("%d.%m.%Y %H:%M") if last_user else "Нет данных"
+        last_created_at = aggregates['last_created_at']
+        last_activity = last_created_at.strftime("%d.%m.%Y %H:%M") if last_created_at else "Нет данных"
         
         stats = {
             'total_users': total_users,
             'subscribed_users': subscribed_users,
             'unsubscribed_users': unsubscribed_users,
             'subscription_rate': subscription_rate,
-            'today_users': today_users,
-            'week_users': week_users,
-            'month_users': month_users,
+            'today_users': aggregates['today_users'],
+            'week_users': aggregates['week_users'],
+            'month_users': aggregates['month_users'],
             'last_activity': last_activity
         }
         
@@ -76,8 +119,37 @@ async def get_statistics():
             'month_users': 0,
             'last_activity': 'Ошибка'
         }
-    finally:
-        db.close()
+
+
+def _format_user_row(user) -> dict:
+    """Строка детальной статистики для одного пользователя"""
+    return {
+        'user_id': user.user_id,
+        'username': user.username or 'Не указано',
+        'first_name': user.first_name or 'Не указано',
+        'last_name': user.last_name or 'Не указано',
+        'subscribed': 'Да' if user.subscribed else 'Нет',
+        'subscription_date': user.subscription_date.strftime("%d.%m.%Y %H:%M") if user.subscription_date else 'Не подписан',
+        'created_at': user.created_at.strftime("%d.%m.%Y %H:%M"),
+        'reminder_3min_sent': 'Да' if user.reminder_3min_sent else 'Нет',
+        'reminder_10min_sent': 'Да' if user.reminder_10min_sent else 'Нет',
+        'reminder_30min_sent': 'Да' if user.reminder_30min_sent else 'Нет',
+        'reminder_9hours_sent': 'Да' if user.reminder_9hours_sent else 'Нет'
+    }
+
+
+def iter_detailed_statistics(page_size: int = RECIPIENT_PAGE_SIZE):
+    """
+    Построчный обход детальной статистики
+    
+    Пользователи читаются страницами и только нужными колонками.
+    Порядок по убыванию id совпадает с порядком регистрации (created_at desc).
+    
+    Yields:
+        dict: Данные одного пользователя
+    """
+    for user in iter_user_rows(DETAILED_STATISTICS_COLUMNS, page_size=page_size, descending=True):
+        yield _format_user_row(user)
 
 
 async def get_detailed_statistics():
@@ -87,25 +159,8 @@ async def get_detailed_statistics():
     Returns:
         list: Список пользователей с их данными
     """
-    db = get_db()
     try:
-        users = db.query(User).order_by(User.created_at.desc()).all()
-        
-        user_data = []
-        for user in users:
-            user_data.append({
-                'user_id': user.user_id,
-                'username': user.username or 'Не указано',
-                'first_name': user.first_name or 'Не указано',
-                'last_name': user.last_name or 'Не указано',
-                'subscribed': 'Да' if user.subscribed else 'Нет',
-                'subscription_date': user.subscription_date.strftime("%d.%m.%Y %H:%M") if user.subscription_date else 'Не подписан',
-                'created_at': user.created_at.strftime("%d.%m.%Y %H:%M"),
-                'reminder_3min_sent': 'Да' if user.reminder_3min_sent else 'Нет',
-                'reminder_10min_sent': 'Да' if user.reminder_10min_sent else 'Нет',
-                'reminder_30min_sent': 'Да' if user.reminder_30min_sent else 'Нет',
-                'reminder_9hours_sent': 'Да' if user.reminder_9hours_sent else 'Нет'
-            })
+        user_data = list(iter_detailed_statistics())
         
         logger.info(f"Получена детальная статистика по {len(user_data)} пользователям")
         return user_data
@@ -113,88 +168,153 @@ async def get_detailed_statistics():
     except Exception as e:
         logger.error(f"Ошибка при получении детальной статистики: {e}")
         return []
-    finally:
-        db.close()
+
+
+# Заголовки колонок выгрузки (в порядке полей iter_detailed_statistics)
+EXPORT_HEADERS = [
+    'ID пользователя',
+    'Username',
+    'Имя',
+    'Фамилия',
+    'Подписан',
+    'Дата подписки',
+    'Дата регистрации',
+    'Напоминание 3 мин',
+    'Напоминание 10 мин',
+    'Напоминание 30 мин',
+    'Напоминание 9 часов'
+]
+
+
+def _export_filepath(extension: str) -> Path:
+    """Путь к новому файлу выгрузки"""
+    # Создаем папку для экспорта, если её нет
+    export_dir = Path("exports")
+    export_dir.mkdir(exist_ok=True)
+    
+    # Создаем имя файла с текущей датой
+    filename = f"statistics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+    return export_dir / filename
+
+
+def _general_statistics_rows(general_stats: dict) -> list:
+    """Строки листа с общей статистикой"""
+    return [
+        ['Всего пользователей', general_stats['total_users']],
+        ['Подписанных', general_stats['subscribed_users']],
+        ['Не подписанных', general_stats['unsubscribed_users']],
+        ['Процент подписки', f"{general_stats['subscription_rate']:.1f}%"],
+        ['Новых за сегодня', general_stats['today_users']],
+        ['Новых за неделю', general_stats['week_users']],
+        ['Новых за месяц', general_stats['month_users']],
+        ['Последняя активность', general_stats['last_activity']]
+    ]
+
+
+def _column_widths(rows: list) -> list:
+    """Ширина колонок по самому длинному значению (не более 50 символов)"""
+    widths = [0] * len(rows[0])
+    for row in rows:
+        for index, value in enumerate(row):
+            widths[index] = max(widths[index], len(str(value)))
+    return [min(width + 2, 50) for width in widths]
+
+
+def _add_sheet(workbook, title: str, header: list, rows):
+    """
+    Записать лист в write-only книгу
+    
+    Ширина колонок считается по первым EXPORT_WIDTH_SAMPLE строкам:
+    в write-only режиме ее нужно задать до записи строк.
+    """
+    rows = iter(rows)
+    sample = list(islice(rows, EXPORT_WIDTH_SAMPLE))
+    
+    worksheet = workbook.create_sheet(title)
+    for index, width in enumerate(_column_widths([header] + sample), start=1):
+        worksheet.column_dimensions[get_column_letter(index)].width = width
+    
+    worksheet.append(header)
+    for row in sample:
+        worksheet.append(row)
+    count = len(sample)
+    for row in rows:
+        worksheet.append(row)
+        count += 1
+    return count
+
+
+def _write_excel(filepath: Path, general_stats: dict) -> int:
+    """Потоковая запись выгрузки в Excel (выполняется в отдельном потоке)"""
+    workbook = Workbook(write_only=True)
+    user_rows = (list(row.values()) for row in iter_detailed_statistics())
+    count = _add_sheet(workbook, 'Пользователи', EXPORT_HEADERS, user_rows)
+    _add_sheet(workbook, 'Общая статистика', ['Показатель', 'Значение'], _general_statistics_rows(general_stats))
+    workbook.save(filepath)
+    return count
+
+
+def _write_csv_gz(filepath: Path) -> int:
+    """Потоковая запись выгрузки в сжатый CSV (выполняется в отдельном потоке)"""
+    count = 0
+    with gzip.open(filepath, 'wt', encoding='utf-8-sig', newline='') as file:
+        writer = csv.writer(file, delimiter=';')
+        writer.writerow(EXPORT_HEADERS)
+        for row in iter_detailed_statistics():
+            writer.writerow(row.values())
+            count += 1
+    return count
 
 
 async def export_statistics_excel():
     """
     Экспорт статистики в Excel файл
     
+    Строки читаются из базы страницами и сразу пишутся в write-only книгу,
+    поэтому память не растет с количеством пользователей. Запись идет в
+    отдельном потоке и не блокирует обработку обновлений.
+    
     Returns:
         str: Путь к созданному файлу или None в случае ошибки
     """
     try:
-        # Получаем детальную статистику
-        user_data = await get_detailed_statistics()
+        # Получаем общую статистику
+        general_stats = await get_statistics()
         
-        if not user_data:
+        if not general_stats['total_users']:
             logger.warning("Нет данных для экспорта")
             return None
         
-        # Создаем DataFrame
-        df = pd.DataFrame(user_data)
-        
-        # Переименовываем колонки на русский
-        df.columns = [
-            'ID пользователя',
-            'Username',
-            'Имя',
-            'Фамилия',
-            'Подписан',
-            'Дата подписки',
-            'Дата регистрации',
-            'Напоминание 3 мин',
-            'Напоминание 10 мин',
-            'Напоминание 30 мин',
-            'Напоминание 9 часов'
-        ]
+        filepath = _export_filepath('xlsx')
+        count = await asyncio.to_thread(_write_excel, filepath, general_stats)
         
-        # Создаем папку для экспорта, если её нет
-        export_dir = Path("exports")
-        export_dir.mkdir(exist_ok=True)
+        logger.info(f"Статистика по {count} пользователям экспортирована в файл: {filepath}")
+        return str(filepath)
         
-        # Создаем имя файла с текущей датой
-        filename = f"statistics_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        filepath = export_dir / filename
+    except Exception as e:
+        logger.error(f"Ошибка при экспорте статистики: {e}")
+        return None
+
+
+async def export_statistics_csv():
+    """
+    Экспорт статистики в сжатый CSV файл (csv.gz)
+    
+    Самый быстрый и компактный формат для больших баз пользователей.
+    
+    Returns:
+        str: Путь к созданному файлу или None в случае ошибки
+    """
+    try:
+        filepath = _export_filepath('csv.gz')
+        count = await asyncio.to_thread(_write_csv_gz, filepath)
         
-        # Сохраняем в Excel
-        with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Пользователи', index=False)
-            
-            # Получаем общую статистику
-            general_stats = await get_statistics()
-            
-            # Создаем DataFrame с общей статистикой
-            stats_df = pd.DataFrame([
-                ['Всего пользователей', general_stats['total_users']],
-                ['Подписанных', general_stats['subscribed_users']],
-                ['Не подписанных', general_stats['unsubscribed_users']],
-                ['Процент подписки', f"{general_stats['subscription_rate']:.1f}%"],
-                ['Новых за сегодня', general_stats['today_users']],
-                ['Новых за неделю', general_stats['week_users']],
-                ['Новых за месяц', general_stats['month_users']],
-                ['Последняя активность', general_stats['last_activity']]
-            ], columns=['Показатель', 'Значение'])
-            
-            stats_df.to_excel(writer, sheet_name='Общая статистика', index=False)
-            
-            # Автоматическая настройка ширины колонок
-            for sheet_name in writer.sheets:
-                worksheet = writer.sheets[sheet_name]
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    for cell in column:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = min(max_length + 2, 50)
-                    worksheet.column_dimensions[column_letter].width = adjusted_width
+        if not count:
+            logger.warning("Нет данных для экспорта")
+            filepath.unlink(missing_ok=True)
+            return None
         
-        logger.info(f"Статистика экспортирована в файл: {filepath}")
+        logger.info(f"Статистика по {count} пользователям экспортирована в файл: {filepath}")
         return str(filepath)
         
     except Exception as e:
@@ -209,58 +329,22 @@ async def get_subscription_statistics():
     Returns:
         dict: Статистика по подпискам
     """
-    db = get_db()
     try:
-        # Статистика по напоминаниям
-        total_users = db.query(User).count()
+        aggregates = await _get_user_aggregates()
         
-        reminder_3min_sent = db.query(User).filter_by(reminder_3min_sent=True).count()
-        reminder_10min_sent = db.query(User).filter_by(reminder_10min_sent=True).count()
-        reminder_30min_sent = db.query(User).filter_by(reminder_30min_sent=True).count()
-        reminder_9hours_sent = db.query(User).filter_by(reminder_9hours_sent=True).count()
+        stats = {'total_users': aggregates['total_users']}
         
-        # Конверсия после каждого напоминания
-        subscribed_after_3min = db.query(User).filter(
-            User.reminder_3min_sent == True,
-            User.subscribed == True
-        ).count()
-        
-        subscribed_after_10min = db.query(User).filter(
-            User.reminder_10min_sent == True,
-            User.subscribed == True
-        ).count()
-        
-        subscribed_after_30min = db.query(User).filter(
-            User.reminder_30min_sent == True,
-            User.subscribed == True
-        ).count()
-        
-        subscribed_after_9hours = db.query(User).filter(
-            User.reminder_9hours_sent == True,
-            User.subscribed == True
-        ).count()
+        # Статистика по напоминаниям
+        for reminder_type in REMINDER_INTERVALS:
+            stats[f"{reminder_type}_sent"] = aggregates[f"{reminder_type}_sent"]
         
-        stats = {
-            'total_users': total_users,
-            'reminder_3min_sent': reminder_3min_sent,
-            'reminder_10min_sent': reminder_10min_sent,
-            'reminder_30min_sent': reminder_30min_sent,
-            'reminder_9hours_sent': reminder_9hours_sent,
-            'subscribed_after_3min': subscribed_after_3min,
-            'subscribed_after_10min': subscribed_after_10min,
-            'subscribed_after_30min': subscribed_after_30min,
-            'subscribed_after_9hours': subscribed_after_9hours
-        }
+        # Конверсия после каждого напоминания
+        for reminder_type in REMINDER_INTERVALS:
+            suffix = reminder_type.replace('reminder_', '')
+            stats[f"subscribed_after_{suffix}"] = aggregates[f"subscribed_after_{suffix}"]
         
         return stats
         
     except Exception as e:
         logger.error(f"Ошибка при получении статистики подписок: {e}")
         return {}
-    finally:
-        db.close()
-
-
-
-
-
@@ -6,7 +6,9 @@ from datetime import datetime
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from telegram.error import TelegramError, BadRequest
-from database import get_db, User, BotSettings
+from database import get_db, User
+from cache import invalidate_user_statistics
+from settings_cache import get_settings
 from config import CHANNEL_ID, SUCCESS_MESSAGE_WITH_LINK, SUCCESS_MESSAGE_NO_LINK, ALREADY_SUBSCRIBED_MESSAGE
 
 logger = logging.getLogger(__name__)
@@ -38,18 +40,18 @@ async def subscribe_user(context: ContextTypes.DEFAULT_TYPE, user_id: int):
             return True, ALREADY_SUBSCRIBED_MESSAGE, None
         
         try:
-            # Проверяем, есть ли сохраненная инвайт-ссылка в настройках
-            invite_link_setting = db.query(BotSettings).filter_by(setting_key='channel_invite_link').first()
+            # Проверяем, есть ли сохраненная инвайт-ссылка в настройках (из кэша, без запроса к базе)
+            invite_link_url = get_settings().channel_invite_link
             
-            if invite_link_setting and invite_link_setting.setting_value:
+            if invite_link_url:
                 # Используем сохраненную ссылку
-                invite_link_url = invite_link_setting.setting_value
                 logger.info(f"Используется сохраненная инвайт-ссылка для пользователя {user_id}")
                 
                 # Помечаем пользователя как подписанного
                 user.subscribed = True
                 user.subscription_date = datetime.utcnow()
                 db.commit()
+                invalidate_user_statistics()
                 
                 # Текст сообщения
                 success_message = """✅ <b>Отлично!</b>
@@ -84,6 +86,7 @@ async def subscribe_user(context: ContextTypes.DEFAULT_TYPE, user_id: int):
                     user.subscribed = True
                     user.subscription_date = datetime.utcnow()
                     db.commit()
+                    invalidate_user_statistics()
                     
                     logger.info(f"Создана инвайт-ссылка для пользователя {user_id}")
                     
@@ -108,6 +111,7 @@ async def subscribe_user(context: ContextTypes.DEFAULT_TYPE, user_id: int):
                         user.subscribed = True
                         user.subscription_date = datetime.utcnow()
                         db.commit()
+                        invalidate_user_statistics()
                         
                         return True, SUCCESS_MESSAGE_NO_LINK, None
                     else:
@@ -121,6 +125,7 @@ async def subscribe_user(context: ContextTypes.DEFAULT_TYPE, user_id: int):
             user.subscribed = True
             user.subscription_date = datetime.utcnow()
             db.commit()
+            invalidate_user_statistics()
             
             return True, SUCCESS_MESSAGE_NO_LINK, None
             
@@ -177,6 +182,7 @@ async def unsubscribe_user(user_id: int):
             user.subscribed = False
             user.subscription_date = None
             db.commit()
+            invalidate_user_statistics()
             logger.info(f"Пользователь {user_id} отписан")
             return True
         else:
@@ -0,0 +1,69 @@
+"""
+Параллельная обработка обновлений с сохранением порядка для каждого пользователя
+"""
+import asyncio
+import logging
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+def _ordering_key(update: object):
+    """Ключ, внутри которого обновления обрабатываются строго по порядку"""
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обработчик обновлений: разные пользователи параллельно, один пользователь - по порядку
+
+    Обновления одного пользователя выполняются последовательно (от этого
+    зависят ConversationHandler админ-панели), поэтому медленная выгрузка
+    статистики у администратора не задерживает /start остальных.
+
+    max_concurrent_updates базового класса ограничивает число принятых,
+    но еще не обработанных обновлений; число одновременно выполняемых
+    ограничивает concurrency. Так обновления, ждущие своей очереди у одного
+    пользователя, не занимают места выполняемых обновлений других.
+    """
+
+    __slots__ = ("_running", "_locks")
+
+    def __init__(self, concurrency: int, max_pending: int):
+        super().__init__(max(max_pending, concurrency))
+        self._running = asyncio.BoundedSemaphore(concurrency)
+        # {ключ: [блокировка, количество ожидающих]}
+        self._locks = {}
+
+    async def do_process_update(self, update: object, coroutine):
+        key = _ordering_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # Блокировка выдается в порядке ожидания, то есть в порядке поступления обновлений
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def initialize(self):
+        """Ресурсы не нужны"""
+
+    async def shutdown(self):
+        """Ресурсы не нужны"""
@@ -0,0 +1,138 @@
+"""
+Пакетное сохранение пользователей из /start и заявок на вступление
+"""
+import asyncio
+import logging
+from datetime import datetime
+from database import get_async_db, upsert_insert, User
+from reachability import REACHABLE
+from cache import invalidate_user_statistics
+from config import USER_UPSERT_DELAY_MS, USER_UPSERT_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Колонки, которые обновляются у уже существующего пользователя
+_UPDATED_COLUMNS = ('chat_id', 'username', 'first_name', 'last_name', 'reachability', 'unreachable_since')
+
+
+class UserUpsertBuffer:
+    """
+    Буфер сохранения пользователей
+
+    Заявки копятся несколько миллисекунд и сохраняются одним запросом
+    INSERT ... ON CONFLICT (user_id) DO UPDATE. Вызывающий ждет, пока
+    сохранится именно его строка, и получает ошибку, если запрос не прошел.
+    Повторные данные одного пользователя внутри пачки объединяются
+    (побеждают последние).
+    """
+
+    def __init__(self, delay: float, batch_size: int):
+        self.delay = delay
+        self.batch_size = batch_size
+        self._pending = {}
+        self._waiters = {}
+        self._timer = None
+        self._flush_lock = asyncio.Lock()
+        self._tasks = set()
+
+    async def upsert(self, user_id: int, chat_id: int, username: str = None,
+                     first_name: str = None, last_name: str = None):
+        """
+        Создать или обновить пользователя
+
+        Новый пользователь сохраняется неподписанным; у существующего
+        обновляются контакты, а чат снова считается доступным.
+        """
+        self._pending[user_id] = {
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'username': username,
+            'first_name': first_name,
+            'last_name': last_name,
+            'subscribed': False,
+            'created_at': datetime.utcnow(),
+            # Пользователь снова вышел на связь - чат снова доступен для рассылок
+            'reachability': REACHABLE,
+            'unreachable_since': None,
+        }
+        waiter = self._waiters.get(user_id)
+        if waiter is None:
+            waiter = self._waiters[user_id] = asyncio.get_running_loop().create_future()
+
+        if len(self._pending) >= self.batch_size:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.delay)
+
+        # shield: отмена обработчика не должна отменять сохранение чужих строк
+        await asyncio.shield(waiter)
+
+    def _schedule(self, delay: float):
+        if self._timer is not None and delay > 0:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        task = asyncio.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Сохранить накопленных пользователей"""
+        async with self._flush_lock:
+            self._timer = None
+            if not self._pending:
+                return
+            rows, self._pending = list(self._pending.values()), {}
+            waiters, self._waiters = self._waiters, {}
+
+            try:
+                for start in range(0, len(rows), self.batch_size):
+                    await _upsert_rows(rows[start:start + self.batch_size])
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении пачки пользователей ({len(rows)}): {e}")
+                for waiter in waiters.values():
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                return
+
+            invalidate_user_statistics()
+            for waiter in waiters.values():
+                if not waiter.done():
+                    waiter.set_result(None)
+            logger.debug(f"Сохранена пачка пользователей: {len(rows)}")
+
+            # Пока шло сохранение, могли накопиться новые пользователи
+            if self._pending and self._timer is None:
+                self._schedule(self.delay)
+
+
+async def _upsert_rows(rows: list):
+    """Один INSERT ... ON CONFLICT (user_id) DO UPDATE на пачку строк"""
+    statement = upsert_insert(User).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_={column: statement.excluded[column] for column in _UPDATED_COLUMNS}
+    )
+    async with get_async_db() as db:
+        await db.execute(statement)
+        await db.commit()
+
+
+_buffer = None
+
+
+def get_user_buffer() -> UserUpsertBuffer:
+    """Получить общий буфер сохранения пользователей"""
+    global _buffer
+    if _buffer is None:
+        _buffer = UserUpsertBuffer(USER_UPSERT_DELAY_MS / 1000, USER_UPSERT_BATCH_SIZE)
+    return _buffer
+
+
+async def upsert_user(user_id: int, chat_id: int, username: str = None,
+                      first_name: str = None, last_name: str = None):
+    """Сохранить пользователя через общий буфер (ждет сохранения своей строки)"""
+    await get_user_buffer().upsert(user_id, chat_id, username, first_name, last_name)
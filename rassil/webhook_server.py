@@ -0,0 +1,157 @@
+"""
+Прием обновлений через webhook (встроенный HTTP-сервер на aiohttp)
+
+Локальная проверка без регистрации webhook в Telegram (WEBHOOK_URL пустой):
+
+    curl -X POST http://127.0.0.1:8443/telegram \\
+         -H 'Content-Type: application/json' \\
+         -H 'X-Telegram-Bot-Api-Secret-Token: <WEBHOOK_SECRET_TOKEN>' \\
+         -d '{"update_id": 1, "message": {...}}'
+"""
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+from config import (
+    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_CONNECTIONS, WEBHOOK_MAX_PENDING, ALLOWED_UPDATES
+)
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookIntake:
+    """
+    Прием обновлений от Telegram
+
+    Обновление передается в обработчик обновлений приложения (с его
+    порядком по пользователям) и HTTP-ответ возвращается сразу. Принятых,
+    но еще не обработанных обновлений не больше max_pending: сверх этого
+    сервер отвечает 503, и Telegram повторит доставку позже, а память бота
+    не растет вместе с очередью.
+    """
+
+    def __init__(self, application: Application, secret_token: str, max_pending: int):
+        self.application = application
+        self.secret_token = secret_token
+        self.max_pending = max_pending
+        self.pending = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    async def _process(self, update: Update):
+        try:
+            await self.application.update_processor.process_update(
+                update, self.application.process_update(update)
+            )
+        finally:
+            self.pending -= 1
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Обработчик POST-запроса с обновлением"""
+        if not hmac.compare_digest(
+            request.headers.get(SECRET_TOKEN_HEADER, ''), self.secret_token
+        ):
+            logger.warning(f"Webhook: запрос с неверным секретным токеном от {request.remote}")
+            return web.Response(status=403)
+
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            return web.Response(status=503, headers={'Retry-After': '1'})
+
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except (json.JSONDecodeError, ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Webhook: некорректное обновление: {e}")
+            return web.Response(status=400)
+        if update is None:
+            return web.Response(status=400)
+
+        self.pending += 1
+        self.accepted += 1
+        # Задачи приложения дожидаются при остановке, поэтому принятые обновления не теряются
+        self.application.create_task(self._process(update), update=update)
+        return web.Response()
+
+    async def health(self, request: web.Request) -> web.Response:
+        """Состояние приема: для мониторинга и локальной проверки"""
+        return web.json_response({
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+        })
+
+
+def create_webhook_app(intake: WebhookIntake) -> web.Application:
+    """aiohttp-приложение с маршрутом webhook"""
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, intake.handle)
+    app.router.add_get(f"{WEBHOOK_PATH}/health", intake.health)
+    return app
+
+
+async def _serve(application: Application):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    # Тот же порядок запуска и остановки, что и у Application.run_polling
+    await application.initialize()
+    runner = None
+    try:
+        if application.post_init:
+            await application.post_init(application)
+
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                allowed_updates=ALLOWED_UPDATES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                drop_pending_updates=False
+            )
+            logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL}")
+        else:
+            logger.warning("WEBHOOK_URL не задан: webhook в Telegram не регистрируется (локальный режим)")
+
+        await application.start()
+
+        intake = WebhookIntake(application, WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_PENDING)
+        runner = web.AppRunner(create_webhook_app(intake), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+        logger.info(f"Webhook слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+        await stop_event.wait()
+        logger.info("Получен сигнал остановки")
+    finally:
+        # Сначала перестаем принимать обновления, затем дорабатываем принятые
+        if runner is not None:
+            await runner.cleanup()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application: Application):
+    """Запуск бота в режиме webhook (блокирует до остановки)"""
+    # Без секретного токена любой, кто знает адрес, мог бы присылать боту поддельные обновления
+    if not WEBHOOK_SECRET_TOKEN:
+        raise RuntimeError("WEBHOOK_SECRET_TOKEN не указан в файле .env (обязателен в режиме webhook)")
+    asyncio.run(_serve(application))